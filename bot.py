@@ -1,5 +1,9 @@
+import asyncio
+import functools
+import io
 import logging
 import os
+import secrets
 from typing import Any, List, Optional
 from textwrap import dedent
 from enum import Enum
@@ -21,10 +25,11 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 from telegram.helpers import escape_markdown
-from telegram.request import BaseRequest
+from telegram.request import BaseRequest, HTTPXRequest
 
 from dotenv import load_dotenv
 
@@ -34,19 +39,30 @@ import users
 from users import UserRole
 import stats
 import pause
-
-load_dotenv()
-
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
+import broadcasts
+import delivery
+import exports
+import invalidation
+import metrics
+import profiling
+import throttle
+import tracing
+import update_journal
+import webhook
+import workers
+from store import quest_store
+from update_processing import (
+    ChatOrderedUpdateProcessor,
+    drop_duplicate_update,
+    recent_updates,
 )
-logging.getLogger("httpx").setLevel(logging.WARNING)
+
 logger = logging.getLogger(__name__)
 
 class Action(Enum):
     ADD_NUMBER = 1
     BROADCAST = 2
+    IMPORT_PHONEBOOK = 3
 
 class LongActionContext:
     def __init__(self) -> None:
@@ -73,16 +89,26 @@ class LongActionContext:
         self._action = Action.BROADCAST
         self._reply_parts = []
 
+    def start_import_phonebook(self) -> None:
+        assert self._action == None, "another operation is in progress"
+        self._action = Action.IMPORT_PHONEBOOK
+
+    def finish_import_phonebook(self) -> bool:
+        if self._action != Action.IMPORT_PHONEBOOK:
+            return False
+        self._action = None
+        return True
+
     def add_reply_part(self, reply_part: ReplyPart) -> bool:
         if self._action == None:
             return False
         self._reply_parts.append(reply_part)
         return True
 
-    def finish_add_number(self) -> bool:
+    async def finish_add_number(self) -> bool:
         if self._action != Action.ADD_NUMBER:
             return False
-        phonebook.add_number(self._phone, self._password, Reply(self._reply_parts))
+        await phonebook.add_number(self._phone, self._password, Reply(self._reply_parts))
         self._action = None
         return True
 
@@ -115,6 +141,39 @@ async def check_admin_permission(update: Update) -> bool:
         return False
     return True
 
+# Admins are not throttled.
+async def check_throttle(update: Update, command: str) -> bool:
+    if update.effective_user is None:
+        return False
+    user = users.users.get(update.effective_user.id)
+    if user is not None and user.role == UserRole.ADMIN:
+        return True
+    verdict = throttle.check(update.effective_user.id, command)
+    if verdict == throttle.Verdict.NOTIFY and update.message is not None:
+        await update.message.reply_text("_Лінія зайнята, спробуйте пізніше_",
+                                        parse_mode="MarkdownV2")
+    return verdict == throttle.Verdict.ALLOW
+
+# With several worker processes, caches another worker changed are reloaded
+# before the next update is handled.
+async def refresh_stale_caches(update: object,
+                               context: ContextTypes.DEFAULT_TYPE) -> None:
+    if invalidation.stale(invalidation.USERS):
+        users.read_users()
+    if invalidation.stale(invalidation.PHONEBOOK):
+        phonebook.read_phonebook()
+        phonebook.read_phone_aliases()
+    if invalidation.stale(invalidation.PAUSE):
+        pause.read_pause()
+    if invalidation.stale(invalidation.THROTTLE):
+        throttle.read_limits()
+
+# Calls change all the time, so call statistics are only refreshed for the
+# reports that show other workers' captains.
+async def refresh_call_stats() -> None:
+    if invalidation.stale(invalidation.CALLS):
+        await stats.refresh_call_stats()
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if (context.user_data is None):
         context.user_data = {}
@@ -137,6 +196,10 @@ async def get_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
                         /add_number номер [пароль] — додати новий номер в телефонну книгу
                         /broadcast — надіслати повідомлення всім капітанам
+                        /broadcasts — стан останніх оголошень
+                        /retry_broadcast номер — повторити оголошення для капітанів з помилками
+                        /import_phonebook — замінити телефонну книгу файлом .jsonl чи .csv
+                        /export_phonebook [jsonl|csv] — отримати телефонну книгу файлом
 
                         Керування капітанами:
                         /add_captain user_id username — додати капітана
@@ -151,12 +214,21 @@ async def get_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                         Перегляд прогресу:
                         /leaderboard — таблиця лідерів
                         /progress username — прогрес окремого капітана
+                        /export — дзвінки, таблиця лідерів і прогрес файлами CSV
                         /add_alias номер імʼя/назва — додати імʼя чи назву важливого номеру
                         /remove_alias номер — видалити імʼя чи назву номеру
 
+                        Обмеження для капітанів:
+                        /throttle — показати, скільки команд на хвилину дозволено капітану
+                        /throttle ліміт запас — змінити ліміт на хвилину і запас (0 — вимкнути)
+
                         Команди для Артема:
                         /read_users — оновити базу даних користувачів
-                        /read_phonebook — оновити телефонну книгу""")
+                        /read_phonebook — оновити телефонну книгу
+                        /journal — стан журналу дзвінків
+                        /check_counts — звірити лічильники дзвінків з журналом
+                        /metrics — затримки обробників, бази та Bot API
+                        /profile [секунди] [memory] — профілювати бота і надіслати гарячі точки""")
             )
         case UserRole.CAPTAIN:
             await update.message.reply_text(
@@ -179,36 +251,13 @@ async def get_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 #    await update.message.reply_text(f"Photo ID: `{file_id}`", parse_mode="MarkdownV2")
 
 async def send_reply(message: Message, reply: Reply) -> None:
-    for part in reply.parts:
-        match part.reply_type:
-            case ReplyType.TEXT:
-                await message.reply_text(part.reply_data)
-            case ReplyType.PHOTO:
-                await message.reply_photo(part.reply_data)
-            case ReplyType.STICKER:
-                await message.reply_sticker(part.reply_data)
-            case ReplyType.VOICE:
-                await message.reply_voice(part.reply_data)
-            case ReplyType.DOCUMENT:
-                await message.reply_document(part.reply_data)
-
-async def send_message(bot: Bot, user_id: int, reply: Reply) -> None:
-    for part in reply.parts:
-        match part.reply_type:
-            case ReplyType.TEXT:
-                await bot.send_message(user_id, part.reply_data)
-            case ReplyType.PHOTO:
-                await bot.send_photo(user_id, part.reply_data)
-            case ReplyType.STICKER:
-                await bot.send_sticker(user_id, part.reply_data)
-            case ReplyType.VOICE:
-                await bot.send_voice(user_id, part.reply_data)
-            case ReplyType.DOCUMENT:
-                await bot.send_document(user_id, part.reply_data)
+    await delivery.send_reply(message.get_bot(), message.chat_id, reply)
 
 async def call(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await check_captain_permission(update):
         return
+    if not await check_throttle(update, "call"):
+        return
     if (context.args is None or
         update.message is None or
         update.effective_user is None):
@@ -222,20 +271,31 @@ async def call(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logging.info(f"received a call from {update.effective_user.id} to number {number} ({password})")
     # Record the call in the database only after delivering the reply. Recording it
     # first could deduct a point even if sending fails, so failed deliveries go unrecorded.
-    if (number, password) in phonebook.phonebook.replies:
-        await send_reply(update.message,
-                         phonebook.phonebook.replies[(number, password)])
-    else:
-        await update.message.reply_text("_Ніхто не відповідає\\.\\.\\._",
-                                        parse_mode="MarkdownV2")
-    stats.log_call(update.effective_user.id,
-                   update.message.date,
-                   number,
-                   password)
+    # OutboundLimiter has already retried whatever could be retried, so an error
+    # here means the reply was not (fully) delivered, or after a TimedOut that
+    # it may have been; such a call is not counted either.
+    try:
+        if (number, password) in phonebook.phonebook.replies:
+            await send_reply(update.message,
+                             phonebook.phonebook.replies[(number, password)])
+        else:
+            await update.message.reply_text("_Ніхто не відповідає\\.\\.\\._",
+                                            parse_mode="MarkdownV2")
+    except error.TelegramError:
+        logging.exception(f"reply to the call from {update.effective_user.id} "
+                          f"was not delivered, the call is not recorded")
+        return
+    await stats.log_call(update.effective_user.id,
+                         update.message.date,
+                         number,
+                         password,
+                         update.update_id)
 
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await check_captain_permission(update):
         return
+    if not await check_throttle(update, "status"):
+        return
     if (update.message is None or
         update.effective_user is None):
         return
@@ -297,6 +357,68 @@ async def broadcast(update: Update,
             parse_mode = "MarkdownV2"
     )
 
+async def import_phonebook(update: Update,
+                           context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_admin_permission(update):
+        return
+    if update.message is None:
+        return
+    long_action_context = get_long_action_context(context)
+    if long_action_context.current_action() != None:
+        await update.message.reply_text("_Виконується інша операція_",
+                                        parse_mode = "MarkdownV2")
+        return
+    long_action_context.start_import_phonebook()
+    await update.message.reply_text(
+            dedent(f"""\
+                    _Надішліть файл телефонної книги \\(\\.jsonl або \\.csv\\)\\._
+                    _Він замінить всі номери та назви номерів\\._
+                    _Для відміни використайте команду_ `/cancel` _\\._
+                    """),
+            parse_mode = "MarkdownV2"
+    )
+
+async def import_phonebook_file(message: Message,
+                                long_action_context: LongActionContext) -> None:
+    document = message.document
+    if document is None or document.file_name is None:
+        await message.reply_text("_Очікую файл телефонної книги_",
+                                 parse_mode = "MarkdownV2")
+        return
+    try:
+        file_format = phonebook.file_format(document.file_name)
+        data = await (await document.get_file()).download_as_bytearray()
+        phonebook_file = phonebook.parse_phonebook_file(
+                data.decode("utf-8-sig"), file_format
+        )
+    except (phonebook.PhonebookFileError, UnicodeDecodeError) as e:
+        await message.reply_text(f"Файл не імпортовано: {e}")
+        return
+    await phonebook.replace_phonebook(phonebook_file)
+    long_action_context.finish_import_phonebook()
+    await message.reply_text(
+            f"Імпортовано номерів: {len(phonebook_file.replies)}, "
+            f"назв номерів: {len(phonebook_file.aliases)}"
+    )
+
+async def export_phonebook(update: Update,
+                           context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_admin_permission(update):
+        return
+    if context.args is None or update.message is None:
+        return
+    file_format = context.args[0] if context.args else "jsonl"
+    if file_format not in phonebook.FILE_FORMATS:
+        await update.message.reply_text("Використання: /export_phonebook [jsonl|csv]")
+        return
+    output = io.BytesIO()
+    with io.TextIOWrapper(output, encoding = "utf-8", newline = "") as text:
+        phonebook.export_phonebook(text, file_format)
+        text.flush()
+        output.seek(0)
+        await update.message.reply_document(output,
+                                            filename = f"phonebook.{file_format}")
+
 async def done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await check_admin_permission(update):
         return
@@ -308,32 +430,71 @@ async def done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             await update.message.reply_text("_Операція не виконується_",
                                             parse_mode = "MarkdownV2")
         case Action.ADD_NUMBER:
-            long_action_context.finish_add_number()
+            await long_action_context.finish_add_number()
             await update.message.reply_text("_Номер додано_",
                                             parse_mode = "MarkdownV2")
+        case Action.IMPORT_PHONEBOOK:
+            await update.message.reply_text("_Очікую файл телефонної книги_",
+                                            parse_mode = "MarkdownV2")
         case Action.BROADCAST:
-            for user in users.users.values():
-                if user.role == UserRole.CAPTAIN:
-                    await update.message.reply_text(
-                            f"_Надсилаю капітану {escape_markdown(user.username)}_",
-                            parse_mode = "MarkdownV2"
-                    )
-                    try:
-                        await send_message(context.bot,
-                                           user.user_id,
-                                           long_action_context.reply())
-                    except error.BadRequest:
-                        await update.message.reply_text(
-                                "_Капітан не активував бота_",
-                                parse_mode = "MarkdownV2"
-                        )
-                    except error.Forbidden:
-                        await update.message.reply_text(
-                                "_Капітан не активував бота_",
-                                parse_mode = "MarkdownV2"
-                        )
+            captains = [user for user in users.users.values()
+                        if user.role == UserRole.CAPTAIN]
+            broadcast_id = await broadcasts.create_broadcast(update.message.chat_id,
+                                                             captains,
+                                                             long_action_context.reply())
+            broadcasts.start_broadcast(context.bot, broadcast_id)
             long_action_context.finish_broadcast()
 
+async def list_broadcasts(update: Update,
+                          context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_admin_permission(update):
+        return
+    if update.message is None:
+        return
+    summaries = await broadcasts.broadcast_summaries(10)
+    if summaries == []:
+        await update.message.reply_text("Оголошень ще не було")
+        return
+    status = broadcasts.RecipientStatus
+    lines = []
+    for broadcast_id, created_at, counts in summaries:
+        created = datetime.fromtimestamp(created_at).strftime("%d.%m %H:%M")
+        running = " (надсилається)" if broadcast_id in broadcasts.running else ""
+        lines.append(
+            f"#{broadcast_id} {created}{running}: "
+            f"доставлено {counts.get(status.DELIVERED, 0)}, "
+            f"не активували {counts.get(status.BLOCKED, 0)}, "
+            f"помилки {counts.get(status.FAILED, 0)}, "
+            f"в черзі {counts.get(status.PENDING, 0)}"
+        )
+    await update.message.reply_text("\n".join(lines))
+
+async def retry_broadcast(update: Update,
+                          context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_admin_permission(update):
+        return
+    if context.args is None or update.message is None:
+        return
+    try:
+        broadcast_id = int(context.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text("Використання: /retry_broadcast номер")
+        return
+    if broadcast_id in broadcasts.running:
+        await update.message.reply_text("Це оголошення ще надсилається")
+        return
+    reset = await broadcasts.reset_failed(broadcast_id)
+    if reset is None:
+        # Another worker is sending it.
+        await update.message.reply_text("Це оголошення ще надсилається")
+        return
+    if reset == 0:
+        await update.message.reply_text("Немає кому надсилати повторно")
+        return
+    # Resuming may have started it meanwhile.
+    if broadcast_id not in broadcasts.running:
+        broadcasts.start_broadcast(context.bot, broadcast_id)
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await check_admin_permission(update):
         return
@@ -352,6 +513,7 @@ async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
     if update.message is None:
         return
+    await refresh_call_stats()
     result = stats.stats()
     await update.message.reply_text(
         "\n".join(map(
@@ -360,6 +522,19 @@ async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         ))
     )
 
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_admin_permission(update):
+        return
+    if update.message is None:
+        return
+    files = await quest_store.run_read(exports.export_snapshot)
+    try:
+        for file_name, file in files:
+            await update.message.reply_document(file, filename = file_name)
+    finally:
+        for _, file in files:
+            file.close()
+
 async def progress(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await check_admin_permission(update):
         return
@@ -367,14 +542,14 @@ async def progress(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     username = context.args[0]
     user_id = users.users_by_username[username].user_id
+    await refresh_call_stats()
     result = stats.progress(user_id)
     if result == []:
         await update.message.reply_text("Повідомлень поки немає")
         return
 
-    start_of_day = min(
-        map(lambda stat: stat[2], result)
-    ).replace(hour=0, minute=0, second=0, microsecond=0)
+    # stats.progress returns first calls in chronological order.
+    start_of_day = result[0][2].replace(hour=0, minute=0, second=0, microsecond=0)
     def format_datetime(date: datetime) -> str:
         total_seconds = int((date - start_of_day).total_seconds())
         hours = total_seconds // 3600
@@ -415,6 +590,9 @@ async def long_action_handler(update: Update,
     if update.message is None:
         return
     long_action_context = get_long_action_context(context)
+    if long_action_context.current_action() == Action.IMPORT_PHONEBOOK:
+        await import_phonebook_file(update.message, long_action_context)
+        return
     result = False
     if update.message.text is not None:
         result = long_action_context.add_reply_part(
@@ -445,6 +623,7 @@ async def read_users(update: Update,
     if not await check_admin_permission(update):
         return
     users.read_users()
+    invalidation.bump(invalidation.USERS)
 
 async def read_phonebook(update: Update,
                          context: ContextTypes.DEFAULT_TYPE):
@@ -452,6 +631,7 @@ async def read_phonebook(update: Update,
         return
     phonebook.read_phonebook()
     phonebook.read_phone_aliases()
+    invalidation.bump(invalidation.PHONEBOOK)
 
 async def add_captain(update: Update,
                       context: ContextTypes.DEFAULT_TYPE):
@@ -461,7 +641,7 @@ async def add_captain(update: Update,
         return
     user_id = context.args[0]
     username = context.args[1]
-    users.add_captain(user_id, username)
+    await users.add_captain(user_id, username)
 
 async def remove_captain(update: Update,
                       context: ContextTypes.DEFAULT_TYPE):
@@ -470,7 +650,7 @@ async def remove_captain(update: Update,
     if context.args is None:
         return
     user_id = context.args[0]
-    users.remove_captain(user_id)
+    await users.remove_captain(user_id)
 
 async def list_users(update: Update,
                      context: ContextTypes.DEFAULT_TYPE):
@@ -495,7 +675,7 @@ async def pause_calls(update: Update,
         await update.message.reply_text("_Телефонна мережа вже вимкнена_",
                                         parse_mode = "MarkdownV2")
     else:
-        pause.pause_calls()
+        await pause.pause_calls()
         await update.message.reply_text("_Телефонну мережу вимкнено_",
                                         parse_mode = "MarkdownV2")
 
@@ -509,7 +689,7 @@ async def resume_calls(update: Update,
         await update.message.reply_text("_Телефонна мережа не вимкнена_",
                                         parse_mode = "MarkdownV2")
     else:
-        pause.resume_calls()
+        await pause.resume_calls()
         await update.message.reply_text("_Телефонну мережу увімкнено_",
                                         parse_mode = "MarkdownV2")
 
@@ -521,7 +701,7 @@ async def add_alias(update: Update,
         return
     number = context.args[0]
     alias = ' '.join(context.args[1:])
-    phonebook.add_phone_alias(number, alias)
+    await phonebook.add_phone_alias(number, alias)
     await update.message.reply_text("_Додано_", parse_mode = "MarkdownV2")
 
 async def remove_alias(update: Update,
@@ -531,9 +711,148 @@ async def remove_alias(update: Update,
     if context.args is None or update.message is None:
         return
     number = context.args[0]
-    phonebook.remove_phone_alias(number)
+    await phonebook.remove_phone_alias(number)
     await update.message.reply_text("_Видалено_", parse_mode = "MarkdownV2")
 
+async def throttle_limits(update: Update,
+                          context: ContextTypes.DEFAULT_TYPE):
+    if not await check_admin_permission(update):
+        return
+    if context.args is None or update.message is None:
+        return
+    if len(context.args) != 0:
+        try:
+            rate_per_minute, burst = (float(arg) for arg in context.args)
+        except ValueError:
+            await update.message.reply_text("Використання: /throttle ліміт запас")
+            return
+        if not throttle.valid_limits(rate_per_minute, burst):
+            await update.message.reply_text("Ліміт має бути не менше 0, запас — не менше 1")
+            return
+        await throttle.modify_limits(rate_per_minute, burst)
+    if throttle.rate_per_minute <= 0:
+        await update.message.reply_text("Обмеження вимкнено")
+        return
+    await update.message.reply_text(
+        f"Ліміт: {throttle.rate_per_minute:g} команд на хвилину, "
+        f"запас: {throttle.burst:g}"
+    )
+
+async def journal(update: Update,
+                  context: ContextTypes.DEFAULT_TYPE):
+    if not await check_admin_permission(update):
+        return
+    if update.message is None:
+        return
+    journal_stats = stats.journal_stats()
+    if journal_stats is None:
+        await update.message.reply_text("Журнал дзвінків не запущено")
+        return
+    await update.message.reply_text(
+        dedent(f"""\
+                Черга: {journal_stats.queue_depth}
+                Записано дзвінків: {journal_stats.committed_calls}
+                Записано пакетів: {journal_stats.committed_batches}
+                Втрачено дзвінків: {journal_stats.dropped_calls}
+                Останній коміт: {journal_stats.last_commit_latency * 1000:.1f} мс
+                Найдовший коміт: {journal_stats.max_commit_latency * 1000:.1f} мс""")
+    )
+
+async def check_counts(update: Update,
+                       context: ContextTypes.DEFAULT_TYPE):
+    if not await check_admin_permission(update):
+        return
+    if update.message is None:
+        return
+    mismatches = await stats.reconcile_call_counts()
+    if mismatches == []:
+        await update.message.reply_text("Лічильники дзвінків збігаються з журналом")
+        return
+    await update.message.reply_text(
+        "Лічильники виправлено:\n" + "\n".join(map(
+            lambda mismatch: f"{mismatch[0]}: {mismatch[1]} → {mismatch[2]}",
+            mismatches
+        ))
+    )
+
+def format_histograms(title: str, name: str) -> List[str]:
+    lines = [title]
+    for labels, histogram in sorted(metrics.registry.histogram_snapshot(name).items()):
+        label = " ".join(value for _, value in labels)
+        lines.append(f"{label} — {histogram.count}, "
+                     f"сер. {histogram.sum / histogram.count * 1000:.1f} мс, "
+                     f"p95 ≤ {histogram.quantile(0.95) * 1000:.1f} мс, "
+                     f"макс. {histogram.max * 1000:.1f} мс")
+    return lines
+
+def format_counters(title: str, name: str) -> List[str]:
+    lines = [title]
+    for labels, value in sorted(metrics.registry.counter_snapshot(name).items()):
+        label = " ".join(value for _, value in labels)
+        lines.append(f"{label} — {value}")
+    return lines
+
+async def show_metrics(update: Update,
+                       context: ContextTypes.DEFAULT_TYPE):
+    if not await check_admin_permission(update):
+        return
+    if update.message is None:
+        return
+    lines = (format_histograms("Обробники:", metrics.HANDLER_SECONDS) +
+             format_counters("Помилки обробників:", metrics.HANDLER_ERRORS) +
+             format_histograms("Запити до бази:", metrics.QUERY_SECONDS) +
+             format_histograms("Bot API:", metrics.BOT_API_SECONDS) +
+             format_counters("Помилки Bot API:", metrics.BOT_API_ERRORS) +
+             format_histograms("Очікування в черзі:", delivery.OUTBOUND_WAIT_SECONDS) +
+             format_counters("Повтори Bot API:", delivery.OUTBOUND_RETRIES) +
+             format_counters("Повторні оновлення:", metrics.DUPLICATE_UPDATES) +
+             format_counters("Обмежені команди:", throttle.THROTTLED))
+    for text in delivery.split_lines(lines):
+        await update.message.reply_text(text)
+
+async def profile(update: Update,
+                  context: ContextTypes.DEFAULT_TYPE):
+    if not await check_admin_permission(update):
+        return
+    if context.args is None or update.message is None:
+        return
+    memory = "memory" in context.args
+    args = [arg for arg in context.args if arg != "memory"]
+    try:
+        seconds = float(args[0]) if len(args) != 0 else 10.0
+    except ValueError:
+        seconds = -1.0
+    if len(args) > 1 or not 0 < seconds <= profiling.MAX_SECONDS:
+        await update.message.reply_text(
+            f"Використання: /profile [секунди до {profiling.MAX_SECONDS:g}] [memory]")
+        return
+    if profiling.is_running():
+        await update.message.reply_text("Профілювання вже триває")
+        return
+    # The handler returns right away: profiling must not hold up the updates
+    # it is meant to measure.
+    profiling.start(send_profile(context.application,
+                                 update.message.chat_id,
+                                 seconds,
+                                 memory))
+    await update.message.reply_text(f"Профілюю {seconds:g} с")
+
+async def send_profile(application: Application,
+                       chat_id: int,
+                       seconds: float,
+                       memory: bool) -> None:
+    report = await profiling.profile_for(seconds, memory)
+    lines = ["Гарячі точки (мс разом, мс власні, виклики):"] + report.hotspots
+    if memory:
+        lines += ["",
+                  f"Телефонна книга: {len(phonebook.phonebook.replies)} відповідей, "
+                  f"user_data: {len(application.user_data)} користувачів",
+                  "Приріст памʼяті:"] + report.allocations
+    await application.bot.send_message(chat_id, "\n".join(lines))
+    await application.bot.send_document(chat_id,
+                                        report.profile,
+                                        filename = "quest.prof")
+
 async def error_handler(update: Any | None,
                         context: ContextTypes.DEFAULT_TYPE) -> None:
     e = context.error
@@ -543,13 +862,110 @@ async def error_handler(update: Any | None,
         await update.message.reply_text("_Технічна помилка_",
                                         parse_mode = "MarkdownV2")
 
+class QuestApplication(Application):
+    # Unlike post_init and post_shutdown, these also run for `async with
+    # application`, so tests get the same lifecycle as run_polling. Importing
+    # the bot does no I/O; the database is opened and the caches are loaded
+    # here.
+    def __init__(self,
+                 *,
+                 database_path: str,
+                 update_journal_path: str,
+                 resume_broadcasts: bool,
+                 **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.database_path = database_path
+        self.update_journal_path = update_journal_path
+        self.resume_broadcasts = resume_broadcasts
+        self.metrics_task: asyncio.Task | None = None
+
+    async def initialize(self) -> None:
+        await super().initialize()
+        # Checks the settings before anything is started.
+        throttle.configure()
+        if self.update_journal_path != "":
+            update_journal.open_journal(self.update_journal_path)
+        metrics_file = os.getenv("METRICS_FILE")
+        if metrics_file is not None:
+            self.metrics_task = asyncio.create_task(
+                metrics.write_prometheus_file_periodically(
+                    metrics_file,
+                    float(os.getenv("METRICS_INTERVAL", "15"))
+                )
+            )
+        tracing.configure(int(os.getenv("SQLITE_TRACE_EVENTS", "1000")),
+                          float(os.getenv("SQLITE_TRACE_DUMP_INTERVAL", "10")))
+        quest_store.open(self.database_path,
+                         float(os.getenv("SQLITE_BUSY_TIMEOUT", "5")),
+                         int(os.getenv("SQLITE_WRITE_ATTEMPTS", "5")),
+                         int(os.getenv("SQLITE_READ_THREADS", "2")),
+                         float(os.getenv("SQLITE_READ_TIMEOUT", "30")),
+                         float(os.getenv("SQLITE_MAX_WRITE_WAIT", "15")))
+        users.setup()
+        phonebook.setup()
+        pause.setup()
+        throttle.setup()
+        stats.setup()
+        broadcasts.setup()
+        recent_updates_capacity = int(os.getenv("RECENT_UPDATES", "10000"))
+        recent_updates.reset(recent_updates_capacity,
+                             stats.recent_update_ids(recent_updates_capacity))
+        broadcasts.configure()
+        if self.resume_broadcasts:
+            await broadcasts.resume_broadcasts(self.bot)
+        stats.start_journal()
+
+    async def shutdown(self) -> None:
+        if self.metrics_task is not None:
+            self.metrics_task.cancel()
+            self.metrics_task = None
+        profiling.cancel()
+        await broadcasts.drain()
+        await asyncio.to_thread(stats.stop_journal)
+        quest_store.close()
+        update_journal.close_journal()
+        await super().shutdown()
+
 def create_application(token: str,
-                       request: Optional[BaseRequest] = None) -> Application:
-    builder = Application.builder().token(token)
-    if request is not None:
-        builder.request(request)
+                       request: Optional[BaseRequest] = None,
+                       database_path: Optional[str] = None,
+                       concurrent_updates: Optional[int] = None,
+                       update_journal_path: Optional[str] = None,
+                       resume_broadcasts: bool = True) -> Application:
+    if database_path is None:
+        database_path = os.getenv("QUEST_DB_PATH", "quest.db")
+    if concurrent_updates is None:
+        concurrent_updates = int(os.getenv("CONCURRENT_UPDATES", "0"))
+    if update_journal_path is None:
+        update_journal_path = os.getenv("UPDATE_JOURNAL", "")
+    builder = Application.builder().application_class(
+        QuestApplication,
+        kwargs={
+            "database_path": database_path,
+            "update_journal_path": update_journal_path,
+            "resume_broadcasts": resume_broadcasts,
+        },
+    ).token(token)
+    builder.rate_limiter(delivery.OutboundLimiter(
+        float(os.getenv("OUTBOUND_GLOBAL_RATE", "30")),
+        float(os.getenv("OUTBOUND_BACKGROUND_RATE", "20")),
+        float(os.getenv("OUTBOUND_CHAT_RATE", "1")),
+        float(os.getenv("OUTBOUND_CHAT_BURST", "5")),
+        int(os.getenv("OUTBOUND_MAX_ATTEMPTS", "4")),
+    ))
+    builder.request(metrics.InstrumentedRequest(
+        request if request is not None else HTTPXRequest(connection_pool_size=256)
+    ))
+    if concurrent_updates > 0:
+        builder.concurrent_updates(ChatOrderedUpdateProcessor(concurrent_updates))
     application = builder.build()
 
+    if update_journal_path != "":
+        application.add_handler(TypeHandler(Update, update_journal.record_update),
+                                group=-2)
+    application.add_handler(TypeHandler(Update, refresh_stale_caches), group=-3)
+    application.add_handler(TypeHandler(Update, drop_duplicate_update), group=-1)
+
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", get_help))
 
@@ -560,12 +976,19 @@ def create_application(token: str,
     # Commands for Artem
     application.add_handler(CommandHandler("read_users", read_users))
     application.add_handler(CommandHandler("read_phonebook", read_phonebook))
+    application.add_handler(CommandHandler("journal", journal))
+    application.add_handler(CommandHandler("check_counts", check_counts))
+    application.add_handler(CommandHandler("metrics", show_metrics))
+    application.add_handler(CommandHandler("profile", profile))
 
     # Captain administration
     application.add_handler(CommandHandler("add_captain", add_captain))
     application.add_handler(CommandHandler("remove_captain", remove_captain))
     application.add_handler(CommandHandler("list_users", list_users))
 
+    # Captain throttling
+    application.add_handler(CommandHandler("throttle", throttle_limits))
+
     # Pause control
     application.add_handler(CommandHandler("pause_calls", pause_calls))
     application.add_handler(CommandHandler("resume_calls", resume_calls))
@@ -573,12 +996,17 @@ def create_application(token: str,
     # Viewing progress
     application.add_handler(CommandHandler("leaderboard", leaderboard))
     application.add_handler(CommandHandler("progress", progress))
+    application.add_handler(CommandHandler("export", export))
     application.add_handler(CommandHandler("add_alias", add_alias))
     application.add_handler(CommandHandler("remove_alias", remove_alias))
 
     # Adding number and broadcasting
     application.add_handler(CommandHandler("add_number", add_number))
+    application.add_handler(CommandHandler("import_phonebook", import_phonebook))
+    application.add_handler(CommandHandler("export_phonebook", export_phonebook))
     application.add_handler(CommandHandler("broadcast", broadcast))
+    application.add_handler(CommandHandler("broadcasts", list_broadcasts))
+    application.add_handler(CommandHandler("retry_broadcast", retry_broadcast))
     application.add_handler(CommandHandler("done", done))
     application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(MessageHandler(filters.TEXT |
@@ -593,17 +1021,72 @@ def create_application(token: str,
 
     application.add_error_handler(error_handler)
 
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, CommandHandler):
+                handler.callback = metrics.timed_handler(
+                    min(handler.commands), handler.callback
+                )
+    metrics.registry.gauge(
+        "quest_call_journal_queue_depth",
+        lambda: len(stats.pending_calls())
+    )
+
     return application
 
 
+# Runs in a worker process. Telegram's overall limit is per bot, so the
+# workers split the overall rates; each writes its own metrics file, updates
+# are recorded by the intake and only the first worker resumes broadcasts.
+def create_worker_application(token: str, index: int, count: int) -> Application:
+    for name, default in (("OUTBOUND_GLOBAL_RATE", "30"),
+                          ("OUTBOUND_BACKGROUND_RATE", "20")):
+        os.environ[name] = str(float(os.getenv(name, default)) / count)
+    metrics_file = os.getenv("METRICS_FILE")
+    if metrics_file is not None:
+        os.environ["METRICS_FILE"] = f"{metrics_file}.{index}"
+    return create_application(token,
+                              update_journal_path = "",
+                              resume_broadcasts = index == 0)
+
 def main() -> None:
+    load_dotenv()
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO
+    )
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
     token = os.getenv("TOKEN")
     if token is None:
         print("TOKEN is not in the environment")
         return
-    application = create_application(token)
+    worker_count = int(os.getenv("WORKERS", "1"))
+    if worker_count > 1:
+        application = workers.create_intake_application(
+            token,
+            workers.WorkerPool(worker_count,
+                               functools.partial(create_worker_application, token)),
+            update_journal_path = os.getenv("UPDATE_JOURNAL", ""),
+            stop_timeout = float(os.getenv("WORKER_STOP_TIMEOUT", "30")),
+        )
+    else:
+        application = create_application(token)
 
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url is None:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        return
+    asyncio.run(webhook.run_webhook(
+        application,
+        webhook_url,
+        os.getenv("WEBHOOK_LISTEN", "127.0.0.1"),
+        int(os.getenv("WEBHOOK_PORT", "8443")),
+        # Telegram echoes the token back in every request; without a
+        # configured one a random token still keeps strangers out.
+        os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32),
+        float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "10")),
+    ))
 
 if __name__ == "__main__":
     main()
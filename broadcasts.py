@@ -0,0 +1,430 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+import uuid
+
+from sqlite3 import Cursor
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Dict, List, Tuple
+
+from telegram import Message, error
+from telegram.ext import ExtBot
+
+import delivery
+from metrics import timed_query
+from phonebook import Reply, ReplyPart, ReplyType
+from store import quest_store
+from users import User
+
+logger = logging.getLogger(__name__)
+
+# Rate limits and retries are applied to every request by
+# delivery.OutboundLimiter; broadcasts only bound how many captains are
+# being sent to at once.
+concurrency = 8
+progress_interval = 1.0
+drain_timeout = 10.0
+lease_seconds = 30.0
+
+# Several processes can share the database, see workers.py. A broadcast is
+# sent by the one process holding its lease, which it renews while sending.
+# One whose holder died is taken over once the lease runs out.
+owner = uuid.uuid4().hex
+
+def configure() -> None:
+    global concurrency, progress_interval, drain_timeout, lease_seconds, stopping
+    concurrency = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+    progress_interval = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "1"))
+    drain_timeout = float(os.getenv("BROADCAST_DRAIN_TIMEOUT", "10"))
+    lease_seconds = float(os.getenv("BROADCAST_LEASE", "30"))
+    # Left set by the previous application's shutdown.
+    stopping = False
+
+class RecipientStatus(Enum):
+    PENDING = "pending"
+    DELIVERED = "delivered"
+    BLOCKED = "blocked"
+    FAILED = "failed"
+
+@dataclass
+class Recipient:
+    user_id: int
+    username: str
+
+@dataclass
+class BroadcastTally:
+    total: int
+    delivered: List[str] = field(default_factory = list)
+    blocked: List[str] = field(default_factory = list)
+    failed: List[str] = field(default_factory = list)
+
+    def add(self, username: str, status: RecipientStatus) -> None:
+        match status:
+            case RecipientStatus.DELIVERED:
+                self.delivered.append(username)
+            case RecipientStatus.BLOCKED:
+                self.blocked.append(username)
+            case RecipientStatus.FAILED:
+                self.failed.append(username)
+
+    def finished(self) -> int:
+        return len(self.delivered) + len(self.blocked) + len(self.failed)
+
+    def progress_text(self) -> str:
+        return f"Надсилаю оголошення: {self.finished()} з {self.total}"
+
+    def summary_text(self) -> str:
+        lines = [
+            f"Оголошення надіслано {self.total} капітанам.",
+            f"Доставлено: {len(self.delivered)}",
+            f"Не активували бота: {len(self.blocked)}",
+        ]
+        lines.extend(f"  {username}" for username in self.blocked)
+        lines.append(f"Помилки: {len(self.failed)}")
+        lines.extend(f"  {username}" for username in self.failed)
+        return "\n".join(lines)
+
+@dataclass
+class BroadcastJob:
+    broadcast_id: int
+    admin_chat_id: int
+    reply: Reply
+    pending: List[Recipient]
+    tally: BroadcastTally
+
+# A broadcast is stored as a job before anything is sent, leased to this
+# process, and every recipient's status is written as soon as their delivery
+# ends. A job that was interrupted is picked up again on startup, or once its
+# lease runs out, with only the recipients still pending. A recipient whose
+# delivery was under way when the process died gets the broadcast again; at
+# most `concurrency` of them can.
+@timed_query
+async def create_broadcast(admin_chat_id: int, captains: List[User], reply: Reply) -> int:
+    def write(cursor: Cursor) -> int:
+        now = int(time.time())
+        cursor.execute("""
+            INSERT INTO broadcasts (admin_chat_id, created_at, owner, lease_until)
+            VALUES (?, ?, ?, ?)""",
+            (admin_chat_id, now, owner, int(now + lease_seconds))
+        )
+        broadcast_id = cursor.lastrowid
+        assert broadcast_id is not None
+        cursor.executemany("""
+            INSERT INTO broadcast_parts
+            VALUES (?, ?, ?, ?)""",
+            [(broadcast_id, part_n, part.reply_type.value, part.reply_data)
+             for part_n, part in enumerate(reply.parts)]
+        )
+        cursor.executemany("""
+            INSERT INTO broadcast_recipients
+            VALUES (?, ?, ?, ?)""",
+            [(broadcast_id, user.user_id, user.username,
+              RecipientStatus.PENDING.value)
+             for user in captains]
+        )
+        return broadcast_id
+    return await quest_store.write_async(write)
+
+@timed_query
+def load_broadcast(broadcast_id: int) -> BroadcastJob:
+    (admin_chat_id,) = quest_store.read_one("""
+        SELECT admin_chat_id
+        FROM broadcasts
+        WHERE broadcast_id = ?
+    """, (broadcast_id,))
+    reply = Reply([
+        ReplyPart(ReplyType(reply_type), reply_data)
+        for reply_type, reply_data in quest_store.read("""
+            SELECT reply_type, reply_data
+            FROM broadcast_parts
+            WHERE broadcast_id = ?
+            ORDER BY part_n
+        """, (broadcast_id,))
+    ])
+    rows = quest_store.read("""
+        SELECT user_id, username, status
+        FROM broadcast_recipients
+        WHERE broadcast_id = ?
+        ORDER BY rowid
+    """, (broadcast_id,))
+    pending = []
+    tally = BroadcastTally(len(rows))
+    for user_id, username, status in rows:
+        if RecipientStatus(status) == RecipientStatus.PENDING:
+            pending.append(Recipient(user_id, username))
+        else:
+            tally.add(username, RecipientStatus(status))
+    return BroadcastJob(broadcast_id, admin_chat_id, reply, pending, tally)
+
+@timed_query
+async def record_status(broadcast_id: int, user_id: int, status: RecipientStatus) -> None:
+    await quest_store.write_async(lambda cursor: cursor.execute("""
+            UPDATE broadcast_recipients
+            SET status = ?
+            WHERE broadcast_id = ? AND user_id = ?""",
+            (status.value, broadcast_id, user_id)
+    ))
+
+@timed_query
+async def record_finished(broadcast_id: int) -> None:
+    await quest_store.write_async(lambda cursor: cursor.execute("""
+            UPDATE broadcasts
+            SET finished_at = ?, owner = NULL, lease_until = NULL
+            WHERE broadcast_id = ?""",
+            (int(time.time()), broadcast_id)
+    ))
+
+def execute_claim(cursor: Cursor, broadcast_id: int) -> bool:
+    now = int(time.time())
+    cursor.execute("""
+        UPDATE broadcasts
+        SET owner = ?, lease_until = ?
+        WHERE broadcast_id = ?
+        AND (owner IS NULL OR owner = ? OR lease_until < ?)""",
+        (owner, int(now + lease_seconds), broadcast_id, owner, now)
+    )
+    return cursor.rowcount == 1
+
+# Takes the broadcast's lease unless another live process holds it.
+@timed_query
+async def claim(broadcast_id: int) -> bool:
+    return await quest_store.write_async(
+        lambda cursor: execute_claim(cursor, broadcast_id)
+    )
+
+# Returns whether this process still holds the lease.
+@timed_query
+async def renew_lease(broadcast_id: int) -> bool:
+    cursor = await quest_store.write_async(lambda cursor: cursor.execute("""
+            UPDATE broadcasts
+            SET lease_until = ?
+            WHERE broadcast_id = ? AND owner = ?""",
+            (int(time.time() + lease_seconds), broadcast_id, owner)
+    ))
+    return cursor.rowcount == 1
+
+@timed_query
+async def release(broadcast_id: int) -> None:
+    await quest_store.write_async(lambda cursor: cursor.execute("""
+            UPDATE broadcasts
+            SET owner = NULL, lease_until = NULL
+            WHERE broadcast_id = ? AND owner = ?""",
+            (broadcast_id, owner)
+    ))
+
+@timed_query
+def unfinished_broadcasts() -> List[int]:
+    return [broadcast_id for broadcast_id, in quest_store.read("""
+        SELECT broadcast_id
+        FROM broadcasts
+        WHERE finished_at IS NULL
+        ORDER BY broadcast_id
+    """)]
+
+# Claims the broadcast and puts the recipients that failed back in the queue.
+# Returns how many there were, or None if another process is sending it:
+# that one would not see them.
+@timed_query
+async def reset_failed(broadcast_id: int) -> int | None:
+    def write(cursor: Cursor) -> int | None:
+        if not execute_claim(cursor, broadcast_id):
+            exists = cursor.execute(
+                "SELECT 1 FROM broadcasts WHERE broadcast_id = ?",
+                (broadcast_id,)
+            ).fetchone()
+            return None if exists is not None else 0
+        cursor.execute("""
+            UPDATE broadcast_recipients
+            SET status = ?
+            WHERE broadcast_id = ? AND status = ?""",
+            (RecipientStatus.PENDING.value, broadcast_id,
+             RecipientStatus.FAILED.value)
+        )
+        reset = cursor.rowcount
+        if reset > 0:
+            cursor.execute("""
+                UPDATE broadcasts
+                SET finished_at = NULL
+                WHERE broadcast_id = ?""",
+                (broadcast_id,)
+            )
+        else:
+            # Nothing to send, so no lease to keep.
+            cursor.execute("""
+                UPDATE broadcasts
+                SET owner = NULL, lease_until = NULL
+                WHERE broadcast_id = ?""",
+                (broadcast_id,)
+            )
+        return reset
+    return await quest_store.write_async(write)
+
+# (broadcast_id, created_at, recipients per status) of the latest broadcasts,
+# newest first.
+async def broadcast_summaries(limit: int) -> List[Tuple[int, int, Dict[RecipientStatus, int]]]:
+    rows = await quest_store.read_async("""
+        SELECT broadcast_id, created_at, status, COUNT(*)
+        FROM (
+            SELECT broadcast_id, created_at
+            FROM broadcasts
+            ORDER BY broadcast_id DESC
+            LIMIT ?
+        )
+        JOIN broadcast_recipients USING (broadcast_id)
+        GROUP BY broadcast_id, status
+        ORDER BY broadcast_id DESC
+    """, (limit,))
+    summaries: Dict[int, Tuple[int, int, Dict[RecipientStatus, int]]] = {}
+    for broadcast_id, created_at, status, count in rows:
+        summary = summaries.setdefault(broadcast_id, (broadcast_id, created_at, {}))
+        summary[2][RecipientStatus(status)] = count
+    return list(summaries.values())
+
+async def update_progress(bot: ExtBot, message: Message, text: str) -> None:
+    try:
+        await bot.edit_message_text(text,
+                                    chat_id = message.chat_id,
+                                    message_id = message.message_id,
+                                    rate_limit_args = delivery.BACKGROUND)
+    except error.TelegramError:
+        logger.exception("failed to update broadcast progress")
+
+# Set on shutdown once broadcasts had `drain_timeout` seconds to finish:
+# workers finish the recipient they are sending to and leave the rest
+# pending for the next start. Cleared by configure().
+stopping = False
+
+# Returns when the lease is lost, or could not be renewed, which stops the
+# broadcast: by then another process may be sending it.
+async def keep_lease(broadcast_id: int) -> None:
+    while True:
+        await asyncio.sleep(lease_seconds / 3)
+        try:
+            if not await renew_lease(broadcast_id):
+                logger.error(f"broadcast {broadcast_id} was taken over "
+                             f"by another process")
+                return
+        except sqlite3.Error:
+            logger.exception(f"failed to renew the lease on broadcast {broadcast_id}")
+            return
+
+# The caller has claimed the broadcast.
+async def run_broadcast(bot: ExtBot, broadcast_id: int) -> BroadcastTally:
+    lease = asyncio.create_task(keep_lease(broadcast_id))
+    try:
+        return await send_broadcast(bot, broadcast_id, lease)
+    finally:
+        lease.cancel()
+        await release(broadcast_id)
+
+async def send_broadcast(bot: ExtBot,
+                         broadcast_id: int,
+                         lease: asyncio.Task) -> BroadcastTally:
+    job = load_broadcast(broadcast_id)
+    tally = job.tally
+    progress = await bot.send_message(job.admin_chat_id, tally.progress_text(),
+                                      rate_limit_args = delivery.BACKGROUND)
+    remaining = iter(job.pending)
+
+    async def worker() -> None:
+        for recipient in remaining:
+            if stopping or lease.done():
+                return
+            try:
+                await delivery.send_reply(bot, recipient.user_id, job.reply,
+                                          delivery.BACKGROUND)
+                status = RecipientStatus.DELIVERED
+            except (error.BadRequest, error.Forbidden):
+                status = RecipientStatus.BLOCKED
+            except error.TelegramError:
+                logger.exception(f"failed to broadcast to {recipient.user_id}")
+                status = RecipientStatus.FAILED
+            await record_status(broadcast_id, recipient.user_id, status)
+            tally.add(recipient.username, status)
+
+    async def reporter() -> None:
+        text = progress.text
+        while True:
+            await asyncio.sleep(progress_interval)
+            if tally.progress_text() != text:
+                text = tally.progress_text()
+                await update_progress(bot, progress, text)
+
+    reporter_task = asyncio.create_task(reporter())
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        reporter_task.cancel()
+    if tally.finished() < tally.total:
+        await update_progress(bot, progress,
+                              f"{tally.progress_text()}\n"
+                              f"Продовжу після перезапуску бота")
+        return tally
+    await record_finished(broadcast_id)
+    await update_progress(bot, progress, tally.summary_text())
+    return tally
+
+running: Dict[int, asyncio.Task] = {}
+
+def start_broadcast(bot: ExtBot, broadcast_id: int) -> asyncio.Task:
+    assert broadcast_id not in running, f"broadcast {broadcast_id} is running"
+    task = asyncio.create_task(run_broadcast(bot, broadcast_id),
+                               name = f"broadcast-{broadcast_id}")
+    running[broadcast_id] = task
+    task.add_done_callback(lambda task: finish_broadcast(broadcast_id, task))
+    return task
+
+def finish_broadcast(broadcast_id: int, task: asyncio.Task) -> None:
+    running.pop(broadcast_id, None)
+    if not task.cancelled() and task.exception() is not None:
+        e = task.exception()
+        logger.error(f"broadcast {broadcast_id} failed",
+                     exc_info=(type(e), e, e.__traceback__))
+
+async def resume_unfinished(bot: ExtBot) -> None:
+    for broadcast_id in unfinished_broadcasts():
+        if broadcast_id in running:
+            continue
+        if not await claim(broadcast_id):
+            logger.info(f"broadcast {broadcast_id} is sent by another process")
+        # /retry_broadcast may have started it during the claim.
+        elif broadcast_id not in running:
+            logger.info(f"resuming broadcast {broadcast_id}")
+            start_broadcast(bot, broadcast_id)
+
+# Takes over the broadcasts whose sender died once their lease runs out.
+async def keep_resuming(bot: ExtBot) -> None:
+    while True:
+        await asyncio.sleep(lease_seconds)
+        try:
+            await resume_unfinished(bot)
+        except sqlite3.Error:
+            logger.exception("failed to resume broadcasts")
+
+resumer: asyncio.Task | None = None
+
+async def resume_broadcasts(bot: ExtBot) -> None:
+    global resumer
+    await resume_unfinished(bot)
+    resumer = asyncio.create_task(keep_resuming(bot), name = "broadcast-resumer")
+
+async def drain() -> None:
+    global stopping, resumer
+    if resumer is not None:
+        resumer.cancel()
+        resumer = None
+    if running:
+        await asyncio.wait(list(running.values()), timeout = drain_timeout)
+    stopping = True
+    if running:
+        await asyncio.gather(*running.values(), return_exceptions=True)
+
+def setup() -> None:
+    columns = [column[1] for column in quest_store.read("PRAGMA table_info(broadcasts)")]
+    # The layout before leases.
+    if columns and "owner" not in columns:
+        quest_store.run_script("migrate_broadcasts_lease.sql")
+    quest_store.run_script("broadcasts.sql")
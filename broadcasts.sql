@@ -0,0 +1,30 @@
+CREATE TABLE IF NOT EXISTS broadcasts (
+  broadcast_id INTEGER PRIMARY KEY,
+  admin_chat_id INTEGER NOT NULL,
+  created_at INTEGER NOT NULL,
+  finished_at INTEGER NULL,
+  -- The process sending the broadcast, until lease_until in Unix seconds.
+  owner TEXT NULL,
+  lease_until INTEGER NULL
+) STRICT;
+
+CREATE TABLE IF NOT EXISTS broadcast_parts (
+  broadcast_id INTEGER NOT NULL REFERENCES broadcasts (broadcast_id),
+  part_n INTEGER NOT NULL,
+  reply_type TEXT NOT NULL,
+  reply_data TEXT NOT NULL,
+  PRIMARY KEY (broadcast_id, part_n)
+) STRICT;
+
+-- status is pending, delivered, blocked or failed.
+CREATE TABLE IF NOT EXISTS broadcast_recipients (
+  broadcast_id INTEGER NOT NULL REFERENCES broadcasts (broadcast_id),
+  user_id INTEGER NOT NULL,
+  username TEXT NOT NULL,
+  status TEXT NOT NULL,
+  PRIMARY KEY (broadcast_id, user_id)
+) STRICT;
+
+CREATE INDEX IF NOT EXISTS broadcast_unfinished_lookup ON broadcasts (
+  finished_at
+);
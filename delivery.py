@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import random
+import time
+import warnings
+
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Any, Callable, Coroutine, Dict, List
+
+import httpx
+
+from telegram import InputMediaDocument, InputMediaPhoto, error
+from telegram.ext import BaseRateLimiter, ExtBot
+
+import metrics
+from phonebook import Reply, ReplyType
+from ratelimit import KeyedTokenBuckets, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_WAIT_SECONDS = "quest_outbound_wait_seconds"
+OUTBOUND_RETRIES = "quest_outbound_retries_total"
+
+# Rate limit arguments for requests that may yield to captains' replies,
+# such as broadcasts and their progress messages.
+BACKGROUND = {"background": True}
+
+# Telegram's limits for sendMediaGroup, media captions and messages.
+MAX_ALBUM_SIZE = 10
+MAX_CAPTION_LENGTH = 1024
+MAX_MESSAGE_LENGTH = 4096
+
+ALBUM_TYPES = (ReplyType.PHOTO, ReplyType.DOCUMENT)
+
+@dataclass
+class MediaItem:
+    file_id: str
+    caption: str | None = None
+
+# One Bot API request: a single part, or an album of photos or documents.
+@dataclass
+class Delivery:
+    reply_type: ReplyType
+    data: str = ""
+    items: List[MediaItem] = field(default_factory = list)
+
+    def is_album(self) -> bool:
+        return len(self.items) > 1
+
+# Merges consecutive photos, or consecutive documents, into albums. A text
+# part directly after a photo or document becomes its caption, which keeps
+# the order admins recorded: Telegram shows a caption under its media, so
+# a captioned item closes its album.
+def plan_reply(reply: Reply) -> List[Delivery]:
+    deliveries: List[Delivery] = []
+    for part in reply.parts:
+        last = deliveries[-1] if deliveries else None
+        if (part.reply_type == ReplyType.TEXT and
+            last is not None and
+            last.reply_type in ALBUM_TYPES and
+            last.items[-1].caption is None and
+            len(part.reply_data) <= MAX_CAPTION_LENGTH):
+            last.items[-1].caption = part.reply_data
+        elif (part.reply_type in ALBUM_TYPES and
+              last is not None and
+              last.reply_type == part.reply_type and
+              last.items[-1].caption is None and
+              len(last.items) < MAX_ALBUM_SIZE):
+            last.items.append(MediaItem(part.reply_data))
+        elif part.reply_type in ALBUM_TYPES:
+            deliveries.append(Delivery(part.reply_type,
+                                       items = [MediaItem(part.reply_data)]))
+        else:
+            deliveries.append(Delivery(part.reply_type, part.reply_data))
+    return deliveries
+
+# Packs report lines into as few messages as Telegram accepts, splitting
+# between lines; a line too long for one message is cut.
+def split_lines(lines: List[str]) -> List[str]:
+    messages: List[str] = []
+    for line in lines:
+        for start in range(0, max(len(line), 1), MAX_MESSAGE_LENGTH):
+            piece = line[start:start + MAX_MESSAGE_LENGTH]
+            if messages and len(messages[-1]) + 1 + len(piece) <= MAX_MESSAGE_LENGTH:
+                messages[-1] += "\n" + piece
+            else:
+                messages.append(piece)
+    return messages
+
+async def send_delivery(bot: ExtBot,
+                        chat_id: int,
+                        delivery: Delivery,
+                        rate_limit_args: Dict[str, Any] | None = None) -> None:
+    if delivery.is_album():
+        if delivery.reply_type == ReplyType.PHOTO:
+            media = [InputMediaPhoto(item.file_id, caption = item.caption)
+                     for item in delivery.items]
+        else:
+            media = [InputMediaDocument(item.file_id, caption = item.caption)
+                     for item in delivery.items]
+        await bot.send_media_group(chat_id, media,
+                                   rate_limit_args = rate_limit_args)
+        return
+    match delivery.reply_type:
+        case ReplyType.TEXT:
+            await bot.send_message(chat_id, delivery.data,
+                                   rate_limit_args = rate_limit_args)
+        case ReplyType.PHOTO:
+            item = delivery.items[0]
+            await bot.send_photo(chat_id, item.file_id, caption = item.caption,
+                                 rate_limit_args = rate_limit_args)
+        case ReplyType.STICKER:
+            await bot.send_sticker(chat_id, delivery.data,
+                                   rate_limit_args = rate_limit_args)
+        case ReplyType.VOICE:
+            await bot.send_voice(chat_id, delivery.data,
+                                 rate_limit_args = rate_limit_args)
+        case ReplyType.DOCUMENT:
+            item = delivery.items[0]
+            await bot.send_document(chat_id, item.file_id, caption = item.caption,
+                                    rate_limit_args = rate_limit_args)
+
+async def send_reply(bot: ExtBot,
+                     chat_id: int,
+                     reply: Reply,
+                     rate_limit_args: Dict[str, Any] | None = None) -> None:
+    for delivery in plan_reply(reply):
+        await send_delivery(bot, chat_id, delivery, rate_limit_args)
+
+def retry_after_seconds(e: error.RetryAfter) -> float:
+    # PTB warns that retry_after is about to become a timedelta; accept both.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        retry_after = e.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+# Every Bot API request of the application passes through here. Requests
+# wait for the global budget in arrival order and then for their chat's
+# budget. Background requests additionally draw from a smaller budget, which
+# leaves headroom for captains' replies during a broadcast. A RetryAfter
+# pauses the chat (or everything, for requests without a chat) for as long
+# as Telegram asks, and requests that could not connect are retried with
+# jittered exponential backoff. Any other error, TimedOut included, goes to
+# the caller at once, since the request may have been delivered already.
+# Whether the request failed before it reached Telegram, so sending it again
+# cannot deliver it twice. After a TimedOut while waiting for the response, or
+# any other NetworkError, Telegram may already have handled it.
+def never_sent(e: error.NetworkError) -> bool:
+    return isinstance(e.__cause__, (httpx.ConnectError,
+                                    httpx.ConnectTimeout,
+                                    httpx.PoolTimeout))
+
+class OutboundLimiter(BaseRateLimiter[Dict[str, Any]]):
+    def __init__(self,
+                 global_rate: float = 30,
+                 background_rate: float = 20,
+                 chat_rate: float = 1,
+                 chat_burst: float = 5,
+                 max_attempts: int = 4,
+                 backoff: float = 0.5) -> None:
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._global = TokenBucket(global_rate, global_rate)
+        self._background = TokenBucket(background_rate, background_rate)
+        self._chats = KeyedTokenBuckets(chat_rate, chat_burst)
+        self._global_turn = asyncio.Lock()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def _acquire(self, chat_id: Any, background: bool) -> None:
+        started = time.perf_counter()
+        if background:
+            await self._background.acquire()
+        async with self._global_turn:
+            await self._global.acquire()
+        if chat_id is not None:
+            await self._chats.bucket(chat_id).acquire()
+        metrics.registry.observe(OUTBOUND_WAIT_SECONDS,
+                                 time.perf_counter() - started,
+                                 background=str(background).lower())
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, bool | Dict[str, Any] | List[Dict[str, Any]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Dict[str, Any] | None,
+    ) -> bool | Dict[str, Any] | List[Dict[str, Any]]:
+        chat_id = data.get("chat_id")
+        background = rate_limit_args is not None and rate_limit_args.get("background", False)
+        for attempt in range(1, self.max_attempts + 1):
+            await self._acquire(chat_id, background)
+            try:
+                return await callback(*args, **kwargs)
+            except error.RetryAfter as e:
+                if attempt == self.max_attempts:
+                    raise
+                metrics.registry.increment(OUTBOUND_RETRIES, method=endpoint,
+                                           reason="retry_after")
+                retry_after = retry_after_seconds(e)
+                logger.warning(f"flood control on {endpoint} to {chat_id}, "
+                               f"retrying in {retry_after}s")
+                if chat_id is None:
+                    self._global.block(retry_after)
+                else:
+                    self._chats.bucket(chat_id).block(retry_after)
+            except error.NetworkError as e:
+                if not never_sent(e) or attempt == self.max_attempts:
+                    raise
+                metrics.registry.increment(OUTBOUND_RETRIES, method=endpoint,
+                                           reason=type(e).__name__)
+                delay = self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                logger.warning(f"{type(e).__name__} on {endpoint} to {chat_id}, "
+                               f"retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+        raise AssertionError("unreachable")
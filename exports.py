@@ -0,0 +1,100 @@
+import csv
+import gzip
+import sqlite3
+import tempfile
+
+from dataclasses import dataclass
+from typing import BinaryIO, Iterable, List, Sequence, Tuple
+
+from metrics import timed_query
+from store import read_transaction
+
+@dataclass
+class Export:
+    name: str
+    header: List[str]
+    sql: str
+
+# Times are UTC. Calls of removed captains keep their user_id and have no
+# username.
+EXPORTS = [
+    Export(
+        "calls",
+        ["call_time_utc", "user_id", "username", "phone", "password", "update_id"],
+        """
+        SELECT strftime('%Y-%m-%d %H:%M:%S', call_timestamp, 'unixepoch'),
+               user_id, username, phone, password, update_id
+        FROM call_log
+        JOIN call_keys USING (key_id)
+        LEFT JOIN users USING (user_id)
+        ORDER BY call_timestamp, call_log.rowid
+        """,
+    ),
+    # The same order as /leaderboard.
+    Export(
+        "leaderboard",
+        ["user_id", "username", "role", "calls"],
+        """
+        SELECT user_id, username, role, calls
+        FROM (
+            SELECT user_id, COUNT(*) AS calls
+            FROM call_log
+            GROUP BY user_id
+        )
+        LEFT JOIN users USING (user_id)
+        ORDER BY role IS NULL, role DESC, calls ASC
+        """,
+    ),
+    Export(
+        "progress",
+        ["user_id", "username", "phone", "password", "alias", "first_call_utc"],
+        """
+        SELECT user_id, username, phone, password, alias,
+               strftime('%Y-%m-%d %H:%M:%S', first_call, 'unixepoch')
+        FROM (
+            SELECT user_id, key_id, MIN(call_timestamp) AS first_call
+            FROM call_log
+            GROUP BY user_id, key_id
+        )
+        JOIN call_keys USING (key_id)
+        LEFT JOIN users USING (user_id)
+        LEFT JOIN phone_aliases USING (phone)
+        ORDER BY user_id, first_call
+        """,
+    ),
+]
+
+# Writes `rows` as they come, so neither the rows nor the CSV are ever held
+# in memory as a whole.
+def write_csv_gz(output: BinaryIO,
+                 header: List[str],
+                 rows: Iterable[Sequence[object]]) -> int:
+    written = 0
+    # The gzip command line default; level 9 takes twice as long for 5% less.
+    with gzip.open(output, "wt", compresslevel = 6,
+                   encoding = "utf-8", newline = "") as text:
+        writer = csv.writer(text)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+            written += 1
+    return written
+
+# Every export is read in one read transaction on a read pool connection
+# and spooled to a temporary file, so this never runs on the event loop and
+# never touches the writer. The caller closes the files.
+@timed_query
+def export_snapshot(connection: sqlite3.Connection) -> List[Tuple[str, BinaryIO]]:
+    files: List[Tuple[str, BinaryIO]] = []
+    try:
+        with read_transaction(connection):
+            for export in EXPORTS:
+                output = tempfile.TemporaryFile()
+                files.append((f"{export.name}.csv.gz", output))
+                write_csv_gz(output, export.header, connection.execute(export.sql))
+                output.seek(0)
+    except BaseException:
+        for _, output in files:
+            output.close()
+        raise
+    return files
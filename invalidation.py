@@ -0,0 +1,42 @@
+from typing import Any, List
+
+# Caches other worker processes may have to reload after this one changes
+# the tables behind them.
+USERS = 0
+PHONEBOOK = 1
+PAUSE = 2
+CALLS = 3
+THROTTLE = 4
+CACHES = 5
+
+# One counter per cache in shared memory, bumped after every committed
+# change. Set by the worker pool; when the bot runs as a single process it
+# stays None and both bump and stale cost nothing.
+versions: Any = None
+seen: List[int] = [0] * CACHES
+
+def attach(shared_versions: Any) -> None:
+    global versions, seen
+    versions = shared_versions
+    seen = list(shared_versions)
+
+# Whether other worker processes share the database.
+def shared() -> bool:
+    return versions is not None
+
+def bump(cache: int) -> None:
+    if versions is None:
+        return
+    with versions.get_lock():
+        versions[cache] += 1
+
+# True once per change made since the last call, including this process's own
+# changes, so a change by another process in between is never missed.
+def stale(cache: int) -> bool:
+    if versions is None:
+        return False
+    current = versions[cache]
+    if current == seen[cache]:
+        return False
+    seen[cache] = current
+    return True
@@ -0,0 +1,221 @@
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Tuple, TypeVar
+
+from telegram.request import BaseRequest, RequestData
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+Labels = Tuple[Tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HANDLER_SECONDS = "quest_handler_seconds"
+HANDLER_ERRORS = "quest_handler_errors_total"
+QUERY_SECONDS = "quest_query_seconds"
+BOT_API_SECONDS = "quest_bot_api_seconds"
+BOT_API_ERRORS = "quest_bot_api_errors_total"
+DUPLICATE_UPDATES = "quest_duplicate_updates_total"
+
+@dataclass
+class Histogram:
+    buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    bucket_counts: List[int] = field(default_factory = lambda: [0] * (len(DEFAULT_BUCKETS) + 1))
+    count: int = 0
+    sum: float = 0.0
+    max: float = 0.0
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    # Upper bound of the bucket holding the q-quantile, capped by the largest
+    # observation.
+    def quantile(self, q: float) -> float:
+        rank = q * self.count
+        seen = 0
+        for upper, bucket_count in zip(self.buckets, self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(upper, self.max)
+        return self.max
+
+class Registry:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.counters: Dict[str, Dict[Labels, int]] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.histograms.setdefault(name, {}).setdefault(key, Histogram()).observe(value)
+
+    def increment(self, name: str, amount: int = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counter = self.counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + amount
+
+    def gauge(self, name: str, read: Callable[[], float]) -> None:
+        self.gauges[name] = read
+
+    def histogram_snapshot(self, name: str) -> Dict[Labels, Histogram]:
+        with self._lock:
+            return {
+                labels: Histogram(histogram.buckets,
+                                  list(histogram.bucket_counts),
+                                  histogram.count,
+                                  histogram.sum,
+                                  histogram.max)
+                for labels, histogram in self.histograms.get(name, {}).items()
+            }
+
+    def counter_snapshot(self, name: str) -> Dict[Labels, int]:
+        with self._lock:
+            return dict(self.counters.get(name, {}))
+
+    def prometheus_text(self) -> str:
+        lines = []
+        with self._lock:
+            for name, histograms in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in sorted(histograms.items()):
+                    cumulative = 0
+                    for upper, bucket_count in zip(histogram.buckets + (float("inf"),),
+                                                   histogram.bucket_counts):
+                        cumulative += bucket_count
+                        le = "+Inf" if upper == float("inf") else repr(upper)
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} "
+                                     f"{cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+            for name, counters in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in sorted(counters.items()):
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        f'{key}="{escape_label_value(value)}"' for key, value in labels
+    ) + "}"
+
+registry = Registry()
+
+def timed_handler(command: str,
+                  callback: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+    @functools.wraps(callback)
+    async def wrapper(*args: Any, **kwargs: Any) -> T:
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception:
+            registry.increment(HANDLER_ERRORS, command=command)
+            raise
+        finally:
+            registry.observe(HANDLER_SECONDS, time.perf_counter() - started,
+                             command=command)
+    return wrapper
+
+def timed_query(function: Callable[..., T]) -> Callable[..., T]:
+    query = f"{function.__module__}.{function.__name__}"
+    if asyncio.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                registry.observe(QUERY_SECONDS, time.perf_counter() - started,
+                                 query=query)
+        return async_wrapper  # type: ignore[return-value]
+    @functools.wraps(function)
+    def wrapper(*args: Any, **kwargs: Any) -> T:
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            registry.observe(QUERY_SECONDS, time.perf_counter() - started,
+                             query=query)
+    return wrapper
+
+# Wraps the real request layer, so every Bot API call is timed and every
+# non-2xx response or transport failure is counted per method.
+class InstrumentedRequest(BaseRequest):
+    def __init__(self, request: BaseRequest) -> None:
+        self.request = request
+
+    @property
+    def read_timeout(self) -> float | None:
+        return self.request.read_timeout
+
+    async def initialize(self) -> None:
+        await self.request.initialize()
+
+    async def shutdown(self) -> None:
+        await self.request.shutdown()
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: RequestData | None = None,
+        read_timeout: Any = BaseRequest.DEFAULT_NONE,
+        write_timeout: Any = BaseRequest.DEFAULT_NONE,
+        connect_timeout: Any = BaseRequest.DEFAULT_NONE,
+        pool_timeout: Any = BaseRequest.DEFAULT_NONE,
+    ) -> Tuple[int, bytes]:
+        # File downloads end in the file's path rather than a method name.
+        api_method = "download" if "/file/bot" in url else url.rsplit("/", maxsplit=1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await self.request.do_request(
+                url, method, request_data,
+                read_timeout, write_timeout, connect_timeout, pool_timeout
+            )
+        except Exception as e:
+            registry.increment(BOT_API_ERRORS, method=api_method,
+                               code=type(e).__name__)
+            raise
+        finally:
+            registry.observe(BOT_API_SECONDS, time.perf_counter() - started,
+                             method=api_method)
+        if not 200 <= code <= 299:
+            registry.increment(BOT_API_ERRORS, method=api_method, code=str(code))
+        return code, payload
+
+def write_prometheus_file(path: str) -> None:
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as metrics_file:
+        metrics_file.write(registry.prometheus_text())
+    os.replace(temporary_path, path)
+
+async def write_prometheus_file_periodically(path: str, interval: float) -> None:
+    while True:
+        try:
+            await asyncio.to_thread(write_prometheus_file, path)
+        except OSError:
+            logger.exception(f"failed to write metrics to {path}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,5 @@
+ALTER TABLE broadcasts
+ADD COLUMN owner TEXT NULL;
+
+ALTER TABLE broadcasts
+ADD COLUMN lease_until INTEGER NULL;
@@ -0,0 +1,2 @@
+ALTER TABLE call_log
+ADD COLUMN update_id INTEGER NULL;
@@ -0,0 +1,41 @@
+BEGIN;
+
+ALTER TABLE call_log
+RENAME TO call_log_old;
+
+-- Indexes keep their names when the table is renamed.
+DROP INDEX IF EXISTS call_log_update_lookup;
+DROP INDEX IF EXISTS call_log_user_lookup;
+DROP INDEX IF EXISTS call_log_timestamp_lookup;
+
+CREATE TABLE IF NOT EXISTS call_keys (
+  key_id INTEGER PRIMARY KEY,
+  phone TEXT NOT NULL,
+  password TEXT NULL
+) STRICT;
+
+CREATE TABLE IF NOT EXISTS call_log (
+  user_id INTEGER NOT NULL,
+  call_timestamp INTEGER NOT NULL,
+  key_id INTEGER NOT NULL REFERENCES call_keys (key_id),
+  update_id INTEGER NULL
+) STRICT;
+
+INSERT INTO call_keys (phone, password)
+SELECT DISTINCT phone, password
+FROM call_log_old;
+
+-- Timestamps were stored as isoformat(" ") with a UTC offset.
+INSERT INTO call_log
+SELECT user_id,
+       CAST(strftime('%s', call_timestamp) AS INTEGER),
+       key_id,
+       update_id
+FROM call_log_old
+JOIN call_keys USING (phone)
+WHERE call_keys.password IS call_log_old.password
+ORDER BY call_log_old.rowid;
+
+DROP TABLE call_log_old;
+
+COMMIT;
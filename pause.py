@@ -1,44 +1,45 @@
-import os
-import sqlite3
-
 from sqlite3 import Cursor
 
-pause_connection = sqlite3.connect(os.getenv("QUEST_DB_PATH", "quest.db"))
+import invalidation
+from metrics import timed_query
+from store import quest_store
 
-with open('pause.sql') as pause_file:
-    pause_connection.executescript(pause_file.read())
-    cursor = pause_connection.cursor()
+def insert_default_pause(cursor: Cursor) -> None:
     existing_pause = cursor.execute("""
         SELECT pause
         FROM pause
     """).fetchone()
     if existing_pause is None:
-        with pause_connection:
-            cursor.execute("INSERT INTO pause VALUES (0)")
+        cursor.execute("INSERT INTO pause VALUES (0)")
 
 pause: bool = False
 
+@timed_query
 def read_pause() -> None:
     global pause
-    cursor = pause_connection.cursor()
-    pause = cursor.execute("""
+    pause = quest_store.read_one("""
         SELECT pause
         FROM pause
-    """).fetchone()[0] == 1
+    """)[0] == 1
 
-def modify_pause(new_pause: bool) -> None:
-    with pause_connection:
-        cursor = pause_connection.cursor()
-        cursor.execute(
+@timed_query
+async def modify_pause(new_pause: bool) -> None:
+    global pause
+    await quest_store.write_async(lambda cursor: cursor.execute(
             "UPDATE pause SET pause = ?",
             (1 if new_pause else 0,)
-        )
-    read_pause()
+    ))
+    invalidation.bump(invalidation.PAUSE)
+    # Only reached after the transaction has committed.
+    pause = new_pause
 
-def pause_calls() -> None:
-    modify_pause(True)
+async def pause_calls() -> None:
+    await modify_pause(True)
 
-def resume_calls() -> None:
-    modify_pause(False)
+async def resume_calls() -> None:
+    await modify_pause(False)
 
-read_pause()
+def setup() -> None:
+    quest_store.run_script("pause.sql")
+    quest_store.write(insert_default_pause)
+    read_pause()
@@ -1,15 +1,15 @@
-import os
-import sqlite3
+import csv
+import io
+import json
 
 from sqlite3 import Cursor
 from dataclasses import dataclass, field
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, List, TextIO, Tuple
 from enum import Enum
 
-phonebook_connection = sqlite3.connect(os.getenv("QUEST_DB_PATH", "quest.db"))
-
-with open('phonebook.sql') as phonebook_file:
-    phonebook_connection.executescript(phonebook_file.read())
+import invalidation
+from metrics import timed_query
+from store import quest_store
 
 class ReplyType(Enum):
     TEXT = "text"
@@ -33,30 +33,31 @@ class Phonebook:
 
 phonebook = Phonebook()
 
+# Full reloads build a new Phonebook and swap it in with a single assignment,
+# so handlers never observe a half-filled cache.
+@timed_query
 def read_phonebook() -> None:
     global phonebook
-    phonebook = Phonebook()
-    cursor = phonebook_connection.cursor()
-    cursor.execute("""
+    new_phonebook = Phonebook()
+    rows = quest_store.read("""
         SELECT phone, password, reply_type, reply_data
         FROM phonebook
         ORDER BY phone, password, reply_n ASC
     """)
-    for phone, password, reply_type, reply_data in cursor.fetchall():
-        if (phone, password) not in phonebook.replies:
-            phonebook.replies[(phone, password)] = Reply()
-        phonebook.replies[(phone, password)].parts.append(
+    for phone, password, reply_type, reply_data in rows:
+        if (phone, password) not in new_phonebook.replies:
+            new_phonebook.replies[(phone, password)] = Reply()
+        new_phonebook.replies[(phone, password)].parts.append(
                 ReplyPart(ReplyType(reply_type), reply_data)
         )
+    phonebook = new_phonebook
 
-read_phonebook()
-
-def add_number(phone: str, password: str | None, reply: Reply) -> None:
+@timed_query
+async def add_number(phone: str, password: str | None, reply: Reply) -> None:
     values = [(phone, password, reply_n,
                reply_part.reply_type.value, reply_part.reply_data)
               for reply_n, reply_part in enumerate(reply.parts)]
-    with phonebook_connection:
-        cursor = phonebook_connection.cursor()
+    def write(cursor: Cursor) -> None:
         execute_delete(cursor, phone, password)
         cursor.executemany("""
             INSERT INTO phonebook
@@ -64,7 +65,13 @@ def add_number(phone: str, password: str | None, reply: Reply) -> None:
             VALUES (?, ?, ?, ?, ?)""",
             values
         )
-    read_phonebook()
+    await quest_store.write_async(write)
+    invalidation.bump(invalidation.PHONEBOOK)
+    # Only reached after the transaction has committed.
+    if reply.parts:
+        phonebook.replies[(phone, password)] = Reply(list(reply.parts))
+    else:
+        phonebook.replies.pop((phone, password), None)
 
 def execute_delete(cursor: Cursor, phone: str, password: str | None) -> None:
     if password is None:
@@ -80,34 +87,222 @@ def execute_delete(cursor: Cursor, phone: str, password: str | None) -> None:
 
 phone_aliases: Dict[str, str] = {}
 
+@timed_query
 def read_phone_aliases() -> None:
     global phone_aliases
-    phone_aliases = {}
-    cursor = phonebook_connection.cursor()
-    cursor.execute("""
+    phone_aliases = dict(quest_store.read("""
         SELECT phone, alias
         FROM phone_aliases
-    """)
-    for phone, alias in cursor.fetchall():
-        phone_aliases[phone] = alias
+    """))
 
-read_phone_aliases()
-
-def add_phone_alias(phone: str, alias: str) -> None:
-    with phonebook_connection:
-        cursor = phonebook_connection.cursor()
-        cursor.execute("""
+@timed_query
+async def add_phone_alias(phone: str, alias: str) -> None:
+    await quest_store.write_async(lambda cursor: cursor.execute("""
             INSERT INTO phone_aliases
             VALUES (?, ?)""",
             (phone, alias)
-        )
-    read_phone_aliases()
+    ))
+    invalidation.bump(invalidation.PHONEBOOK)
+    phone_aliases[phone] = alias
 
-def remove_phone_alias(phone: str) -> None:
-    with phonebook_connection:
-        cursor = phonebook_connection.cursor()
-        cursor.execute(
+@timed_query
+async def remove_phone_alias(phone: str) -> None:
+    await quest_store.write_async(lambda cursor: cursor.execute(
             "DELETE FROM phone_aliases WHERE phone = ?",
             (phone,)
+    ))
+    invalidation.bump(invalidation.PHONEBOOK)
+    phone_aliases.pop(phone, None)
+
+# Bulk import and export. A phonebook file holds every number and alias of a
+# quest, either as JSON Lines:
+#
+#   {"phone": "5551234", "password": "answer", "reply": [{"type": "text", "data": "..."}]}
+#   {"phone": "5551234", "alias": "Police"}
+#
+# or as CSV with one row per reply part, in order, and `alias` in the type
+# column for aliases:
+#
+#   phone,password,type,data
+#   5551234,answer,text,...
+#   5551234,,alias,Police
+#
+# An empty CSV password means no password.
+FILE_FORMATS = ("jsonl", "csv")
+CSV_HEADER = ["phone", "password", "type", "data"]
+
+class PhonebookFileError(ValueError):
+    pass
+
+@dataclass
+class PhonebookFile:
+    replies: Dict[Tuple[str, str | None], Reply] = field(default_factory = dict)
+    aliases: Dict[str, str] = field(default_factory = dict)
+
+def file_format(file_name: str) -> str:
+    extension = file_name.rsplit(".", 1)[-1].lower()
+    if extension not in FILE_FORMATS:
+        raise PhonebookFileError(f"unsupported file type {file_name!r}, "
+                                 f"expected .jsonl or .csv")
+    return extension
+
+def reply_part(line: int, reply_type: object, reply_data: object) -> ReplyPart:
+    if not isinstance(reply_data, str) or reply_data == "":
+        raise PhonebookFileError(f"line {line}: reply data is missing")
+    try:
+        return ReplyPart(ReplyType(reply_type), reply_data)
+    except ValueError:
+        raise PhonebookFileError(f"line {line}: unknown reply type {reply_type!r}")
+
+def parse_jsonl(lines: Iterable[str]) -> PhonebookFile:
+    result = PhonebookFile()
+    for line, text in enumerate(lines, start = 1):
+        if text.strip() == "":
+            continue
+        try:
+            record = json.loads(text)
+        except ValueError as e:
+            raise PhonebookFileError(f"line {line}: {e}")
+        if not isinstance(record, dict):
+            raise PhonebookFileError(f"line {line}: expected an object")
+        phone = record.get("phone")
+        if not isinstance(phone, str) or phone == "":
+            raise PhonebookFileError(f"line {line}: phone is missing")
+        if "alias" in record:
+            if not isinstance(record["alias"], str):
+                raise PhonebookFileError(f"line {line}: alias must be a string")
+            result.aliases[phone] = record["alias"]
+            continue
+        password = record.get("password")
+        if password is not None and not isinstance(password, str):
+            raise PhonebookFileError(f"line {line}: password must be a string")
+        parts = record.get("reply")
+        if not isinstance(parts, list) or parts == []:
+            raise PhonebookFileError(f"line {line}: reply is missing")
+        if (phone, password) in result.replies:
+            raise PhonebookFileError(f"line {line}: {phone} ({password}) is repeated")
+        result.replies[(phone, password)] = Reply([
+            reply_part(line, part.get("type"), part.get("data"))
+            if isinstance(part, dict) else reply_part(line, None, None)
+            for part in parts
+        ])
+    return result
+
+def parse_csv(lines: Iterable[str]) -> PhonebookFile:
+    result = PhonebookFile()
+    reader = csv.reader(lines)
+    if next(reader, None) != CSV_HEADER:
+        raise PhonebookFileError(f"line 1: expected the header {','.join(CSV_HEADER)}")
+    for row in reader:
+        line = reader.line_num
+        if row == []:
+            continue
+        if len(row) != len(CSV_HEADER):
+            raise PhonebookFileError(f"line {line}: expected {len(CSV_HEADER)} columns")
+        phone, password, reply_type, reply_data = row
+        if phone == "":
+            raise PhonebookFileError(f"line {line}: phone is missing")
+        if reply_type == "alias":
+            result.aliases[phone] = reply_data
+            continue
+        key = (phone, password or None)
+        result.replies.setdefault(key, Reply()).parts.append(
+                reply_part(line, reply_type, reply_data)
         )
+    return result
+
+# Text replies may hold line breaks: quoted ones inside a CSV field, and raw
+# ones such as U+2028 that json.dumps leaves in a JSONL line, so neither file
+# is split with str.splitlines.
+def parse_phonebook_file(text: str, file_format: str) -> PhonebookFile:
+    if file_format == "csv":
+        return parse_csv(io.StringIO(text, newline = ""))
+    return parse_jsonl(text.split("\n"))
+
+# Replaces every number and alias in one transaction. The new caches are
+# built off to the side and swapped in only after the commit, like a full
+# reload.
+@timed_query
+async def replace_phonebook(phonebook_file: PhonebookFile) -> None:
+    global phonebook, phone_aliases
+    new_phonebook = Phonebook({
+        key: Reply(list(reply.parts))
+        for key, reply in phonebook_file.replies.items()
+    })
+    new_phone_aliases = dict(phonebook_file.aliases)
+    def write(cursor: Cursor) -> None:
+        cursor.execute("DELETE FROM phonebook")
+        cursor.executemany("""
+            INSERT INTO phonebook
+            (phone, password, reply_n, reply_type, reply_data)
+            VALUES (?, ?, ?, ?, ?)""",
+            ((phone, password, reply_n,
+              reply_part.reply_type.value, reply_part.reply_data)
+             for (phone, password), reply in new_phonebook.replies.items()
+             for reply_n, reply_part in enumerate(reply.parts))
+        )
+        cursor.execute("DELETE FROM phone_aliases")
+        cursor.executemany("""
+            INSERT INTO phone_aliases
+            VALUES (?, ?)""",
+            new_phone_aliases.items()
+        )
+    await quest_store.write_async(write)
+    invalidation.bump(invalidation.PHONEBOOK)
+    phonebook = new_phonebook
+    phone_aliases = new_phone_aliases
+
+# Streams the tables into `output` row by row and returns the number of
+# lines written.
+@timed_query
+def export_phonebook(output: TextIO, file_format: str) -> int:
+    # Both statements are open at once, so they read the same snapshot.
+    reader = quest_store.reader()
+    numbers = reader.execute("""
+        SELECT phone, password, reply_type, reply_data
+        FROM phonebook
+        ORDER BY phone, password, reply_n ASC
+    """)
+    aliases = reader.execute("""
+        SELECT phone, alias
+        FROM phone_aliases
+        ORDER BY phone
+    """)
+    written = 0
+    if file_format == "csv":
+        writer = csv.writer(output, lineterminator = "\n")
+        writer.writerow(CSV_HEADER)
+        for phone, password, reply_type, reply_data in numbers:
+            writer.writerow([phone, password or "", reply_type, reply_data])
+            written += 1
+        for phone, alias in aliases:
+            writer.writerow([phone, "", "alias", alias])
+            written += 1
+        return written
+    key: Tuple[str, str | None] | None = None
+    parts: List[Dict[str, str]] = []
+    def write_number() -> None:
+        assert key is not None
+        record = {"phone": key[0], "password": key[1], "reply": parts}
+        output.write(json.dumps(record, ensure_ascii = False) + "\n")
+    for phone, password, reply_type, reply_data in numbers:
+        if (phone, password) != key:
+            if key is not None:
+                write_number()
+                written += 1
+            key = (phone, password)
+            parts = []
+        parts.append({"type": reply_type, "data": reply_data})
+    if key is not None:
+        write_number()
+        written += 1
+    for phone, alias in aliases:
+        output.write(json.dumps({"phone": phone, "alias": alias},
+                                ensure_ascii = False) + "\n")
+        written += 1
+    return written
+
+def setup() -> None:
+    quest_store.run_script("phonebook.sql")
+    read_phonebook()
     read_phone_aliases()
@@ -0,0 +1,101 @@
+import asyncio
+import cProfile
+import logging
+import os
+import pstats
+import tempfile
+import tracemalloc
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Coroutine, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAX_SECONDS = 120.0
+TOP_FUNCTIONS = 15
+TOP_ALLOCATIONS = 10
+
+@dataclass
+class ProfileReport:
+    hotspots: List[str]
+    allocations: List[str]
+    # pstats dump, for `python -m pstats` or snakeviz.
+    profile: bytes
+
+# Only one profile runs at a time. Nothing is installed while none is
+# running, so profiling costs nothing when it is off.
+active: asyncio.Task | None = None
+
+def is_running() -> bool:
+    return active is not None and not active.done()
+
+def start(coroutine: Coroutine) -> asyncio.Task:
+    global active
+    assert not is_running(), "profiling is already running"
+    active = asyncio.create_task(coroutine, name = "profile")
+    active.add_done_callback(finish)
+    return active
+
+def finish(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        e = task.exception()
+        logger.error("profiling failed", exc_info=(type(e), e, e.__traceback__))
+
+def cancel() -> None:
+    if active is not None:
+        active.cancel()
+
+# Profiles the event loop thread, which runs the handlers and their sqlite3
+# calls, for `seconds`. The call journal and read pool threads are not
+# covered. With `memory`, tracemalloc also records where memory grew.
+async def profile_for(seconds: float, memory: bool) -> ProfileReport:
+    profiler = cProfile.Profile()
+    before = None
+    if memory:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+        after = None
+        if before is not None:
+            after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+    allocations = []
+    if before is not None and after is not None:
+        allocations = await asyncio.to_thread(format_allocations, before, after)
+    hotspots, profile = await asyncio.to_thread(format_profile, profiler)
+    return ProfileReport(hotspots, allocations, profile)
+
+def short_location(file_name: str, line: int, function: str) -> str:
+    if file_name == "~":
+        return function
+    return f"{Path(file_name).name}:{line}({function})"
+
+def format_profile(profiler: cProfile.Profile) -> Tuple[List[str], bytes]:
+    stats = pstats.Stats(profiler)
+    rows = sorted(stats.stats.items(), key = lambda item: item[1][3], reverse = True)  # type: ignore[attr-defined]
+    hotspots = [
+        f"{cumulative * 1000:8.1f} {total * 1000:8.1f} {calls:7} "
+        f"{short_location(*location)}"
+        for location, (_, calls, total, cumulative, _) in rows[:TOP_FUNCTIONS]
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "quest.prof")
+        stats.dump_stats(path)
+        profile = Path(path).read_bytes()
+    return hotspots, profile
+
+def format_allocations(before: tracemalloc.Snapshot,
+                       after: tracemalloc.Snapshot) -> List[str]:
+    differences = after.compare_to(before, "lineno")
+    return [
+        f"{difference.size_diff / 1024:+8.1f} KiB "
+        f"{short_location(frame.filename, frame.lineno, '')}"
+        for difference in differences[:TOP_ALLOCATIONS]
+        for frame in [difference.traceback[0]]
+        if difference.size_diff != 0
+    ]
@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+from typing import Dict, Hashable
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self) -> float:
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def try_acquire(self) -> bool:
+        if self.delay() > 0:
+            return False
+        self._tokens -= 1
+        return True
+
+    async def acquire(self) -> None:
+        while not self.try_acquire():
+            await asyncio.sleep(self.delay())
+
+    def block(self, seconds: float) -> None:
+        self._blocked_until = max(self._blocked_until,
+                                  time.monotonic() + seconds)
+
+    def configure(self, rate: float, burst: float) -> None:
+        self._refill(time.monotonic())
+        self.rate = rate
+        self.burst = burst
+        self._tokens = min(self._tokens, burst)
+
+    def is_full(self) -> bool:
+        self._refill(time.monotonic())
+        return self._tokens >= self.burst
+
+class KeyedTokenBuckets:
+    max_idle_buckets = 10_000
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._buckets: Dict[Hashable, TokenBucket] = {}
+
+    def bucket(self, key: Hashable) -> TokenBucket:
+        if key not in self._buckets:
+            if len(self._buckets) >= self.max_idle_buckets:
+                self._buckets = {
+                    key: bucket for key, bucket in self._buckets.items()
+                    if not bucket.is_full()
+                }
+            self._buckets[key] = TokenBucket(self.rate, self.burst)
+        return self._buckets[key]
+
+    def configure(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        for bucket in self._buckets.values():
+            bucket.configure(rate, burst)
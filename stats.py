@@ -1,59 +1,564 @@
+import asyncio
+import logging
 import os
+import queue
 import sqlite3
+import threading
+import time
 
 from sqlite3 import Cursor
-from datetime import datetime
-from typing import List, Tuple
+from contextlib import AbstractContextManager, nullcontext
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Set, Tuple
 
-stats_connection = sqlite3.connect(os.getenv("QUEST_DB_PATH", "quest.db"))
+import invalidation
+import users
+import metrics
+from metrics import timed_query
+from store import quest_store, read_transaction
 
-with open('stats.sql') as stats_file:
-    stats_connection.executescript(stats_file.read())
+logger = logging.getLogger(__name__)
 
-def log_call(user_id: int,
-             call_timestamp: datetime,
-             phone: str,
-             password: str | None) -> None:
-    with stats_connection:
-        cursor = stats_connection.cursor()
+@dataclass
+class CallRecord:
+    user_id: int
+    call_timestamp: datetime
+    phone: str
+    password: str | None
+    update_id: int | None = None
+
+    def key(self) -> Tuple[str, str | None]:
+        return (self.phone, self.password)
+
+    def row(self, key_id: int) -> Tuple[int, int, int, int | None]:
+        return (self.user_id, int(self.call_timestamp.timestamp()),
+                key_id, self.update_id)
+
+@dataclass
+class JournalStats:
+    queue_depth: int
+    committed_calls: int
+    committed_batches: int
+    dropped_calls: int
+    last_commit_latency: float
+    max_commit_latency: float
+
+# key_id of every (phone, password) in call_keys. Only the thread writing
+# calls adds to it, and only after the keys were committed.
+call_keys: Dict[Tuple[str, str | None], int] = {}
+
+@timed_query
+def read_call_keys() -> None:
+    global call_keys
+    call_keys = {
+        (phone, password): key_id
+        for key_id, phone, password in quest_store.read("""
+            SELECT key_id, phone, password
+            FROM call_keys
+        """)
+    }
+
+def intern_key(cursor: Cursor,
+               key: Tuple[str, str | None],
+               new_keys: Dict[Tuple[str, str | None], int]) -> int:
+    key_id = call_keys.get(key) or new_keys.get(key)
+    if key_id is None:
+        # Another worker process may have added it since call_keys was read.
+        cursor.execute("""
+            INSERT OR IGNORE INTO call_keys (phone, password)
+            VALUES (?, ?)
+        """, key)
+        if cursor.rowcount == 1:
+            assert cursor.lastrowid is not None
+            key_id = cursor.lastrowid
+        else:
+            (key_id,) = cursor.execute("""
+                SELECT key_id
+                FROM call_keys
+                WHERE phone = ? AND password IS ?
+            """, key).fetchone()
+        new_keys[key] = key_id
+    return key_id
+
+# call_log rows this process committed and counted in call_counts, which
+# refresh_call_stats has not read yet. Only kept while other worker processes
+# share the database: without them every row is this process's own.
+own_call_rowids: Set[int] = set()
+
+# Returns the records that were not inserted because their update was
+# already recorded, and adds the rowids of the others to `rowids`.
+def insert_calls(cursor: Cursor,
+                 records: List[CallRecord],
+                 new_keys: Dict[Tuple[str, str | None], int],
+                 rowids: List[int]) -> List[CallRecord]:
+    duplicates = []
+    for record in records:
         cursor.execute("""
-                INSERT INTO call_log
-                (user_id, call_timestamp, phone, password)
+                INSERT OR IGNORE INTO call_log
+                (user_id, call_timestamp, key_id, update_id)
                 VALUES (?, ?, ?, ?)
                 """,
-                (user_id, call_timestamp.isoformat(" "), phone, password)
+                record.row(intern_key(cursor, record.key(), new_keys))
         )
+        if cursor.rowcount == 0:
+            duplicates.append(record)
+        else:
+            assert cursor.lastrowid is not None
+            rowids.append(cursor.lastrowid)
+    return duplicates
 
-def status(user_id: int) -> int:
-    cursor = stats_connection.cursor()
-    cursor.execute("""
-        SELECT COUNT(*)
+# Called with the journal lock or call_counts_lock held, which readers of new
+# calls take while their snapshot starts.
+def write_calls(records: List[CallRecord]) -> List[CallRecord]:
+    new_keys: Dict[Tuple[str, str | None], int] = {}
+    rowids: List[int] = []
+    def write(cursor: Cursor) -> List[CallRecord]:
+        # A retried transaction starts over, and so do its keys.
+        new_keys.clear()
+        rowids.clear()
+        return insert_calls(cursor, records, new_keys, rowids)
+    duplicates = quest_store.write(write)
+    invalidation.bump(invalidation.CALLS)
+    call_keys.update(new_keys)
+    if invalidation.shared():
+        own_call_rowids.update(rowids)
+    return duplicates
+
+class CallJournal:
+    # Calls are appended by the event loop and committed in batches by a
+    # background thread through the store's writer connection. Until a
+    # record is committed it stays in `_pending`, so readers on the event
+    # loop still see it. `lock` is held around the write transaction and
+    # around reads that combine the table with `_pending`, so a record is
+    # never counted twice or missed. `on_drop` takes back records that did not
+    # make it into the table, either dropped or already recorded.
+    max_attempts = 3
+
+    def __init__(self,
+                 max_batch: int = 100,
+                 max_delay: float = 0.05,
+                 on_drop: Callable[[List[CallRecord]], None] = lambda batch: None
+                 ) -> None:
+        self.lock = threading.Lock()
+        self._on_drop = on_drop
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        self._queue: queue.SimpleQueue[CallRecord | None] = queue.SimpleQueue()
+        self._pending: List[CallRecord] = []
+        self._thread: threading.Thread | None = None
+        self._committed_calls = 0
+        self._committed_batches = 0
+        self._dropped_calls = 0
+        self._last_commit_latency = 0.0
+        self._max_commit_latency = 0.0
+
+    def start(self) -> None:
+        assert self._thread is None, "journal is already running"
+        self._thread = threading.Thread(target=self._run,
+                                        name="call-journal",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def append(self, record: CallRecord) -> None:
+        self._pending.append(record)
+        self._queue.put(record)
+
+    def pending(self) -> List[CallRecord]:
+        return list(self._pending)
+
+    def stats(self) -> JournalStats:
+        return JournalStats(len(self._pending),
+                            self._committed_calls,
+                            self._committed_batches,
+                            self._dropped_calls,
+                            self._last_commit_latency,
+                            self._max_commit_latency)
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            record = self._queue.get()
+            if record is None:
+                break
+            batch = [record]
+            deadline = time.monotonic() + self._max_delay
+            while len(batch) < self._max_batch:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout > 0:
+                        record = self._queue.get(timeout=timeout)
+                    else:
+                        record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    stopping = True
+                    break
+                batch.append(record)
+            self._commit(batch)
+
+    def _commit(self, batch: List[CallRecord]) -> None:
+        for attempt in range(1, self.max_attempts + 1):
+            started = time.monotonic()
+            try:
+                with self.lock:
+                    duplicates = write_calls(batch)
+                    del self._pending[:len(batch)]
+                    if duplicates:
+                        self._on_drop(duplicates)
+            except sqlite3.Error:
+                logger.exception(f"failed to commit {len(batch)} calls "
+                                 f"(attempt {attempt})")
+                time.sleep(0.1 * attempt)
+                continue
+            latency = time.monotonic() - started
+            count_duplicates(duplicates)
+            metrics.registry.observe(metrics.QUERY_SECONDS, latency,
+                                     query="stats.journal_commit")
+            self._committed_calls += len(batch)
+            self._committed_batches += 1
+            self._last_commit_latency = latency
+            self._max_commit_latency = max(self._max_commit_latency, latency)
+            return
+        # Same policy as a failed synchronous insert: the reply was already
+        # delivered, so the calls are not deducted.
+        with self.lock:
+            del self._pending[:len(batch)]
+            self._on_drop(batch)
+        self._dropped_calls += len(batch)
+        logger.error(f"dropped {len(batch)} calls after "
+                     f"{self.max_attempts} attempts")
+
+journal: CallJournal | None = None
+
+# Number of calls per user, including calls still pending in the journal, so
+# /status never has to touch SQLite. The journal thread only touches it to
+# take back calls it had to drop.
+call_counts: Dict[int, int] = {}
+call_counts_lock = threading.Lock()
+
+# Only counts the rows read_first_calls saw, and so runs after it; later rows
+# are counted by refresh_call_stats.
+@timed_query
+def read_call_counts() -> None:
+    global call_counts
+    with journal_lock():
+        new_call_counts = dict(quest_store.read("""
+            SELECT user_id, COUNT(*)
+            FROM call_log
+            WHERE rowid <= ?
+            GROUP BY user_id
+        """, (last_call_rowid,)))
+        for record in pending_calls():
+            new_call_counts[record.user_id] = new_call_counts.get(record.user_id, 0) + 1
+        call_counts = new_call_counts
+
+# First call per (phone, password) for every user, in the order the numbers
+# were first reached, so /progress needs neither SQL nor timestamp parsing.
+# Calls the journal drops stay here: their reply was delivered, so the team
+# did reach the number.
+first_calls: Dict[int, Dict[Tuple[str, str | None], datetime]] = {}
+# The last call_log row first_calls was built from or merged with. Rows are
+# only ever appended, so later ones have larger rowids.
+last_call_rowid = 0
+
+@timed_query
+def read_first_calls() -> None:
+    global first_calls, last_call_rowid
+    new_first_calls: Dict[int, Dict[Tuple[str, str | None], datetime]] = {}
+    with journal_lock(), read_transaction(quest_store.reader()):
+        rows = quest_store.read("""
+            SELECT user_id, phone, password, first_call
+            FROM (
+                SELECT user_id, key_id, MIN(call_timestamp) AS first_call
+                FROM call_log
+                GROUP BY user_id, key_id
+            )
+            JOIN call_keys USING (key_id)
+            ORDER BY first_call ASC
+        """)
+        for user_id, phone, password, first_call in rows:
+            new_first_calls.setdefault(user_id, {})[(phone, password)] = \
+                    datetime.fromtimestamp(first_call, timezone.utc)
+        (max_rowid,) = quest_store.read_one("SELECT IFNULL(MAX(rowid), 0) FROM call_log")
+        pending = pending_calls()
+    first_calls = new_first_calls
+    last_call_rowid = max_rowid
+    for record in pending:
+        note_first_call(record)
+
+def note_first_call(record: CallRecord) -> None:
+    user_first_calls = first_calls.setdefault(record.user_id, {})
+    key = (record.phone, record.password)
+    if key in user_first_calls and user_first_calls[key] <= record.call_timestamp:
+        return
+    out_of_order = (key in user_first_calls or
+                    (user_first_calls and
+                     record.call_timestamp < next(reversed(user_first_calls.values()))))
+    user_first_calls[key] = record.call_timestamp
+    if out_of_order:
+        first_calls[record.user_id] = dict(sorted(user_first_calls.items(),
+                                                  key = lambda item: item[1]))
+
+def count_duplicates(duplicates: List[CallRecord]) -> None:
+    if duplicates:
+        metrics.registry.increment(metrics.DUPLICATE_UPDATES, len(duplicates),
+                                   stage="call_log")
+        logger.warning(f"ignored {len(duplicates)} calls from updates that "
+                       f"were already recorded")
+
+def count_calls(records: List[CallRecord], delta: int) -> None:
+    with call_counts_lock:
+        for record in records:
+            call_counts[record.user_id] = call_counts.get(record.user_id, 0) + delta
+
+def start_journal() -> None:
+    global journal
+    journal = CallJournal(int(os.getenv("CALL_JOURNAL_MAX_BATCH", "100")),
+                          float(os.getenv("CALL_JOURNAL_MAX_DELAY", "0.05")),
+                          lambda batch: count_calls(batch, -1))
+    journal.start()
+
+def stop_journal() -> None:
+    global journal
+    if journal is not None:
+        journal.stop()
+        journal = None
+
+# Returns whether the call was recorded, i.e. was not a duplicate.
+def record_call(record: CallRecord) -> bool:
+    # Recording and counting happen together, so count_calls_in_snapshot
+    # never sees one without the other.
+    with call_counts_lock:
+        if journal is not None:
+            journal.append(record)
+        else:
+            duplicates = write_calls([record])
+            count_duplicates(duplicates)
+            if duplicates:
+                return False
+        call_counts[record.user_id] = call_counts.get(record.user_id, 0) + 1
+    return True
+
+@timed_query
+async def log_call(user_id: int,
+                   call_timestamp: datetime,
+                   phone: str,
+                   password: str | None,
+                   update_id: int | None = None) -> None:
+    record = CallRecord(user_id, call_timestamp, phone, password, update_id)
+    if journal is not None:
+        recorded = record_call(record)
+    else:
+        # Without the journal the call is committed right here, so it is
+        # done in a thread, which also holds call_counts_lock meanwhile.
+        recorded = await asyncio.to_thread(record_call, record)
+    if recorded:
+        note_first_call(record)
+
+# The latest update IDs with a recorded call, oldest first.
+@timed_query
+def recent_update_ids(limit: int) -> List[int]:
+    rows = quest_store.read("""
+        SELECT update_id
         FROM call_log
-        WHERE user_id = ?
-    """, (user_id,))
-    call_n, = cursor.fetchone()
-    return call_n
-
-def stats() -> List[Tuple[int, str | int, str]]:
-    cursor = stats_connection.cursor()
-    cursor.execute("""
-        SELECT COUNT(*) as call_n, IFNULL(users.username, users.user_id), role
-        FROM call_log LEFT JOIN users ON call_log.user_id = users.user_id
-        GROUP BY users.user_id, username, role
-        ORDER BY role DESC, call_n ASC
-    """)
-    return cursor.fetchall()
+        WHERE update_id IS NOT NULL
+        ORDER BY update_id DESC
+        LIMIT ?
+    """, (limit,))
+    return [update_id for update_id, in reversed(rows)]
+
+def pending_calls() -> List[CallRecord]:
+    return journal.pending() if journal is not None else []
+
+def journal_stats() -> JournalStats | None:
+    return journal.stats() if journal is not None else None
+
+def journal_lock() -> AbstractContextManager:
+    return journal.lock if journal is not None else nullcontext()
+
+def status(user_id: int) -> int:
+    return call_counts.get(user_id, 0)
+
+# Rows appended to call_log after `after_rowid`, by this process or another.
+def select_new_calls(connection: sqlite3.Connection,
+                     after_rowid: int) -> List[Tuple[int, int, str, str | None, int]]:
+    return connection.execute("""
+        SELECT call_log.rowid, user_id, phone, password, call_timestamp
+        FROM call_log JOIN call_keys USING (key_id)
+        WHERE call_log.rowid > ?
+        ORDER BY call_log.rowid
+    """, (after_rowid,)).fetchall()
+
+# Scans call_log on a read pool connection. The locks are held only while
+# the read transaction starts and the counters and pending calls are copied,
+# so neither /call nor the journal waits for the scan. Also returns the rows
+# added since `after_rowid`, which the counters may not include yet.
+@timed_query
+def count_calls_in_snapshot(connection: sqlite3.Connection,
+                            after_rowid: int
+                            ) -> Tuple[Dict[int, int],
+                                       Dict[int, int],
+                                       List[Tuple[int, int, str, str | None, int]]]:
+    with read_transaction(connection):
+        with journal_lock(), call_counts_lock:
+            connection.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+            pending = pending_calls()
+            counter_snapshot = dict(call_counts)
+        table_counts: Dict[int, int] = dict(connection.execute("""
+            SELECT user_id, COUNT(*)
+            FROM call_log
+            GROUP BY user_id
+        """).fetchall())
+        new_calls = select_new_calls(connection, after_rowid)
+    for record in pending:
+        table_counts[record.user_id] = table_counts.get(record.user_id, 0) + 1
+    return counter_snapshot, table_counts, new_calls
+
+def find_mismatches(counter_snapshot: Dict[int, int],
+                    table_counts: Dict[int, int]) -> List[Tuple[int, int, int]]:
+    return [
+        (user_id, counter_snapshot.get(user_id, 0), table_counts.get(user_id, 0))
+        for user_id in sorted(counter_snapshot.keys() | table_counts.keys())
+        if counter_snapshot.get(user_id, 0) != table_counts.get(user_id, 0)
+    ]
+
+# Calls other processes added since the last refresh are not mismatches:
+# refresh_call_stats counts them. Also returns those rows.
+async def find_call_count_mismatches(
+) -> Tuple[List[Tuple[int, int, int]], List[Tuple[int, int, str, str | None, int]]]:
+    counter_snapshot, table_counts, new_calls = await quest_store.run_read(
+        lambda connection: count_calls_in_snapshot(connection, last_call_rowid)
+    )
+    for user_id, count in other_calls(new_calls).items():
+        counter_snapshot[user_id] = counter_snapshot.get(user_id, 0) + count
+    return find_mismatches(counter_snapshot, table_counts), new_calls
+
+async def check_call_counts() -> List[Tuple[int, int, int]]:
+    mismatches, _ = await find_call_count_mismatches()
+    return mismatches
+
+# Applies the differences found by check_call_counts rather than recounting,
+# so calls made since the snapshot keep their increments.
+def correct_call_counts(mismatches: List[Tuple[int, int, int]]) -> None:
+    with call_counts_lock:
+        for user_id, counted, recorded in mismatches:
+            call_counts[user_id] = call_counts.get(user_id, 0) + recorded - counted
+
+# Held from a snapshot until its corrections are applied, so corrections
+# from two overlapping snapshots are never both applied. Created by setup,
+# on the event loop.
+reconcile_lock: asyncio.Lock | None = None
+
+# Also applies the calls other processes added, as refresh_call_stats does.
+async def reconcile_call_counts() -> List[Tuple[int, int, int]]:
+    assert reconcile_lock is not None, "stats are not set up"
+    async with reconcile_lock:
+        mismatches, new_calls = await find_call_count_mismatches()
+        merge_first_calls(new_calls)
+        count_new_calls(new_calls)
+        correct_call_counts(mismatches)
+    return mismatches
+
+# The locks are held while the read transaction starts, so every row of this
+# process in the snapshot is already in own_call_rowids.
+@timed_query
+def read_new_calls(connection: sqlite3.Connection,
+                   after_rowid: int) -> List[Tuple[int, int, str, str | None, int]]:
+    with read_transaction(connection):
+        with journal_lock(), call_counts_lock:
+            connection.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+        return select_new_calls(connection, after_rowid)
+
+# Calls per user among new rows that other processes added: this process
+# counted its own when they were logged.
+def other_calls(rows: List[Tuple[int, int, str, str | None, int]]) -> Dict[int, int]:
+    counts: Dict[int, int] = {}
+    if not invalidation.shared():
+        return counts
+    with journal_lock(), call_counts_lock:
+        for rowid, user_id, _, _, _ in rows:
+            if rowid not in own_call_rowids:
+                counts[user_id] = counts.get(user_id, 0) + 1
+    return counts
+
+def count_new_calls(rows: List[Tuple[int, int, str, str | None, int]]) -> None:
+    counts = other_calls(rows)
+    with journal_lock(), call_counts_lock:
+        own_call_rowids.difference_update(rowid for rowid, _, _, _, _ in rows)
+        for user_id, count in counts.items():
+            call_counts[user_id] = call_counts.get(user_id, 0) + count
+
+# Merging is idempotent: a first call only ever moves earlier, so rows this
+# process already noted change nothing.
+def merge_first_calls(rows: List[Tuple[int, int, str, str | None, int]]) -> None:
+    global last_call_rowid
+    earlier: Dict[int, Dict[Tuple[str, str | None], datetime]] = {}
+    for rowid, user_id, phone, password, call_timestamp in rows:
+        last_call_rowid = max(last_call_rowid, rowid)
+        key = (phone, password)
+        timestamp = datetime.fromtimestamp(call_timestamp, timezone.utc)
+        known = earlier.get(user_id, {}).get(key, first_calls.get(user_id, {}).get(key))
+        if known is None or timestamp < known:
+            earlier.setdefault(user_id, {})[key] = timestamp
+    for user_id, user_earlier in earlier.items():
+        merged = {**first_calls.get(user_id, {}), **user_earlier}
+        first_calls[user_id] = dict(sorted(merged.items(), key = lambda item: item[1]))
+
+# Brings the counters and first calls up to date with calls other workers
+# recorded, from only the rows added since the last refresh, read on the read
+# pool. Serialized with reconcile_call_counts, so no row is counted twice.
+async def refresh_call_stats() -> None:
+    assert reconcile_lock is not None, "stats are not set up"
+    async with reconcile_lock:
+        new_calls = await quest_store.run_read(
+            lambda connection: read_new_calls(connection, last_call_rowid)
+        )
+        merge_first_calls(new_calls)
+        count_new_calls(new_calls)
+
+def stats() -> List[Tuple[int, str | int, str | None]]:
+    # Built from call_counts, so the cost is O(captains) rather than a scan of
+    # call_log. Rows stay keyed by call_log.user_id: removed captains keep
+    # their own row with the user ID instead of the username.
+    result = []
+    for user_id, call_n in list(call_counts.items()):
+        if call_n == 0:
+            continue
+        user = users.users.get(user_id)
+        if user is None:
+            result.append((call_n, user_id, None))
+        else:
+            result.append((call_n, user.username, user.role.value))
+    result.sort(key = lambda stat: stat[0])
+    result.sort(key = lambda stat: stat[2] or "", reverse = True)
+    return result
 
 def progress(user_id: int) -> List[Tuple[str, str | None, datetime]]:
-    cursor = stats_connection.cursor()
-    cursor.execute("""
-        SELECT phone, password, MIN(call_timestamp) AS first_call
-        FROM call_log
-        WHERE user_id = ?
-        GROUP BY phone, password
-        ORDER BY first_call ASC
-    """, (user_id,))
-    return list(map(
-        lambda row: (row[0], row[1], datetime.fromisoformat(row[2])),
-        cursor.fetchall()
-    ))
+    return [
+        (phone, password, first_call)
+        for (phone, password), first_call in first_calls.get(user_id, {}).items()
+    ]
+
+def setup() -> None:
+    global reconcile_lock
+    columns = [column[1] for column in quest_store.read("PRAGMA table_info(call_log)")]
+    # The layout before call_keys.
+    if "phone" in columns:
+        if "update_id" not in columns:
+            quest_store.run_script("migrate_call_log.sql")
+        quest_store.run_script("migrate_call_log_keys.sql")
+    quest_store.run_script("stats.sql")
+    own_call_rowids.clear()
+    read_call_keys()
+    read_first_calls()
+    read_call_counts()
+    reconcile_lock = asyncio.Lock()
@@ -1,12 +1,37 @@
-CREATE TABLE IF NOT EXISTS call_log (
-  user_id INTEGER NOT NULL,
-  call_timestamp TEXT NOT NULL,
+-- Every (phone, password) pair that was ever called, so call_log stores a
+-- small integer instead of repeating the strings.
+CREATE TABLE IF NOT EXISTS call_keys (
+  key_id INTEGER PRIMARY KEY,
   phone TEXT NOT NULL,
   password TEXT NULL
 ) STRICT;
 
+-- A plain unique index would accept the same phone twice with a NULL
+-- password.
+CREATE UNIQUE INDEX IF NOT EXISTS call_key_lookup ON call_keys (
+  phone,
+  password IS NULL,
+  IFNULL(password, '')
+);
+
+-- call_timestamp is Telegram's message date in Unix seconds.
+CREATE TABLE IF NOT EXISTS call_log (
+  user_id INTEGER NOT NULL,
+  call_timestamp INTEGER NOT NULL,
+  key_id INTEGER NOT NULL REFERENCES call_keys (key_id),
+  update_id INTEGER NULL
+) STRICT;
+
+-- Telegram redelivers updates it has no confirmation for, so a call is
+-- recorded at most once per update. Calls recorded before update_id was
+-- stored keep NULL, which the index does not compare.
+CREATE UNIQUE INDEX IF NOT EXISTS call_log_update_lookup ON call_log (
+  update_id
+);
+
 CREATE INDEX IF NOT EXISTS call_log_user_lookup ON call_log (
   user_id,
+  key_id,
   call_timestamp
 );
 
@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import random
+import sqlite3
+import threading
+import time
+
+from sqlite3 import Cursor
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterator, List, TypeVar
+
+import tracing
+from tracing import TracedConnection
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+PACKAGE_DIR = Path(__file__).resolve().parent
+
+BUSY_ERROR_CODES = (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+
+class StoreClosedError(RuntimeError):
+    pass
+
+# A few threads, each with a read-only connection of its own, for reads too
+# slow for the event loop. At most `size` reads run at once; the rest wait
+# on the loop. A read whose caller is cancelled or times out is interrupted.
+class ReadPool:
+    def __init__(self, connect: Callable[[], sqlite3.Connection], size: int) -> None:
+        self.size = size
+        self._connect = connect
+        self._executor = ThreadPoolExecutor(size, thread_name_prefix="store-read")
+        self._slots = asyncio.Semaphore(size)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._connect()
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    async def run(self,
+                  operation: Callable[[sqlite3.Connection], T],
+                  timeout: float | None = None) -> T:
+        async with self._slots:
+            # The connection while `operation` runs, so it can be interrupted
+            # without hitting the next read on the same thread.
+            running: List[sqlite3.Connection] = []
+            def call() -> T:
+                connection = self._connection()
+                with self._lock:
+                    running.append(connection)
+                try:
+                    return operation(connection)
+                finally:
+                    with self._lock:
+                        running.clear()
+            future = self._executor.submit(call)
+            try:
+                return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+            except (asyncio.CancelledError, asyncio.TimeoutError):
+                with self._lock:
+                    if running:
+                        running[0].interrupt()
+                raise
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+
+# Groups reads on one connection into a single read transaction, so they see
+# the same point in time. In WAL mode the writer carries on meanwhile.
+@contextmanager
+def read_transaction(connection: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+    connection.execute("BEGIN")
+    try:
+        yield connection
+    finally:
+        connection.rollback()
+
+# One writer connection, shared by the event loop and the call journal thread
+# and serialized by `_write_lock`, plus a separate read connection. In WAL
+# mode readers never block the writer and the writer never blocks readers.
+class Store:
+    def __init__(self) -> None:
+        self.database_path = ""
+        self.busy_timeout = 5.0
+        self.max_attempts = 5
+        self.max_write_wait = 15.0
+        self.read_timeout = 30.0
+        self.backoff = 0.05
+        self._writer: TracedConnection | None = None
+        self._reader: TracedConnection | None = None
+        self._read_pool: ReadPool | None = None
+        self._write_lock = threading.RLock()
+
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    def open(self,
+             database_path: str,
+             busy_timeout: float = 5.0,
+             max_attempts: int = 5,
+             read_pool_size: int = 2,
+             read_timeout: float = 30.0,
+             max_write_wait: float = 15.0) -> None:
+        assert not self.is_open(), f"{self.database_path} is already open"
+        self.database_path = database_path
+        self.busy_timeout = busy_timeout
+        self.max_attempts = max_attempts
+        self.max_write_wait = max_write_wait
+        self.read_timeout = read_timeout
+        self._writer = self._connect("writer")
+        self._writer.execute("PRAGMA journal_mode = WAL")
+        self._reader = self._connect("reader")
+        self._read_pool = ReadPool(self._connect_read_only, read_pool_size)
+        logger.info(f"opened {self.database_path} in WAL mode "
+                    f"with a {self.busy_timeout}s busy timeout")
+
+    def _connect(self, name: str) -> TracedConnection:
+        connection = sqlite3.connect(self.database_path,
+                                     timeout=self.busy_timeout,
+                                     check_same_thread=False,
+                                     factory=TracedConnection)
+        connection.name = name
+        connection.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout * 1000)}")
+        return connection
+
+    # A read-only connection can never take the write lock.
+    def _connect_read_only(self) -> sqlite3.Connection:
+        uri = f"{Path(self.database_path).resolve().as_uri()}?mode=ro"
+        connection = sqlite3.connect(uri,
+                                     uri=True,
+                                     timeout=self.busy_timeout,
+                                     check_same_thread=False,
+                                     factory=TracedConnection)
+        connection.name = "read-pool"
+        return connection
+
+    def close(self) -> None:
+        if self._read_pool is not None:
+            self._read_pool.close()
+            self._read_pool = None
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+    def writer(self) -> TracedConnection:
+        if self._writer is None:
+            raise StoreClosedError(f"{self.database_path} is not open")
+        return self._writer
+
+    def reader(self) -> TracedConnection:
+        if self._reader is None:
+            raise StoreClosedError(f"{self.database_path} is not open")
+        return self._reader
+
+    # Holds the write lock, recording how long it took to get and who holds
+    # it for the tracer.
+    @contextmanager
+    def _writing(self) -> Iterator[TracedConnection]:
+        started = time.perf_counter()
+        with self._write_lock:
+            writer = self.writer()
+            writer.lock_wait = time.perf_counter() - started
+            held = tracing.hold_write_lock()
+            try:
+                yield writer
+            finally:
+                tracing.release_write_lock(held)
+
+    def executescript(self, script: str) -> None:
+        with self._writing() as writer:
+            writer.executescript(script)
+
+    def run_script(self, file_name: str) -> None:
+        self.executescript((PACKAGE_DIR / file_name).read_text())
+
+    # Runs `operation` in one write transaction, which commits on success and
+    # rolls back on any exception. The whole transaction is retried with
+    # jittered exponential backoff while SQLite reports the database as busy,
+    # but only while another attempt, which may wait up to the busy timeout,
+    # still fits in `max_write_wait`. Blocks the calling thread throughout;
+    # code on the event loop uses write_async.
+    def write(self, operation: Callable[[Cursor], T]) -> T:
+        deadline = time.monotonic() + self.max_write_wait
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                with self._writing() as writer:
+                    with writer:
+                        return operation(writer.cursor())
+            except sqlite3.OperationalError as e:
+                if ((e.sqlite_errorcode & 0xff) not in BUSY_ERROR_CODES or
+                    attempt == self.max_attempts):
+                    raise
+                delay = self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                if time.monotonic() + delay + self.busy_timeout > deadline:
+                    raise
+                logger.warning(f"database is busy, retrying in {delay:.3f}s "
+                               f"(attempt {attempt})")
+                time.sleep(delay)
+        raise AssertionError("unreachable")
+
+    # Runs write in a thread, so the event loop keeps serving while the
+    # transaction waits for the database or backs off.
+    async def write_async(self, operation: Callable[[Cursor], T]) -> T:
+        return await asyncio.to_thread(self.write, operation)
+
+    def read(self, sql: str, parameters: Any = ()) -> List[Any]:
+        return self.reader().execute(sql, parameters).fetchall()
+
+    def read_one(self, sql: str, parameters: Any = ()) -> Any:
+        return self.reader().execute(sql, parameters).fetchone()
+
+    # Runs `operation` on the read pool, off the event loop, and gives up
+    # after `timeout` or the store's read timeout.
+    async def run_read(self,
+                       operation: Callable[[sqlite3.Connection], T],
+                       timeout: float | None = None) -> T:
+        if self._read_pool is None:
+            raise StoreClosedError(f"{self.database_path} is not open")
+        return await self._read_pool.run(
+            operation,
+            timeout if timeout is not None else self.read_timeout
+        )
+
+    async def read_async(self,
+                         sql: str,
+                         parameters: Any = (),
+                         timeout: float | None = None) -> List[Any]:
+        return await self.run_read(
+            lambda connection: connection.execute(sql, parameters).fetchall(),
+            timeout
+        )
+
+# Opened and closed by the Application; importing this module does no I/O.
+quest_store = Store()
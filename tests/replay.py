@@ -0,0 +1,204 @@
+# Replays an update journal recorded with UPDATE_JOURNAL against this build,
+# through the fake Telegram request layer, starting from a copy of a database:
+#   python tests/replay.py updates.jsonl --database quest-before.db \
+#       --save replay.jsonl [--baseline previous-replay.jsonl] [--speed 1]
+# Prints the total time and per-command latency, and with --baseline the
+# difference in call_log and replies between the two runs. --speed 0 replays
+# as fast as the bot goes, 1 at the recorded pace, 10 ten times faster.
+import argparse
+import asyncio
+import difflib
+import json
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from telegram import Update  # noqa: E402
+
+import bot  # noqa: E402
+import throttle  # noqa: E402
+import update_journal  # noqa: E402
+from telegram_fakes import FakeTelegramRequest  # noqa: E402
+
+
+@dataclass
+class ReplayResult:
+    updates: int = 0
+    total_seconds: float = 0.0
+    journal_seconds: float = 0.0
+    # Command -> seconds from an update's arrival to the end of its handling.
+    latencies: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    # (update_id, user_id, phone, password), without the replay's timestamps.
+    calls: List[Tuple[Any, ...]] = field(default_factory=list)
+    # (chat_id, Bot API method, parameters) in the order they were sent.
+    replies: List[Tuple[Any, str, str]] = field(default_factory=list)
+
+    def lines(self) -> List[str]:
+        return ([json.dumps(["call", *call], ensure_ascii=False) for call in self.calls] +
+                [json.dumps(["reply", *reply], ensure_ascii=False) for reply in self.replies])
+
+
+def command_name(update: Update) -> str:
+    message = update.effective_message
+    if message is None:
+        return "other"
+    if message.text is not None and message.text.startswith("/"):
+        return message.text.split(maxsplit=1)[0].split("@", 1)[0]
+    if message.document is not None:
+        return "document"
+    return "text" if message.text is not None else "other"
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def copy_database(source: str, destination: str) -> None:
+    # The backup API also copies what is still in the source's WAL file.
+    source_connection = sqlite3.connect(source)
+    destination_connection = sqlite3.connect(destination)
+    try:
+        source_connection.backup(destination_connection)
+    finally:
+        source_connection.close()
+        destination_connection.close()
+
+
+def read_calls(database_path: str) -> List[Tuple[Any, ...]]:
+    connection = sqlite3.connect(database_path)
+    try:
+        return connection.execute("""
+            SELECT update_id, user_id, phone, password
+            FROM call_log JOIN call_keys USING (key_id)
+            ORDER BY call_timestamp, update_id
+        """).fetchall()
+    finally:
+        connection.close()
+
+
+def sent_replies(telegram: FakeTelegramRequest) -> List[Tuple[Any, str, str]]:
+    return [
+        (
+            parameters.get("chat_id"),
+            method,
+            json.dumps(
+                {key: value for key, value in parameters.items() if key != "chat_id"},
+                ensure_ascii=False,
+                sort_keys=True,
+                default=str,
+            ),
+        )
+        for method, parameters in telegram.calls
+        if method not in ("getMe", "getFile")
+    ]
+
+
+async def replay(journal_path: str,
+                 database_path: str,
+                 speed: float = 0.0,
+                 telegram_latency: float = 0.0) -> ReplayResult:
+    entries = list(update_journal.read_journal(journal_path))
+    result = ReplayResult(updates=len(entries))
+    if entries:
+        result.journal_seconds = entries[-1][0] - entries[0][0]
+    telegram = FakeTelegramRequest(telegram_latency)
+    with tempfile.TemporaryDirectory() as directory:
+        replay_database = str(Path(directory) / "quest.db")
+        copy_database(database_path, replay_database)
+        application = bot.create_application("999001:replay-token",
+                                             request=telegram,
+                                             database_path=replay_database,
+                                             update_journal_path="")
+        async with application:
+            # Captains' budgets refill on wall-clock time, so a replay faster
+            # than the recording would throttle calls the recorded run allowed.
+            throttle.set_limits(0, 0)
+            processor = application.update_processor
+            pending: set[asyncio.Task] = set()
+
+            async def process(update: Update, arrival: float) -> None:
+                await processor.process_update(update, application.process_update(update))
+                result.latencies[command_name(update)].append(time.perf_counter() - arrival)
+
+            started = time.perf_counter()
+            for received, data in entries:
+                if speed > 0:
+                    delay = (started + (received - entries[0][0]) / speed -
+                             time.perf_counter())
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                elif len(pending) >= processor.max_concurrent_updates:
+                    # As fast as possible, but no more updates in flight than
+                    # polling would start.
+                    _, pending = await asyncio.wait(pending,
+                                                    return_when=asyncio.FIRST_COMPLETED)
+                update = Update.de_json(data, application.bot)
+                pending.add(asyncio.create_task(process(update, time.perf_counter())))
+            if pending:
+                await asyncio.gather(*pending)
+            result.total_seconds = time.perf_counter() - started
+        result.calls = read_calls(replay_database)
+    result.replies = sent_replies(telegram)
+    return result
+
+
+def report(result: ReplayResult) -> str:
+    lines = [
+        f"replayed {result.updates} updates in {result.total_seconds:.2f}s "
+        f"(recorded over {result.journal_seconds:.2f}s)",
+        f"{'command':<20} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}",
+    ]
+    for command, latencies in sorted(result.latencies.items()):
+        lines.append(f"{command:<20} {len(latencies):>7} "
+                     f"{percentile(latencies, 0.5) * 1000:>9.1f} "
+                     f"{percentile(latencies, 0.95) * 1000:>9.1f} "
+                     f"{max(latencies) * 1000:>9.1f}")
+    lines.append(f"{len(result.calls)} calls recorded, {len(result.replies)} replies sent")
+    return "\n".join(lines)
+
+
+def diff(baseline: List[str], result: ReplayResult) -> List[str]:
+    return list(difflib.unified_diff(baseline,
+                                     result.lines(),
+                                     "baseline",
+                                     "replay",
+                                     lineterm=""))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay an update journal.")
+    parser.add_argument("journal")
+    parser.add_argument("--database", required=True,
+                        help="database as it was before the journal, copied first")
+    parser.add_argument("--speed", type=float, default=0.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    parser.add_argument("--save", help="write calls and replies for a later --baseline")
+    parser.add_argument("--baseline", help="calls and replies saved by an earlier run")
+    args = parser.parse_args()
+
+    result = asyncio.run(replay(args.journal,
+                                args.database,
+                                args.speed,
+                                args.telegram_latency))
+    print(report(result))
+    if args.save is not None:
+        Path(args.save).write_text("".join(line + "\n" for line in result.lines()),
+                                   encoding="utf-8")
+    if args.baseline is not None:
+        differences = diff(Path(args.baseline).read_text(encoding="utf-8").splitlines(),
+                           result)
+        print("\n".join(differences) if differences else "no differences")
+        if differences:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
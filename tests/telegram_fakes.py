@@ -0,0 +1,280 @@
+import asyncio
+import itertools
+import json
+from typing import Any
+
+import httpx
+from telegram import Update, error
+from telegram.request import BaseRequest, RequestData
+
+
+# Bot API method -> parameter and message field holding the file.
+MEDIA_METHODS = {
+    "sendPhoto": "photo",
+    "sendDocument": "document",
+    "sendSticker": "sticker",
+    "sendVoice": "voice",
+}
+
+def media_content(kind: str, file_id: str, caption: str | None) -> dict[str, Any]:
+    file = {"file_id": file_id, "file_unique_id": file_id}
+    content: dict[str, Any]
+    if kind == "photo":
+        content = {"photo": [{**file, "width": 1, "height": 1}]}
+    elif kind == "sticker":
+        content = {
+            "sticker": {
+                **file,
+                "type": "regular",
+                "width": 1,
+                "height": 1,
+                "is_animated": False,
+                "is_video": False,
+            }
+        }
+    elif kind == "voice":
+        content = {"voice": {**file, "duration": 1}}
+    else:
+        content = {kind: file}
+    if caption is not None:
+        content["caption"] = caption
+    return content
+
+
+# Telegram's update_id is global to the bot, not per chat.
+_update_ids = itertools.count(1)
+
+
+class FakeTelegramRequest(BaseRequest):
+    def __init__(self, latency: float = 0.0) -> None:
+        self.calls: list[tuple[str, dict[str, Any]]] = []
+        self.blocked_chats: set[int] = set()
+        # File id -> content served by getFile and the file download URL.
+        self.files: dict[str, bytes] = {}
+        # Files the bot uploaded, by the chat they were sent to.
+        self.uploads: list[tuple[int, str, bytes]] = []
+        # Chat id -> retry_after of a single 429 answered on the next request.
+        self.flooded_chats: dict[int, int] = {}
+        # Chats whose next request times out after Telegram has handled it.
+        self.timed_out_chats: set[int] = set()
+        # Chats whose next request fails to connect and never reaches Telegram.
+        self.unreachable_chats: set[int] = set()
+        self.latency = latency
+        self._next_message_id = 100
+        self._bot_user = {
+            "id": 999_001,
+            "is_bot": True,
+            "first_name": "Quest test bot",
+            "username": "quest_test_bot",
+        }
+
+    @property
+    def read_timeout(self) -> float | None:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: RequestData | None = None,
+        read_timeout: Any = BaseRequest.DEFAULT_NONE,
+        write_timeout: Any = BaseRequest.DEFAULT_NONE,
+        connect_timeout: Any = BaseRequest.DEFAULT_NONE,
+        pool_timeout: Any = BaseRequest.DEFAULT_NONE,
+    ) -> tuple[int, bytes]:
+        del method, read_timeout, write_timeout, connect_timeout, pool_timeout
+        if "/file/bot" in url:
+            return 200, self.files[url.rsplit("/", maxsplit=1)[-1]]
+        api_method = url.rsplit("/", maxsplit=1)[-1]
+        parameters = request_data.parameters if request_data is not None else {}
+        if parameters.get("chat_id") in self.unreachable_chats:
+            self.unreachable_chats.discard(parameters["chat_id"])
+            raise error.NetworkError(
+                "httpx.ConnectError: connection refused"
+            ) from httpx.ConnectError("connection refused")
+        self.calls.append((api_method, parameters))
+        if request_data is not None:
+            for file_name, content, _ in request_data.multipart_data.values():
+                assert isinstance(content, bytes)
+                self.uploads.append((parameters["chat_id"], file_name, content))
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+        if parameters.get("chat_id") in self.blocked_chats:
+            response = {
+                "ok": False,
+                "error_code": 403,
+                "description": "Forbidden: bot was blocked by the user",
+            }
+            return 403, json.dumps(response).encode()
+
+        if api_method == "sendMessage" and len(parameters["text"]) > 4096:
+            response = {
+                "ok": False,
+                "error_code": 400,
+                "description": "Bad Request: message is too long",
+            }
+            return 400, json.dumps(response).encode()
+
+        retry_after = self.flooded_chats.pop(parameters.get("chat_id"), None)
+        if retry_after is not None:
+            response = {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {retry_after}",
+                "parameters": {"retry_after": retry_after},
+            }
+            return 429, json.dumps(response).encode()
+
+        if api_method == "getMe":
+            result = self._bot_user
+        elif api_method == "getFile":
+            result = {
+                "file_id": parameters["file_id"],
+                "file_unique_id": parameters["file_id"],
+                "file_path": f"documents/{parameters['file_id']}",
+            }
+        elif api_method == "sendMessage":
+            result = self._message(parameters, {"text": parameters["text"]})
+        elif api_method in MEDIA_METHODS:
+            kind = MEDIA_METHODS[api_method]
+            result = self._message(
+                parameters,
+                media_content(
+                    kind,
+                    # Uploaded files travel as multipart data, not as a parameter.
+                    parameters.get(kind, "uploaded-file"),
+                    parameters.get("caption"),
+                ),
+            )
+        elif api_method == "sendMediaGroup":
+            result = [
+                self._message(
+                    parameters,
+                    media_content(str(media["type"]), media["media"], media.get("caption")),
+                )
+                for media in parameters["media"]
+            ]
+        elif api_method == "editMessageText":
+            result = {
+                "message_id": parameters["message_id"],
+                "date": 1_754_000_000,
+                "chat": {
+                    "id": parameters["chat_id"],
+                    "type": "private",
+                },
+                "from": self._bot_user,
+                "text": parameters["text"],
+            }
+        else:
+            raise AssertionError(f"Unexpected Bot API method: {api_method}")
+
+        if parameters.get("chat_id") in self.timed_out_chats:
+            self.timed_out_chats.discard(parameters["chat_id"])
+            raise error.TimedOut() from httpx.ReadTimeout("timed out")
+
+        response = {"ok": True, "result": result}
+        return 200, json.dumps(response).encode()
+
+    def _message(self, parameters: dict[str, Any], content: dict[str, Any]) -> dict[str, Any]:
+        self._next_message_id += 1
+        return {
+            "message_id": self._next_message_id,
+            "date": 1_754_000_000,
+            "chat": {
+                "id": parameters["chat_id"],
+                "type": "private",
+            },
+            "from": self._bot_user,
+            **content,
+        }
+
+    def requests_to(self, user_id: int) -> list[tuple[str, dict[str, Any]]]:
+        return [
+            (method, parameters)
+            for method, parameters in self.calls
+            if parameters.get("chat_id") == user_id
+        ]
+
+    def messages_to(self, user_id: int) -> list[str]:
+        return [
+            parameters["text"]
+            for method, parameters in self.calls
+            if method == "sendMessage" and parameters["chat_id"] == user_id
+        ]
+
+    def edits_to(self, user_id: int) -> list[str]:
+        return [
+            parameters["text"]
+            for method, parameters in self.calls
+            if method == "editMessageText" and parameters["chat_id"] == user_id
+        ]
+
+
+class TelegramUser:
+    def __init__(self, application: Any, user_id: int, username: str) -> None:
+        self.application = application
+        self.user_id = user_id
+        self.username = username
+
+    def update(self, text: str) -> Update:
+        command = text.split(maxsplit=1)[0]
+        entities = []
+        if command.startswith("/"):
+            entities.append(
+                {
+                    "type": "bot_command",
+                    "offset": 0,
+                    "length": len(command),
+                }
+            )
+        return self._update({"text": text, "entities": entities})
+
+    def document_update(self, file_id: str, file_name: str) -> Update:
+        return self._update(
+            {
+                "document": {
+                    "file_id": file_id,
+                    "file_unique_id": file_id,
+                    "file_name": file_name,
+                }
+            }
+        )
+
+    def _update(self, content: dict[str, Any]) -> Update:
+        update_id = next(_update_ids)
+        return Update.de_json(
+            {
+                "update_id": update_id,
+                "message": {
+                    "message_id": update_id,
+                    "date": 1_754_000_000 + update_id,
+                    "chat": {
+                        "id": self.user_id,
+                        "type": "private",
+                        "first_name": "Test",
+                        "username": self.username,
+                    },
+                    "from": {
+                        "id": self.user_id,
+                        "is_bot": False,
+                        "first_name": "Test",
+                        "username": self.username,
+                    },
+                    **content,
+                },
+            },
+            self.application.bot,
+        )
+
+    async def send(self, text: str) -> None:
+        await self.application.process_update(self.update(text))
+
+    async def send_document(self, file_id: str, file_name: str) -> None:
+        await self.application.process_update(self.document_update(file_id, file_name))
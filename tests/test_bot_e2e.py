@@ -1,139 +1,73 @@
-import importlib
-import json
-import sys
+import asyncio
+import csv
+import gzip
+import io
+import marshal
+import multiprocessing
+import sqlite3
+import time
+from datetime import datetime, timezone
 from pathlib import Path
 from typing import Any
 
 import pytest
-from telegram import Update
-from telegram.request import BaseRequest, RequestData
-
-
-class FakeTelegramRequest(BaseRequest):
-    def __init__(self) -> None:
-        self.calls: list[tuple[str, dict[str, Any]]] = []
-        self._next_message_id = 100
-        self._bot_user = {
-            "id": 999_001,
-            "is_bot": True,
-            "first_name": "Quest test bot",
-            "username": "quest_test_bot",
-        }
-
-    @property
-    def read_timeout(self) -> float | None:
-        return None
-
-    async def initialize(self) -> None:
-        pass
-
-    async def shutdown(self) -> None:
-        pass
-
-    async def do_request(
-        self,
-        url: str,
-        method: str,
-        request_data: RequestData | None = None,
-        read_timeout: Any = BaseRequest.DEFAULT_NONE,
-        write_timeout: Any = BaseRequest.DEFAULT_NONE,
-        connect_timeout: Any = BaseRequest.DEFAULT_NONE,
-        pool_timeout: Any = BaseRequest.DEFAULT_NONE,
-    ) -> tuple[int, bytes]:
-        del method, read_timeout, write_timeout, connect_timeout, pool_timeout
-        api_method = url.rsplit("/", maxsplit=1)[-1]
-        parameters = request_data.parameters if request_data is not None else {}
-        self.calls.append((api_method, parameters))
-
-        if api_method == "getMe":
-            result = self._bot_user
-        elif api_method == "sendMessage":
-            self._next_message_id += 1
-            result = {
-                "message_id": self._next_message_id,
-                "date": 1_754_000_000,
-                "chat": {
-                    "id": parameters["chat_id"],
-                    "type": "private",
-                },
-                "from": self._bot_user,
-                "text": parameters["text"],
-            }
-        else:
-            raise AssertionError(f"Unexpected Bot API method: {api_method}")
-
-        response = {"ok": True, "result": result}
-        return 200, json.dumps(response).encode()
-
-    def messages_to(self, user_id: int) -> list[str]:
-        return [
-            parameters["text"]
-            for method, parameters in self.calls
-            if method == "sendMessage" and parameters["chat_id"] == user_id
-        ]
+
+import bot
+import broadcasts
+import invalidation
+import metrics
+import pause
+import profiling
+import phonebook
+import stats
+import throttle
+import users
+from store import quest_store
+from telegram_fakes import FakeTelegramRequest, TelegramUser
+
+
+async def add_text_number(number: str, text: str) -> None:
+    await phonebook.add_number(
+        number,
+        None,
+        phonebook.Reply([phonebook.ReplyPart(phonebook.ReplyType.TEXT, text)]),
+    )
+
+
+@pytest.fixture
+def telegram() -> FakeTelegramRequest:
+    return FakeTelegramRequest()
+
+
+@pytest.fixture
+def application(tmp_path: Path, telegram: FakeTelegramRequest) -> Any:
+    return bot.create_application(
+        "999001:test-token",
+        request=telegram,
+        database_path=str(tmp_path / "quest.db"),
+    )
 
 
-class TelegramUser:
-    def __init__(self, application: Any, user_id: int, username: str) -> None:
-        self.application = application
-        self.user_id = user_id
-        self.username = username
-        self._next_update_id = 1
-
-    async def send(self, text: str) -> None:
-        command = text.split(maxsplit=1)[0]
-        update = Update.de_json(
-            {
-                "update_id": self._next_update_id,
-                "message": {
-                    "message_id": self._next_update_id,
-                    "date": 1_754_000_000 + self._next_update_id,
-                    "chat": {
-                        "id": self.user_id,
-                        "type": "private",
-                        "first_name": "Test",
-                        "username": self.username,
-                    },
-                    "from": {
-                        "id": self.user_id,
-                        "is_bot": False,
-                        "first_name": "Test",
-                        "username": self.username,
-                    },
-                    "text": text,
-                    "entities": [
-                        {
-                            "type": "bot_command",
-                            "offset": 0,
-                            "length": len(command),
-                        }
-                    ],
-                },
-            },
-            self.application.bot,
+def add_admin(user_id: int, username: str) -> None:
+    quest_store.write(
+        lambda cursor: cursor.execute(
+            "INSERT INTO users VALUES (?, ?, 'admin')",
+            (user_id, username),
         )
-        self._next_update_id += 1
-        await self.application.process_update(update)
+    )
+    users.read_users()
 
 
 @pytest.mark.asyncio
 async def test_successful_call_is_visible_in_status(
-    tmp_path: Path,
-    monkeypatch: pytest.MonkeyPatch,
+    application: Any,
+    telegram: FakeTelegramRequest,
 ) -> None:
     captain_id = 123_456
-    module_names = ("bot", "phonebook", "users", "stats", "pause")
-    monkeypatch.setenv("QUEST_DB_PATH", str(tmp_path / "quest.db"))
 
-    bot = importlib.import_module("bot")
-    phonebook = importlib.import_module("phonebook")
-    users = importlib.import_module("users")
-    stats = importlib.import_module("stats")
-    pause = importlib.import_module("pause")
-
-    try:
-        users.add_captain(str(captain_id), "test_captain")
-        phonebook.add_number(
+    async with application:
+        await users.add_captain(str(captain_id), "test_captain")
+        await phonebook.add_number(
             "5551234",
             "answer",
             phonebook.Reply(
@@ -146,29 +80,1085 @@ async def test_successful_call_is_visible_in_status(
             ),
         )
 
-        telegram = FakeTelegramRequest()
-        application = bot.create_application(
+        captain = TelegramUser(
+            application,
+            captain_id,
+            "test_captain",
+        )
+        await captain.send("/call 5551234 answer")
+        await captain.send("/status")
+
+    assert telegram.messages_to(captain_id) == [
+        "Quest unlocked",
+        r"Кількість дзвінків — 1\.",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_flood_control_delays_reply_instead_of_dropping_it(
+    application: Any,
+    telegram: FakeTelegramRequest,
+) -> None:
+    captain_id = 123_457
+    telegram.flooded_chats[captain_id] = 1
+
+    async with application:
+        await users.add_captain(str(captain_id), "test_captain")
+        await add_text_number("5551234", "Quest unlocked")
+
+        captain = TelegramUser(application, captain_id, "test_captain")
+        await captain.send("/call 5551234")
+        await captain.send("/status")
+
+    # The first attempt was answered with 429 and retried after a second.
+    assert telegram.messages_to(captain_id) == [
+        "Quest unlocked",
+        "Quest unlocked",
+        r"Кількість дзвінків — 1\.",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_reply_that_times_out_is_not_sent_again(
+    application: Any,
+    telegram: FakeTelegramRequest,
+) -> None:
+    captain_id = 123_457
+    telegram.timed_out_chats.add(captain_id)
+
+    async with application:
+        await users.add_captain(str(captain_id), "test_captain")
+        await add_text_number("5551234", "Quest unlocked")
+
+        captain = TelegramUser(application, captain_id, "test_captain")
+        await captain.send("/call 5551234")
+        await captain.send("/status")
+
+    # Telegram may have delivered it, so it was sent once and the call, whose
+    # delivery is unknown, was not counted.
+    assert telegram.messages_to(captain_id) == [
+        "Quest unlocked",
+        r"Кількість дзвінків — 0\.",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_reply_that_fails_to_connect_is_retried(
+    application: Any,
+    telegram: FakeTelegramRequest,
+) -> None:
+    captain_id = 123_457
+    telegram.unreachable_chats.add(captain_id)
+
+    async with application:
+        await users.add_captain(str(captain_id), "test_captain")
+        await add_text_number("5551234", "Quest unlocked")
+
+        captain = TelegramUser(application, captain_id, "test_captain")
+        await captain.send("/call 5551234")
+        await captain.send("/status")
+
+    assert telegram.messages_to(captain_id) == [
+        "Quest unlocked",
+        r"Кількість дзвінків — 1\.",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_broadcast_reports_delivery_tally(
+    application: Any,
+    telegram: FakeTelegramRequest,
+) -> None:
+    admin_id = 1
+    captain_ids = [101, 102, 103]
+    blocked_id = 102
+    telegram.blocked_chats.add(blocked_id)
+
+    async with application:
+        add_admin(admin_id, "test_admin")
+        for captain_id in captain_ids:
+            await users.add_captain(str(captain_id), f"captain_{captain_id}")
+
+        admin = TelegramUser(application, admin_id, "test_admin")
+        await admin.send("/broadcast")
+        await admin.send("Meet at the fountain")
+        await admin.send("/done")
+
+    for captain_id in captain_ids:
+        if captain_id != blocked_id:
+            assert telegram.messages_to(captain_id) == ["Meet at the fountain"]
+    assert telegram.messages_to(admin_id)[-1] == "Надсилаю оголошення: 0 з 3"
+    assert telegram.edits_to(admin_id)[-1] == "\n".join(
+        [
+            "Оголошення надіслано 3 капітанам.",
+            "Доставлено: 2",
+            "Не активували бота: 1",
+            "  captain_102",
+            "Помилки: 0",
+        ]
+    )
+
+
+@pytest.mark.asyncio
+async def test_broadcast_is_sent_by_an_application_started_after_another_stopped(
+    tmp_path: Path,
+    application: Any,
+    telegram: FakeTelegramRequest,
+) -> None:
+    admin_id = 1
+    captain_id = 111
+
+    async with application:
+        add_admin(admin_id, "test_admin")
+        await users.add_captain(str(captain_id), "captain")
+
+    # Like a worker other than the first, which leaves resuming to it.
+    restarted = bot.create_application(
+        "999001:test-token",
+        request=telegram,
+        database_path=str(tmp_path / "quest.db"),
+        resume_broadcasts=False,
+    )
+    async with restarted:
+        admin = TelegramUser(restarted, admin_id, "test_admin")
+        await admin.send("/broadcast")
+        await admin.send("Meet at the fountain")
+        await admin.send("/done")
+
+    assert telegram.messages_to(captain_id) == ["Meet at the fountain"]
+    assert telegram.edits_to(admin_id)[-1].startswith("Оголошення надіслано 1 капітанам.")
+
+
+@pytest.mark.asyncio
+async def test_removed_captains_stay_distinct_in_leaderboard(
+    application: Any,
+    telegram: FakeTelegramRequest,
+) -> None:
+    admin_id = 1
+
+    async with application:
+        add_admin(admin_id, "test_admin")
+        await users.add_captain("201", "captain_a")
+        await users.add_captain("202", "captain_b")
+
+        admin = TelegramUser(application, admin_id, "test_admin")
+        captain_a = TelegramUser(application, 201, "captain_a")
+        captain_b = TelegramUser(application, 202, "captain_b")
+        await captain_a.send("/call 111")
+        await captain_b.send("/call 111")
+        await captain_b.send("/call 222")
+        await admin.send("/remove_captain 201")
+        await admin.send("/remove_captain 202")
+        await admin.send("/leaderboard")
+
+    assert telegram.messages_to(admin_id)[-1] == "\n".join(
+        [
+            "201 (None) — 1",
+            "202 (None) — 2",
+        ]
+    )
+
+
+@pytest.mark.asyncio
+async def test_metrics_show_handler_and_bot_api_latency(
+    application: Any,
+    telegram: FakeTelegramRequest,
+) -> None:
+    admin_id = 1
+
+    async with application:
+        add_admin(admin_id, "test_admin")
+        admin = TelegramUser(application, admin_id, "test_admin")
+        await admin.send("/call 111")
+        await admin.send("/metrics")
+        sent = len(telegram.messages_to(admin_id))
+        # More lines than one message holds.
+        for n in range(300):
+            metrics.registry.increment(throttle.THROTTLED, command=f"command_{n:03}")
+        await admin.send("/metrics")
+
+    report = telegram.messages_to(admin_id)[sent - 1]
+    assert "\ncall — " in report
+    assert "\nstats.log_call — " in report
+    assert "\nsendMessage — " in report
+    long_report = telegram.messages_to(admin_id)[sent:]
+    assert len(long_report) > 1
+    assert all(len(message) <= 4096 for message in long_report)
+    lines = "\n".join(long_report).splitlines()
+    assert lines[0] == "Обробники:"
+    assert [line for line in lines if line.startswith("command_")] == [
+        f"command_{n:03} — 1" for n in range(300)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_updates_keep_per_chat_order(tmp_path: Path) -> None:
+    telegram = FakeTelegramRequest(latency=0.02)
+    application = bot.create_application(
+        "999001:test-token",
+        request=telegram,
+        database_path=str(tmp_path / "quest.db"),
+        concurrent_updates=8,
+    )
+
+    async with application:
+        await users.add_captain("301", "captain_a")
+        await users.add_captain("302", "captain_b")
+        for n in range(3):
+            await add_text_number(f"10{n}", f"Clue {n}")
+        captain_a = TelegramUser(application, 301, "captain_a")
+        captain_b = TelegramUser(application, 302, "captain_b")
+
+        await application.start()
+        for n in range(3):
+            application.update_queue.put_nowait(captain_a.update(f"/call 10{n}"))
+        application.update_queue.put_nowait(captain_b.update("/call 100"))
+        await application.update_queue.join()
+        await application.stop()
+
+    assert telegram.messages_to(301) == ["Clue 0", "Clue 1", "Clue 2"]
+    chats = [
+        parameters["chat_id"]
+        for method, parameters in telegram.calls
+        if method == "sendMessage"
+    ]
+    # Captain B is not stuck behind captain A's backlog.
+    assert chats.index(302) < len(chats) - 1
+
+
+@pytest.mark.asyncio
+async def test_multipart_reply_is_sent_as_albums(
+    application: Any,
+    telegram: FakeTelegramRequest,
+) -> None:
+    captain_id = 401
+    part = phonebook.ReplyPart
+    kind = phonebook.ReplyType
+
+    async with application:
+        await users.add_captain(str(captain_id), "captain")
+        await phonebook.add_number(
+            "777",
+            None,
+            phonebook.Reply(
+                [
+                    part(kind.TEXT, "Look closer"),
+                    part(kind.PHOTO, "photo-1"),
+                    part(kind.PHOTO, "photo-2"),
+                    part(kind.TEXT, "Second photo caption"),
+                    part(kind.STICKER, "sticker-1"),
+                    part(kind.DOCUMENT, "document-1"),
+                    part(kind.TEXT, "Document caption"),
+                    part(kind.PHOTO, "photo-3"),
+                    part(kind.TEXT, "Third photo caption"),
+                    part(kind.PHOTO, "photo-4"),
+                ]
+            ),
+        )
+        captain = TelegramUser(application, captain_id, "captain")
+        await captain.send("/call 777")
+
+    requests = telegram.requests_to(captain_id)
+    assert [method for method, _ in requests] == [
+        "sendMessage",
+        "sendMediaGroup",
+        "sendSticker",
+        "sendDocument",
+        "sendPhoto",
+        "sendPhoto",
+    ]
+    album = requests[1][1]["media"]
+    assert [(media["media"], media.get("caption")) for media in album] == [
+        ("photo-1", None),
+        ("photo-2", "Second photo caption"),
+    ]
+    assert requests[3][1]["caption"] == "Document caption"
+    assert [
+        (parameters["photo"], parameters.get("caption"))
+        for _, parameters in requests[4:]
+    ] == [("photo-3", "Third photo caption"), ("photo-4", None)]
+
+
+@pytest.mark.asyncio
+async def test_redelivered_call_is_counted_once_across_restart(
+    tmp_path: Path,
+    telegram: FakeTelegramRequest,
+) -> None:
+    captain_id = 501
+    database_path = str(tmp_path / "quest.db")
+
+    application = bot.create_application(
+        "999001:test-token", request=telegram, database_path=database_path
+    )
+    async with application:
+        await users.add_captain(str(captain_id), "captain")
+        await add_text_number("555", "Quest unlocked")
+        captain = TelegramUser(application, captain_id, "captain")
+        call_update = captain.update("/call 555")
+        await application.process_update(call_update)
+        await application.process_update(call_update)
+
+    # Telegram delivers the same update again after a restart.
+    application = bot.create_application(
+        "999001:test-token", request=telegram, database_path=database_path
+    )
+    async with application:
+        captain = TelegramUser(application, captain_id, "captain")
+        await application.process_update(call_update)
+        await captain.send("/status")
+
+    assert telegram.messages_to(captain_id) == [
+        "Quest unlocked",
+        r"Кількість дзвінків — 1\.",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_call_log_ignores_an_update_recorded_twice(application: Any) -> None:
+    async with application:
+        when = datetime(2025, 8, 17, 10, 41, tzinfo=timezone.utc)
+        await stats.log_call(601, when, "555", None, update_id=42)
+        await stats.log_call(601, when, "555", None, update_id=42)
+        # Commits everything still in the journal.
+        stats.stop_journal()
+
+        assert stats.status(601) == 1
+        assert await stats.check_call_counts() == []
+
+
+@pytest.mark.asyncio
+async def test_noisy_captain_is_throttled(
+    application: Any,
+    telegram: FakeTelegramRequest,
+) -> None:
+    admin_id = 1
+    captain_id = 701
+
+    async with application:
+        add_admin(admin_id, "test_admin")
+        await users.add_captain(str(captain_id), "captain")
+        admin = TelegramUser(application, admin_id, "test_admin")
+        captain = TelegramUser(application, captain_id, "captain")
+        await admin.send("/throttle 1 2")
+        for guess in range(4):
+            await captain.send(f"/call 555 guess{guess}")
+        await captain.send("/status")
+        # Admins are never throttled.
+        for _ in range(3):
+            await admin.send("/status")
+
+    assert telegram.messages_to(admin_id)[0] == "Ліміт: 1 команд на хвилину, запас: 2"
+    assert telegram.messages_to(captain_id) == [
+        r"_Ніхто не відповідає\.\.\._",
+        r"_Ніхто не відповідає\.\.\._",
+        r"_Лінія зайнята, спробуйте пізніше_",
+    ]
+    assert stats.status(captain_id) == 2
+    assert telegram.messages_to(admin_id)[1:] == [r"Кількість дзвінків — 0\."] * 3
+
+
+@pytest.mark.asyncio
+async def test_throttle_limits_outlast_a_restart_until_the_settings_change(
+    tmp_path: Path,
+    application: Any,
+    telegram: FakeTelegramRequest,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    admin_id = 1
+
+    async with application:
+        add_admin(admin_id, "test_admin")
+        await TelegramUser(application, admin_id, "test_admin").send("/throttle 5 3")
+
+    for rate in ("30", "60"):
+        monkeypatch.setenv("CAPTAIN_RATE_PER_MINUTE", rate)
+        restarted = bot.create_application(
             "999001:test-token",
             request=telegram,
+            database_path=str(tmp_path / "quest.db"),
         )
+        async with restarted:
+            await TelegramUser(restarted, admin_id, "test_admin").send("/throttle")
+
+    assert telegram.messages_to(admin_id) == [
+        "Ліміт: 5 команд на хвилину, запас: 3",
+        "Ліміт: 5 команд на хвилину, запас: 3",
+        "Ліміт: 60 команд на хвилину, запас: 10",
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("rate, burst", [("-1", "10"), ("30", "0.5")])
+async def test_invalid_throttle_settings_stop_the_start(
+    application: Any,
+    monkeypatch: pytest.MonkeyPatch,
+    rate: str,
+    burst: str,
+) -> None:
+    monkeypatch.setenv("CAPTAIN_RATE_PER_MINUTE", rate)
+    monkeypatch.setenv("CAPTAIN_BURST", burst)
 
+    with pytest.raises(ValueError, match="CAPTAIN_RATE_PER_MINUTE must be at least 0"):
         async with application:
-            captain = TelegramUser(
-                application,
-                captain_id,
-                "test_captain",
-            )
-            await captain.send("/call 5551234 answer")
-            await captain.send("/status")
-
-        assert telegram.messages_to(captain_id) == [
-            "Quest unlocked",
-            r"Кількість дзвінків — 1\.",
-        ]
+            pass
+
+
+PHONEBOOK_JSONL = """\
+{"phone": "100", "password": null, "reply": [{"type": "text", "data": "Дзвінок прийнято"}]}
+{"phone": "200", "password": "secret", "reply": [{"type": "photo", "data": "photo-1"}, {"type": "text", "data": "Caption"}]}
+{"phone": "200", "alias": "Поліція"}
+"""
+
+
+@pytest.mark.asyncio
+async def test_phonebook_is_imported_and_exported_in_bulk(
+    application: Any,
+    telegram: FakeTelegramRequest,
+) -> None:
+    admin_id = 1
+    telegram.files["phonebook-file"] = PHONEBOOK_JSONL.encode()
+
+    async with application:
+        add_admin(admin_id, "test_admin")
+        await add_text_number("999", "Replaced by the import")
+        admin = TelegramUser(application, admin_id, "test_admin")
+        await admin.send("/import_phonebook")
+        await admin.send_document("phonebook-file", "quest.jsonl")
+        await admin.send("/call 100")
+        await admin.send("/call 999")
+        await admin.send("/export_phonebook")
+        await admin.send("/export_phonebook csv")
+
+    assert telegram.messages_to(admin_id)[1:] == [
+        "Імпортовано номерів: 2, назв номерів: 1",
+        "Дзвінок прийнято",
+        r"_Ніхто не відповідає\.\.\._",
+    ]
+    assert phonebook.phone_aliases == {"200": "Поліція"}
+    (_, jsonl_name, jsonl), (_, csv_name, csv) = telegram.uploads
+    assert (jsonl_name, jsonl.decode()) == ("phonebook.jsonl", PHONEBOOK_JSONL)
+    assert (csv_name, csv.decode()) == (
+        "phonebook.csv",
+        "phone,password,type,data\n"
+        "100,,text,Дзвінок прийнято\n"
+        "200,secret,photo,photo-1\n"
+        "200,secret,text,Caption\n"
+        "200,,alias,Поліція\n",
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("file_format", ["jsonl", "csv"])
+async def test_exported_phonebook_imports_back_with_its_line_breaks(
+    application: Any,
+    telegram: FakeTelegramRequest,
+    file_format: str,
+) -> None:
+    admin_id = 1
+    text = "line one\nline two\r\nline three\u2028line four\x85end"
+
+    async with application:
+        add_admin(admin_id, "test_admin")
+        await add_text_number("100", text)
+        admin = TelegramUser(application, admin_id, "test_admin")
+        await admin.send(f"/export_phonebook {file_format}")
+        [(_, file_name, exported)] = telegram.uploads
+        telegram.files["phonebook-file"] = exported
+        await add_text_number("100", "Replaced by the import")
+        await admin.send("/import_phonebook")
+        await admin.send_document("phonebook-file", file_name)
+        await admin.send("/call 100")
+
+    assert telegram.messages_to(admin_id)[-2:] == [
+        "Імпортовано номерів: 1, назв номерів: 0",
+        text,
+    ]
+
+
+@pytest.mark.asyncio
+async def test_invalid_phonebook_file_changes_nothing(
+    application: Any,
+    telegram: FakeTelegramRequest,
+) -> None:
+    admin_id = 1
+    telegram.files["phonebook-file"] = b"phone,password,type,data\n100,,song,x\n"
+
+    async with application:
+        add_admin(admin_id, "test_admin")
+        await add_text_number("999", "Still here")
+        admin = TelegramUser(application, admin_id, "test_admin")
+        await admin.send("/import_phonebook")
+        await admin.send_document("phonebook-file", "quest.csv")
+        await admin.send("/call 999")
+
+    assert telegram.messages_to(admin_id)[1:] == [
+        "Файл не імпортовано: line 2: unknown reply type 'song'",
+        "Still here",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_call_log_from_before_call_keys_is_migrated(
+    tmp_path: Path,
+    telegram: FakeTelegramRequest,
+) -> None:
+    database_path = tmp_path / "quest.db"
+    with sqlite3.connect(database_path) as connection:
+        connection.executescript(
+            """
+            CREATE TABLE call_log (
+              user_id INTEGER NOT NULL,
+              call_timestamp TEXT NOT NULL,
+              phone TEXT NOT NULL,
+              password TEXT NULL
+            ) STRICT;
+            CREATE INDEX call_log_user_lookup ON call_log (user_id, call_timestamp);
+            INSERT INTO call_log VALUES
+              (801, '2025-08-17 07:42:28+00:00', '555', NULL),
+              (801, '2025-08-17 07:41:28+00:00', '555', NULL),
+              (801, '2025-08-17 07:43:00+00:00', '555', 'answer'),
+              (802, '2025-08-17 07:44:00+00:00', '555', NULL);
+            """
+        )
+    connection.close()
+
+    application = bot.create_application(
+        "999001:test-token", request=telegram, database_path=str(database_path)
+    )
+    async with application:
+        await users.add_captain("801", "captain")
+        await stats.log_call(801, datetime(2025, 8, 17, 7, 45, tzinfo=timezone.utc), "555", None)
+        stats.stop_journal()
+        assert await stats.check_call_counts() == []
+
+    assert stats.status(801) == 4
+    assert stats.progress(801) == [
+        ("555", None, datetime(2025, 8, 17, 7, 41, 28, tzinfo=timezone.utc)),
+        ("555", "answer", datetime(2025, 8, 17, 7, 43, tzinfo=timezone.utc)),
+    ]
+    with sqlite3.connect(database_path) as connection:
+        assert connection.execute("SELECT COUNT(*) FROM call_keys").fetchone() == (2,)
+    connection.close()
+
+
+@pytest.mark.asyncio
+async def test_export_sends_gzipped_csv_snapshots(
+    application: Any,
+    telegram: FakeTelegramRequest,
+) -> None:
+    admin_id = 1
+
+    async with application:
+        add_admin(admin_id, "test_admin")
+        await users.add_captain("901", "captain_a")
+        await users.add_captain("902", "captain_b")
+        await add_text_number("555", "Clue")
+        await phonebook.add_phone_alias("555", "Police")
+        admin = TelegramUser(application, admin_id, "test_admin")
+        captain_a = TelegramUser(application, 901, "captain_a")
+        captain_b = TelegramUser(application, 902, "captain_b")
+        await captain_a.send("/call 555")
+        await captain_b.send("/call 555")
+        await captain_b.send("/call 777 secret")
+        # Exports see committed calls only.
+        stats.stop_journal()
+        await admin.send("/export")
+
+    files = {
+        file_name: list(csv.reader(io.StringIO(gzip.decompress(content).decode())))
+        for chat_id, file_name, content in telegram.uploads
+        if chat_id == admin_id
+    }
+    assert list(files) == ["calls.csv.gz", "leaderboard.csv.gz", "progress.csv.gz"]
+    calls = files["calls.csv.gz"]
+    assert calls[0] == [
+        "call_time_utc", "user_id", "username", "phone", "password", "update_id",
+    ]
+    assert [row[1:5] for row in calls[1:]] == [
+        ["901", "captain_a", "555", ""],
+        ["902", "captain_b", "555", ""],
+        ["902", "captain_b", "777", "secret"],
+    ]
+    assert files["leaderboard.csv.gz"][1:] == [
+        ["901", "captain_a", "captain", "1"],
+        ["902", "captain_b", "captain", "2"],
+    ]
+    assert [row[:5] for row in files["progress.csv.gz"][1:]] == [
+        ["901", "captain_a", "555", "", "Police"],
+        ["902", "captain_b", "555", "", "Police"],
+        ["902", "captain_b", "777", "secret", ""],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_interrupted_broadcast_resumes_and_retries_failed_captains(
+    tmp_path: Path,
+    telegram: FakeTelegramRequest,
+) -> None:
+    admin_id = 1
+    database_path = str(tmp_path / "quest.db")
+    captains = [
+        users.User(1001, "delivered", users.UserRole.CAPTAIN),
+        users.User(1002, "pending", users.UserRole.CAPTAIN),
+        users.User(1003, "failed", users.UserRole.CAPTAIN),
+    ]
+
+    # The process died after the first captain got the broadcast and the
+    # third one failed.
+    application = bot.create_application(
+        "999001:test-token", request=telegram, database_path=database_path
+    )
+    async with application:
+        add_admin(admin_id, "test_admin")
+        broadcast_id = await broadcasts.create_broadcast(
+            admin_id,
+            captains,
+            phonebook.Reply([phonebook.ReplyPart(phonebook.ReplyType.TEXT, "News")]),
+        )
+        await broadcasts.record_status(broadcast_id, 1001, broadcasts.RecipientStatus.DELIVERED)
+        await broadcasts.record_status(broadcast_id, 1003, broadcasts.RecipientStatus.FAILED)
+
+    application = bot.create_application(
+        "999001:test-token", request=telegram, database_path=database_path
+    )
+    async with application:
+        await asyncio.gather(*broadcasts.running.values())
+        admin = TelegramUser(application, admin_id, "test_admin")
+        await admin.send("/retry_broadcast 1")
+        await asyncio.gather(*broadcasts.running.values())
+        await admin.send("/broadcasts")
+
+    assert telegram.messages_to(1001) == []
+    assert telegram.messages_to(1002) == ["News"]
+    assert telegram.messages_to(1003) == ["News"]
+    summaries = [
+        text for text in telegram.edits_to(admin_id)
+        if text.startswith("Оголошення надіслано")
+    ]
+    assert summaries[0].split("\n")[1:] == [
+        "Доставлено: 2",
+        "Не активували бота: 0",
+        "Помилки: 1",
+        "  failed",
+    ]
+    assert summaries[1].split("\n")[1] == "Доставлено: 3"
+    assert telegram.messages_to(admin_id)[-1].endswith(
+        "доставлено 3, не активували 0, помилки 0, в черзі 0"
+    )
+
+
+@pytest.mark.asyncio
+async def test_broadcast_leased_to_another_process_is_taken_over_when_the_lease_ends(
+    tmp_path: Path,
+    telegram: FakeTelegramRequest,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setenv("BROADCAST_LEASE", "1")
+    database_path = str(tmp_path / "quest.db")
+    admin_id = 1
+    captain_id = 1001
+
+    application = bot.create_application(
+        "999001:test-token", request=telegram, database_path=database_path
+    )
+    async with application:
+        add_admin(admin_id, "test_admin")
+        broadcast_id = await broadcasts.create_broadcast(
+            admin_id,
+            [users.User(captain_id, "captain", users.UserRole.CAPTAIN)],
+            phonebook.Reply([phonebook.ReplyPart(phonebook.ReplyType.TEXT, "News")]),
+        )
+        # Another process is sending it, for two more seconds.
+        quest_store.write(lambda cursor: cursor.execute(
+            "UPDATE broadcasts SET owner = 'another', lease_until = ? "
+            "WHERE broadcast_id = ?",
+            (int(time.time()) + 2, broadcast_id),
+        ))
+
+    application = bot.create_application(
+        "999001:test-token", request=telegram, database_path=database_path
+    )
+    async with application:
+        assert broadcasts.running == {}
+        admin = TelegramUser(application, admin_id, "test_admin")
+        await admin.send(f"/retry_broadcast {broadcast_id}")
+        deadline = time.monotonic() + 10
+        while telegram.messages_to(captain_id) == [] and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        await asyncio.gather(*broadcasts.running.values())
+
+    assert telegram.messages_to(admin_id)[0] == "Це оголошення ще надсилається"
+    assert telegram.messages_to(captain_id) == ["News"]
+
+
+@pytest.mark.asyncio
+async def test_profile_sends_hotspots_and_profile_file(
+    application: Any,
+    telegram: FakeTelegramRequest,
+) -> None:
+    admin_id = 1
+
+    async with application:
+        add_admin(admin_id, "test_admin")
+        await users.add_captain("901", "captain")
+        await add_text_number("555", "Clue")
+        admin = TelegramUser(application, admin_id, "test_admin")
+        captain = TelegramUser(application, 901, "captain")
+        await admin.send("/profile 0.5 memory")
+        await admin.send("/profile 1")
+        # Let the profiling task start.
+        await asyncio.sleep(0.1)
+        await captain.send("/call 555")
+        assert profiling.active is not None
+        await profiling.active
+
+    messages = telegram.messages_to(admin_id)
+    assert messages[:2] == ["Профілюю 0.5 с", "Профілювання вже триває"]
+    report = messages[2]
+    assert report.startswith("Гарячі точки")
+    assert "Телефонна книга: 1 відповідей" in report
+    assert "Приріст памʼяті:" in report
+    [(_, file_name, content)] = [
+        upload for upload in telegram.uploads if upload[0] == admin_id
+    ]
+    assert file_name == "quest.prof"
+    # The handler of the captain's call ran inside the window.
+    assert any(function == "call" and Path(file_name).name == "bot.py"
+               for file_name, _, function in marshal.loads(content))
+
+
+def call_log_rows() -> int:
+    return quest_store.read_one("SELECT COUNT(*) FROM call_log")[0]
+
+
+@pytest.mark.asyncio
+async def test_call_journal_commits_batches_by_size_and_by_delay(application: Any) -> None:
+    async with application:
+        stats.stop_journal()
+        now = datetime.now(timezone.utc)
+        by_size = stats.CallJournal(max_batch=2, max_delay=60)
+        by_size.start()
+        by_size.append(stats.CallRecord(1, now, "555", None))
+        by_size.append(stats.CallRecord(1, now, "556", None))
+        await asyncio.sleep(0.5)
+        # Full long before the delay is up.
+        assert call_log_rows() == 2
+        assert by_size.stats().committed_batches == 1
+        by_size.stop()
+
+        by_delay = stats.CallJournal(max_batch=100, max_delay=0.05)
+        by_delay.start()
+        by_delay.append(stats.CallRecord(1, now, "557", None))
+        assert by_delay.pending() != []
+        await asyncio.sleep(0.5)
+        assert call_log_rows() == 3
+        assert by_delay.pending() == []
+        by_delay.stop()
+
+
+@pytest.mark.asyncio
+async def test_pending_calls_are_counted_and_flushed_on_shutdown(
+    application: Any,
+    telegram: FakeTelegramRequest,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    captain_id = 901
+    monkeypatch.setenv("CALL_JOURNAL_MAX_DELAY", "60")
+
+    async with application:
+        await users.add_captain(str(captain_id), "captain")
+        await add_text_number("555", "Clue")
+        captain = TelegramUser(application, captain_id, "captain")
+        await captain.send("/call 555")
+        await captain.send("/status")
+        assert call_log_rows() == 0
+        assert stats.stats() == [(1, "captain", "captain")]
+
+    assert telegram.messages_to(captain_id) == ["Clue", r"Кількість дзвінків — 1\."]
+    connection = sqlite3.connect(application.database_path)
+    try:
+        assert connection.execute("SELECT user_id FROM call_log").fetchall() == [(captain_id,)]
     finally:
-        users.users_connection.close()
-        phonebook.phonebook_connection.close()
-        stats.stats_connection.close()
-        pause.pause_connection.close()
-        for module_name in module_names:
-            sys.modules.pop(module_name, None)
+        connection.close()
+
+
+@pytest.mark.asyncio
+async def test_calls_the_journal_cannot_commit_are_taken_back(
+    application: Any,
+    telegram: FakeTelegramRequest,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    captain_id = 901
+    attempts = []
+
+    def fail(records: Any) -> Any:
+        attempts.append(records)
+        raise sqlite3.OperationalError("disk I/O error")
+
+    async with application:
+        await users.add_captain(str(captain_id), "captain")
+        await add_text_number("555", "Clue")
+        monkeypatch.setattr(stats, "write_calls", fail)
+        captain = TelegramUser(application, captain_id, "captain")
+        await captain.send("/call 555")
+        # Three attempts, 0.1 s and 0.2 s apart, then a 0.3 s pause.
+        await asyncio.sleep(1)
+        journal_stats = stats.journal_stats()
+        await captain.send("/status")
+
+    assert len(attempts) == stats.CallJournal.max_attempts
+    assert journal_stats is not None and journal_stats.dropped_calls == 1
+    # The reply was delivered, but the call is not deducted.
+    assert telegram.messages_to(captain_id) == ["Clue", r"Кількість дзвінків — 0\."]
+
+
+def cache_matches_database() -> bool:
+    cached_users = sorted((user.user_id, user.username, user.role.value)
+                          for user in users.users.values())
+    cached_phonebook = sorted(
+        (phone, password, reply_n, part.reply_type.value, part.reply_data)
+        for (phone, password), reply in phonebook.phonebook.replies.items()
+        for reply_n, part in enumerate(reply.parts)
+    )
+    return (
+        cached_users == sorted(quest_store.read("SELECT user_id, username, role FROM users")) and
+        {user.username for user in users.users.values()} == set(users.users_by_username) and
+        cached_phonebook == sorted(quest_store.read("""
+            SELECT phone, password, reply_n, reply_type, reply_data FROM phonebook
+        """)) and
+        pause.pause == (quest_store.read_one("SELECT pause FROM pause")[0] == 1)
+    )
+
+
+@pytest.mark.asyncio
+async def test_admin_commands_update_the_caches_in_place(
+    application: Any,
+    telegram: FakeTelegramRequest,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    admin_id = 1
+    full_reloads = []
+
+    async with application:
+        add_admin(admin_id, "test_admin")
+        for module, reload in ((users, "read_users"),
+                               (phonebook, "read_phonebook"),
+                               (pause, "read_pause")):
+            monkeypatch.setattr(module, reload,
+                                lambda reload=reload: full_reloads.append(reload))
+        admin = TelegramUser(application, admin_id, "test_admin")
+        steps = [
+            "/add_captain 901 captain_a",
+            "/add_captain 902 captain_b",
+            "/remove_captain 901",
+            "/add_number 555 secret",
+            "Clue",
+            "/done",
+            "/pause_calls",
+        ]
+        agreed = []
+        for step in steps:
+            await admin.send(step)
+            agreed.append(cache_matches_database())
+        # A captain added to the database behind the bot's back.
+        quest_store.write(lambda cursor: cursor.execute(
+            "INSERT INTO users VALUES (903, 'captain_c', 'captain')"
+        ))
+        await admin.send("/remove_captain 903")
+        agreed.append(cache_matches_database())
+
+    assert agreed == [True] * (len(steps) + 1)
+    assert full_reloads == []
+    assert phonebook.phonebook.replies[("555", "secret")].parts[0].reply_data == "Clue"
+    assert "_Технічна помилка_" not in telegram.messages_to(admin_id)
+
+
+@pytest.mark.asyncio
+async def test_check_counts_reports_and_corrects_a_drifted_counter(
+    application: Any,
+    telegram: FakeTelegramRequest,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    admin_id = 1
+    captain_id = 901
+
+    async with application:
+        add_admin(admin_id, "test_admin")
+        await users.add_captain(str(captain_id), "captain")
+        await add_text_number("555", "Clue")
+        admin = TelegramUser(application, admin_id, "test_admin")
+        captain = TelegramUser(application, captain_id, "captain")
+        await captain.send("/call 555")
+        with stats.call_counts_lock:
+            stats.call_counts[captain_id] = 5
+        # The check scans call_log on the read pool, never on the loop.
+        monkeypatch.setattr(stats, "read_call_counts", None)
+        await admin.send("/check_counts")
+        await captain.send("/status")
+        await admin.send("/check_counts")
+
+    assert telegram.messages_to(admin_id) == [
+        f"Лічильники виправлено:\n{captain_id}: 5 → 1",
+        "Лічильники дзвінків збігаються з журналом",
+    ]
+    assert telegram.messages_to(captain_id)[-1] == r"Кількість дзвінків — 1\."
+
+
+# The per-captain query /progress ran before the first-call index.
+def first_calls_from_call_log(user_id: int) -> list[tuple[str, str | None, datetime]]:
+    rows = quest_store.read("""
+        SELECT phone, password, MIN(call_timestamp) AS first_call
+        FROM call_log JOIN call_keys USING (key_id)
+        WHERE user_id = ?
+        GROUP BY phone, password
+        ORDER BY first_call ASC
+    """, (user_id,))
+    return [
+        (phone, password, datetime.fromtimestamp(first_call, timezone.utc))
+        for phone, password, first_call in rows
+    ]
+
+
+@pytest.mark.asyncio
+async def test_progress_matches_the_call_log_query(
+    application: Any,
+    telegram: FakeTelegramRequest,
+) -> None:
+    admin_id = 1
+    captain_ids = [901, 902]
+
+    def at(day: int, hour: int, minute: int = 0) -> datetime:
+        return datetime(2026, 8, day, hour, minute, tzinfo=timezone.utc)
+
+    async with application:
+        add_admin(admin_id, "test_admin")
+        await users.add_captain("901", "captain_a")
+        await users.add_captain("902", "captain_b")
+        await phonebook.add_phone_alias("555", "Police")
+        # In the order the calls arrive, which is not always chronological.
+        for user_id, timestamp, phone, password in [
+            (901, at(1, 10), "555", None),
+            (901, at(1, 11, 30), "777", "pw"),
+            (902, at(2, 12), "888", None),
+            (901, at(2, 9), "555", None),
+            (901, at(2, 8), "888", None),
+            (902, at(1, 23, 59), "555", None),
+            (902, at(2, 13), "555", None),
+            (901, at(1, 11), "777", None),
+        ]:
+            await stats.log_call(user_id, timestamp, phone, password)
+        incremental = {user_id: stats.progress(user_id) for user_id in captain_ids}
+        stats.stop_journal()
+        expected = {user_id: first_calls_from_call_log(user_id) for user_id in captain_ids}
+        stats.read_first_calls()
+        reloaded = {user_id: stats.progress(user_id) for user_id in captain_ids}
+        admin = TelegramUser(application, admin_id, "test_admin")
+        await admin.send("/progress captain_a")
+
+    assert incremental == expected
+    assert reloaded == expected
+    # The repeat on the second day did not move the first call to 555.
+    assert expected[901][0] == ("555", None, at(1, 10))
+    assert telegram.messages_to(admin_id) == [
+        "Прогрес captain\\_a починаючи від 2026/08/01:\n"
+        "```\n"
+        "Police 555    — 10:00:00\n"
+        "       777    — 11:00:00\n"
+        "       777 pw — 11:30:00\n"
+        "       888    — 32:00:00\n"
+        "```"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_reports_add_the_calls_another_worker_recorded(
+    application: Any,
+    telegram: FakeTelegramRequest,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(invalidation, "versions",
+                        multiprocessing.Array("q", invalidation.CACHES))
+    monkeypatch.setattr(invalidation, "seen", [0] * invalidation.CACHES)
+    admin_id = 1
+
+    def at(hour: int) -> datetime:
+        return datetime(2026, 8, 1, hour, tzinfo=timezone.utc)
+
+    def record_elsewhere(cursor: sqlite3.Cursor) -> None:
+        cursor.execute("INSERT INTO call_keys (phone, password) VALUES ('777', NULL)")
+        key_777 = cursor.lastrowid
+        (key_555,) = cursor.execute(
+            "SELECT key_id FROM call_keys WHERE phone = '555' AND password IS NULL"
+        ).fetchone()
+        cursor.executemany("INSERT INTO call_log VALUES (?, ?, ?, NULL)", [
+            (901, int(at(9).timestamp()), key_555),
+            (901, int(at(12).timestamp()), key_777),
+            (902, int(at(11).timestamp()), key_777),
+        ])
+
+    async with application:
+        add_admin(admin_id, "test_admin")
+        await users.add_captain("901", "captain_a")
+        await users.add_captain("902", "captain_b")
+        await stats.log_call(901, at(10), "555", None)
+        await stats.log_call(901, at(11), "555", "pw")
+        # Past the call journal's commit delay.
+        await asyncio.sleep(0.3)
+        quest_store.write(record_elsewhere)
+        invalidation.bump(invalidation.CALLS)
+        admin = TelegramUser(application, admin_id, "test_admin")
+        # Only the new rows are read, not all of call_log.
+        count_calls_in_snapshot = stats.count_calls_in_snapshot
+        monkeypatch.setattr(stats, "count_calls_in_snapshot", None)
+        await admin.send("/leaderboard")
+        await admin.send("/progress captain_a")
+        # Nothing new: the counters are not corrected twice.
+        invalidation.bump(invalidation.CALLS)
+        await admin.send("/leaderboard")
+        # This worker's own call was counted when it was logged.
+        await stats.log_call(901, at(13), "888", None)
+        await asyncio.sleep(0.3)
+        await admin.send("/leaderboard")
+        monkeypatch.setattr(stats, "count_calls_in_snapshot", count_calls_in_snapshot)
+        await admin.send("/check_counts")
+
+    leaderboard = "captain_b (captain) — 1\ncaptain_a (captain) — 4"
+    assert telegram.messages_to(admin_id) == [
+        leaderboard,
+        "Прогрес captain\\_a починаючи від 2026/08/01:\n"
+        "```\n"
+        "  555    — 09:00:00\n"
+        "  555 pw — 11:00:00\n"
+        "  777    — 12:00:00\n"
+        "```",
+        leaderboard,
+        "captain_b (captain) — 1\ncaptain_a (captain) — 5",
+        "Лічильники дзвінків збігаються з журналом",
+    ]
+    assert stats.own_call_rowids == set()
+
+
+@pytest.mark.asyncio
+async def test_call_to_a_number_another_worker_added_as_a_key_is_recorded(
+    application: Any,
+    telegram: FakeTelegramRequest,
+) -> None:
+    captain_id = 901
+
+    async with application:
+        await users.add_captain(str(captain_id), "captain")
+        await add_text_number("555", "Clue")
+        # Another worker recorded the first call to 555, unknown to this one.
+        quest_store.write(lambda cursor: cursor.execute(
+            "INSERT INTO call_keys (phone, password) VALUES ('555', NULL)"
+        ))
+        captain = TelegramUser(application, captain_id, "captain")
+        await captain.send("/call 555")
+        stats.stop_journal()
+        rows = quest_store.read("""
+            SELECT user_id, phone
+            FROM call_log JOIN call_keys USING (key_id)
+        """)
+
+    assert telegram.messages_to(captain_id) == ["Clue"]
+    assert rows == [(captain_id, "555")]
@@ -0,0 +1,198 @@
+import asyncio
+import os
+import random
+import statistics
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import pytest
+from telegram import Update
+from telegram.ext import ContextTypes, TypeHandler
+
+import bot
+import phonebook
+import stats
+import throttle
+import users
+from store import quest_store
+from telegram_fakes import FakeTelegramRequest, TelegramUser
+
+
+# The defaults keep this quick enough for every test run. Raise them through
+# the environment to measure what one bot process sustains, e.g.
+#   LOAD_CAPTAINS=60 LOAD_RATE=200 LOAD_DURATION=30 LOAD_TELEGRAM_LATENCY=0.05 \
+#       pytest -s tests/test_load.py
+@dataclass
+class LoadProfile:
+    captains: int = int(os.getenv("LOAD_CAPTAINS", "40"))
+    admins: int = int(os.getenv("LOAD_ADMINS", "2"))
+    rate: float = float(os.getenv("LOAD_RATE", "20"))
+    duration: float = float(os.getenv("LOAD_DURATION", "2"))
+    admin_share: float = float(os.getenv("LOAD_ADMIN_SHARE", "0.05"))
+    wrong_number_share: float = float(os.getenv("LOAD_WRONG_NUMBER_SHARE", "0.3"))
+    status_share: float = float(os.getenv("LOAD_STATUS_SHARE", "0.3"))
+    broadcasts: int = int(os.getenv("LOAD_BROADCASTS", "1"))
+    telegram_latency: float = float(os.getenv("LOAD_TELEGRAM_LATENCY", "0.005"))
+    concurrent_updates: int = int(os.getenv("LOAD_CONCURRENT_UPDATES", "0"))
+    max_p95: float = float(os.getenv("LOAD_MAX_P95", "2"))
+    seed: int = int(os.getenv("LOAD_SEED", "2025"))
+
+
+@dataclass
+class LoadReport:
+    updates: int
+    elapsed: float
+    latencies: dict[str, list[float]]
+
+    def throughput(self) -> float:
+        return self.updates / self.elapsed
+
+    def format(self) -> str:
+        lines = [
+            f"{self.updates} updates in {self.elapsed:.2f}s, "
+            f"{self.throughput():.1f} updates/s",
+            f"{'command':<14} {'n':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}",
+        ]
+        for command, latencies in sorted(self.latencies.items()):
+            p50, p95, p99 = percentiles(latencies)
+            lines.append(
+                f"{command:<14} {len(latencies):>6} {p50 * 1000:>8.1f} "
+                f"{p95 * 1000:>8.1f} {p99 * 1000:>8.1f}"
+            )
+        return "\n".join(lines)
+
+
+def percentiles(latencies: list[float]) -> tuple[float, float, float]:
+    if len(latencies) < 2:
+        return (latencies[0],) * 3 if latencies else (0.0, 0.0, 0.0)
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return cuts[49], cuts[94], cuts[98]
+
+
+async def run_load(application: Any, profile: LoadProfile) -> LoadReport:
+    rng = random.Random(profile.seed)
+    captains = [
+        TelegramUser(application, 10_000 + n, f"captain_{n}")
+        for n in range(profile.captains)
+    ]
+    admins = [
+        TelegramUser(application, 1_000 + n, f"admin_{n}")
+        for n in range(profile.admins)
+    ]
+    for captain in captains:
+        await users.add_captain(str(captain.user_id), captain.username)
+    for admin in admins:
+        quest_store.write(
+            lambda cursor: cursor.execute(
+                "INSERT INTO users VALUES (?, ?, 'admin')",
+                (admin.user_id, admin.username),
+            )
+        )
+    users.read_users()
+    # The profile models teams playing fair; throttling is tested on its own.
+    throttle.set_limits(0, 0)
+    for n in range(10):
+        await phonebook.add_number(
+            f"555{n:04}",
+            "answer",
+            phonebook.Reply(
+                [phonebook.ReplyPart(phonebook.ReplyType.TEXT, f"Clue {n}")]
+            ),
+        )
+
+    enqueued: dict[int, tuple[str, float]] = {}
+    latencies: dict[str, list[float]] = defaultdict(list)
+    finished = asyncio.Event()
+
+    async def record_done(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+        assert isinstance(update, Update)
+        command, started = enqueued.pop(update.update_id)
+        latencies[command].append(time.perf_counter() - started)
+        if not enqueued and sending_done:
+            finished.set()
+
+    # Runs after every other handler group has finished with the update.
+    application.add_handler(TypeHandler(Update, record_done), group=100)
+
+    def enqueue(user: TelegramUser, text: str) -> None:
+        update = user.update(text)
+        command = text.split(maxsplit=1)[0] if text.startswith("/") else "(message)"
+        enqueued[update.update_id] = (command, time.perf_counter())
+        application.update_queue.put_nowait(update)
+
+    def next_captain_command() -> str:
+        choice = rng.random()
+        if choice < profile.status_share:
+            return "/status"
+        if choice < profile.status_share + profile.wrong_number_share:
+            return f"/call {rng.randrange(1000, 9999)} guess"
+        return f"/call 555{rng.randrange(10):04} answer"
+
+    broadcasts_left = profile.broadcasts
+    sending_done = False
+    started = time.perf_counter()
+    await application.start()
+    try:
+        deadline = started + profile.duration
+        while time.perf_counter() < deadline:
+            if rng.random() < profile.admin_share:
+                admin = rng.choice(admins)
+                if broadcasts_left > 0:
+                    broadcasts_left -= 1
+                    for text in ("/broadcast", "Load test broadcast", "/done"):
+                        enqueue(admin, text)
+                else:
+                    enqueue(admin, "/leaderboard")
+            else:
+                enqueue(rng.choice(captains), next_captain_command())
+            await asyncio.sleep(rng.expovariate(profile.rate))
+        sending_done = True
+        if enqueued:
+            await finished.wait()
+        elapsed = time.perf_counter() - started
+    finally:
+        await application.stop()
+
+    return LoadReport(
+        sum(len(values) for values in latencies.values()),
+        elapsed,
+        latencies,
+    )
+
+
+@pytest.mark.asyncio
+async def test_load_profile_stays_within_latency_budget(tmp_path: Path) -> None:
+    profile = LoadProfile()
+    telegram = FakeTelegramRequest(latency=profile.telegram_latency)
+    application = bot.create_application(
+        "999001:test-token",
+        request=telegram,
+        database_path=str(tmp_path / "quest.db"),
+        concurrent_updates=profile.concurrent_updates,
+    )
+
+    async with application:
+        report = await asyncio.wait_for(
+            run_load(application, profile),
+            timeout=profile.duration * 10 + 30,
+        )
+        call_count = sum(
+            len(latencies)
+            for command, latencies in report.latencies.items()
+            if command == "/call"
+        )
+        assert sum(
+            stats.status(10_000 + n) for n in range(profile.captains)
+        ) == call_count
+
+    print()
+    print(report.format())
+    all_latencies = [
+        latency
+        for latencies in report.latencies.values()
+        for latency in latencies
+    ]
+    assert percentiles(all_latencies)[1] <= profile.max_p95
@@ -0,0 +1,110 @@
+import json
+from pathlib import Path
+
+import pytest
+
+import bot
+import phonebook
+import replay
+import throttle
+import update_journal
+import users
+from telegram_fakes import FakeTelegramRequest, TelegramUser
+
+
+@pytest.mark.asyncio
+async def test_recorded_updates_replay_to_the_same_calls_and_replies(
+    tmp_path: Path,
+) -> None:
+    seed_path = str(tmp_path / "seed.db")
+    journal_path = str(tmp_path / "updates.jsonl")
+    captain_id = 901
+
+    seed = bot.create_application("999001:test-token",
+                                  request=FakeTelegramRequest(),
+                                  database_path=seed_path)
+    async with seed:
+        await users.add_captain(str(captain_id), "captain")
+        await phonebook.add_number(
+            "555",
+            None,
+            phonebook.Reply([phonebook.ReplyPart(phonebook.ReplyType.TEXT, "Clue")]),
+        )
+
+    recorded_path = str(tmp_path / "quest.db")
+    replay.copy_database(seed_path, recorded_path)
+    telegram = FakeTelegramRequest()
+    application = bot.create_application("999001:test-token",
+                                         request=telegram,
+                                         database_path=recorded_path,
+                                         update_journal_path=journal_path)
+    async with application:
+        captain = TelegramUser(application, captain_id, "captain")
+        await captain.send("/call 555")
+        await captain.send("/call 777 secret")
+        redelivered = captain.update("/status")
+        await application.process_update(redelivered)
+        await application.process_update(redelivered)
+    recorded = replay.ReplayResult(calls=replay.read_calls(recorded_path),
+                                   replies=replay.sent_replies(telegram))
+
+    result = await replay.replay(journal_path, seed_path)
+
+    # The journal keeps the redelivered update too.
+    assert result.updates == 4
+    assert [call[1:] for call in result.calls] == [
+        (captain_id, "555", None),
+        (captain_id, "777", "secret"),
+    ]
+    assert {command: len(latencies) for command, latencies in result.latencies.items()} == {
+        "/call": 2,
+        "/status": 2,
+    }
+    assert replay.diff(recorded.lines(), result) == []
+    assert "/call" in replay.report(result)
+
+    # A change in behaviour shows up in the diff.
+    recorded.replies.pop()
+    assert replay.diff(recorded.lines(), result)[-1].startswith("+")
+
+
+@pytest.mark.asyncio
+async def test_fast_replay_of_a_paced_journal_is_not_throttled(
+    tmp_path: Path,
+) -> None:
+    seed_path = str(tmp_path / "seed.db")
+    journal_path = str(tmp_path / "updates.jsonl")
+    captain_id = 902
+    call_count = int(throttle.burst) + 10
+
+    seed = bot.create_application("999001:test-token",
+                                  request=FakeTelegramRequest(),
+                                  database_path=seed_path)
+    async with seed:
+        await users.add_captain(str(captain_id), "captain")
+
+    # A captain calling every 10 seconds stays within the default budget.
+    recorded_path = str(tmp_path / "quest.db")
+    replay.copy_database(seed_path, recorded_path)
+    application = bot.create_application("999001:test-token",
+                                         request=FakeTelegramRequest(),
+                                         database_path=recorded_path,
+                                         update_journal_path=journal_path)
+    async with application:
+        captain = TelegramUser(application, captain_id, "captain")
+        for n in range(call_count):
+            update = captain.update(f"/call {n}")
+            update_journal.recorder.record(update)
+    entries = list(update_journal.read_journal(journal_path))
+    Path(journal_path).write_text(
+        "".join(
+            json.dumps({"received": 1_754_000_000 + 10 * n, "update": data}) + "\n"
+            for n, (_, data) in enumerate(entries)
+        ),
+        encoding="utf-8",
+    )
+
+    result = await replay.replay(journal_path, seed_path)
+
+    assert len(result.calls) == call_count
+    assert not any("Лінія зайнята" in reply[2] for reply in result.replies)
@@ -0,0 +1,113 @@
+import asyncio
+import sqlite3
+import time
+from pathlib import Path
+
+import pytest
+
+import tracing
+from store import Store
+
+# Runs for minutes unless interrupted.
+ENDLESS_QUERY = """
+    WITH RECURSIVE numbers(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM numbers)
+    SELECT COUNT(*) FROM numbers
+"""
+
+
+@pytest.mark.asyncio
+async def test_read_that_times_out_is_interrupted(tmp_path: Path) -> None:
+    store = Store()
+    store.open(str(tmp_path / "quest.db"), read_pool_size=1)
+    store.executescript("CREATE TABLE numbers (n INTEGER) STRICT;")
+    try:
+        started = time.perf_counter()
+        with pytest.raises(asyncio.TimeoutError):
+            await store.read_async(ENDLESS_QUERY, timeout=0.1)
+        # The only read thread is free again, and writes never waited.
+        store.write(lambda cursor: cursor.execute("INSERT INTO numbers VALUES (1)"))
+        assert await store.read_async("SELECT n FROM numbers") == [(1,)]
+        assert time.perf_counter() - started < 5
+    finally:
+        store.close()
+
+
+def test_locked_database_dumps_recent_statements(
+    tmp_path: Path,
+    caplog: pytest.LogCaptureFixture,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(tracing, "last_dump", 0.0)
+    database_path = tmp_path / "quest.db"
+    store = Store()
+    store.open(str(database_path), busy_timeout=0.05, max_attempts=1)
+    store.executescript("CREATE TABLE numbers (n INTEGER) STRICT;")
+    store.write(lambda cursor: cursor.execute("INSERT INTO numbers VALUES (1)"))
+    # Another process holds the write lock.
+    other = sqlite3.connect(database_path)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            store.write(lambda cursor: cursor.execute("INSERT INTO numbers VALUES (2)"))
+    finally:
+        other.rollback()
+        other.close()
+        store.close()
+
+    [dump] = [record.getMessage() for record in caplog.records
+              if record.name == "tracing"]
+    lines = dump.splitlines()
+    assert lines[0].endswith("database is locked")
+    assert lines[1].startswith("write lock: held by MainThread")
+    assert lines[2].startswith("no connection of this process is in a transaction")
+    assert "writer" in lines[-3] and "INSERT INTO numbers VALUES (1)" in lines[-3]
+    assert "COMMIT" in lines[-2]
+    assert lines[-1].endswith(
+        "tx=yes INSERT INTO numbers VALUES (2) -> OperationalError: database is locked")
+
+
+@pytest.mark.asyncio
+async def test_busy_write_is_retried_while_the_loop_keeps_serving(tmp_path: Path) -> None:
+    database_path = tmp_path / "quest.db"
+    store = Store()
+    store.open(str(database_path), busy_timeout=0.1, max_attempts=20)
+    store.executescript("CREATE TABLE numbers (n INTEGER) STRICT;")
+    other = sqlite3.connect(database_path)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        write = asyncio.create_task(store.write_async(
+            lambda cursor: cursor.execute("INSERT INTO numbers VALUES (1)")
+        ))
+        # The loop goes on running while the write waits and backs off.
+        longest_tick = 0.0
+        for _ in range(30):
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            longest_tick = max(longest_tick, time.perf_counter() - started)
+        assert not write.done()
+        other.rollback()
+        await write
+        assert longest_tick < 0.05
+        assert store.read("SELECT n FROM numbers") == [(1,)]
+    finally:
+        other.close()
+        store.close()
+
+
+def test_busy_write_gives_up_after_the_maximum_wait(tmp_path: Path) -> None:
+    database_path = tmp_path / "quest.db"
+    store = Store()
+    store.open(str(database_path), busy_timeout=0.1, max_attempts=100,
+               max_write_wait=0.5)
+    store.executescript("CREATE TABLE numbers (n INTEGER) STRICT;")
+    other = sqlite3.connect(database_path)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        started = time.perf_counter()
+        with pytest.raises(sqlite3.OperationalError):
+            store.write(lambda cursor: cursor.execute("INSERT INTO numbers VALUES (1)"))
+        assert time.perf_counter() - started < 0.6
+    finally:
+        other.rollback()
+        other.close()
+        store.close()
@@ -0,0 +1,93 @@
+import json
+from pathlib import Path
+from typing import Any
+
+import httpx
+import pytest
+
+import bot
+import users
+import webhook
+from telegram_fakes import FakeTelegramRequest, TelegramUser
+
+SECRET = "test-secret"
+
+
+@pytest.fixture
+def telegram() -> FakeTelegramRequest:
+    return FakeTelegramRequest()
+
+
+@pytest.fixture
+def application(tmp_path: Path, telegram: FakeTelegramRequest) -> Any:
+    return bot.create_application(
+        "999001:test-token",
+        request=telegram,
+        database_path=str(tmp_path / "quest.db"),
+    )
+
+
+def update_json(user: TelegramUser, text: str) -> str:
+    return json.dumps(user.update(text).to_dict())
+
+
+@pytest.mark.asyncio
+async def test_webhook_feeds_updates_and_drains_on_stop(
+    application: Any,
+    telegram: FakeTelegramRequest,
+) -> None:
+    captain_id = 501
+
+    async with application:
+        await users.add_captain(str(captain_id), "captain")
+        captain = TelegramUser(application, captain_id, "captain")
+        server = webhook.WebhookServer(application, "/telegram", SECRET)
+        await application.start()
+        await server.start("127.0.0.1", 0)
+        host, port = server.address
+
+        async with httpx.AsyncClient(base_url=f"http://{host}:{port}") as client:
+            health = await client.get("/healthz")
+            wrong_secret = await client.post(
+                "/telegram",
+                content=update_json(captain, "/status"),
+                headers={webhook.SECRET_TOKEN_HEADER: "guess"},
+            )
+            malformed = await client.post(
+                "/telegram",
+                content="{not json",
+                headers={webhook.SECRET_TOKEN_HEADER: SECRET},
+            )
+            accepted = await client.post(
+                "/telegram",
+                content=update_json(captain, "/status"),
+                headers={webhook.SECRET_TOKEN_HEADER: SECRET},
+            )
+
+        # Stopping right away still answers everything already accepted.
+        await server.stop(drain_timeout=5)
+        await application.stop()
+
+    assert health.status_code == 200
+    assert wrong_secret.status_code == 403
+    assert malformed.status_code == 400
+    assert accepted.status_code == 200
+    assert telegram.messages_to(captain_id) == [r"Кількість дзвінків — 0\."]
+
+
+@pytest.mark.asyncio
+async def test_webhook_stop_closes_idle_connections(application: Any) -> None:
+    async with application:
+        server = webhook.WebhookServer(application, "/telegram", SECRET)
+        await application.start()
+        await server.start("127.0.0.1", 0)
+        host, port = server.address
+
+        async with httpx.AsyncClient(base_url=f"http://{host}:{port}") as client:
+            # The client keeps this connection open after the response.
+            assert (await client.get("/healthz")).status_code == 200
+            await server.stop(drain_timeout=5)
+            with pytest.raises(httpx.TransportError):
+                await client.get("/healthz")
+
+        await application.stop()
@@ -0,0 +1,242 @@
+import asyncio
+import functools
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+import bot
+import phonebook
+import users
+import workers
+from store import quest_store
+from telegram_fakes import FakeTelegramRequest, TelegramUser
+
+TOKEN = "999001:test-token"
+
+
+# Writes what a worker process sent to a file the test can read.
+class RecordingTelegramRequest(FakeTelegramRequest):
+    def __init__(self, path: str, latency: float = 0.0) -> None:
+        super().__init__(latency)
+        self.path = path
+
+    async def do_request(self, url: str, method: str, request_data: Any = None,
+                         *args: Any, **kwargs: Any) -> tuple[int, bytes]:
+        # Not self.calls[-1], which may be a request made meanwhile.
+        api_method = url.rsplit("/", maxsplit=1)[-1]
+        parameters = request_data.parameters if request_data is not None else {}
+        result = await super().do_request(url, method, request_data, *args, **kwargs)
+        if api_method == "sendMessage":
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps([os.getpid(), parameters["chat_id"],
+                                       parameters["text"]]) + "\n")
+        return result
+
+
+def create_worker(database_path: str, replies_path: str,
+                  index: int, count: int, latency: float = 0.0) -> Any:
+    return bot.create_application(TOKEN,
+                                  request=RecordingTelegramRequest(replies_path, latency),
+                                  database_path=database_path,
+                                  update_journal_path="",
+                                  resume_broadcasts=index == 0)
+
+
+def read_replies(replies_path: str) -> list[tuple[int, int, str]]:
+    if not Path(replies_path).exists():
+        return []
+    return [tuple(json.loads(line)) for line in Path(replies_path).read_text().splitlines()]
+
+
+async def wait_for_sent(replies_path: str, text: str, count: int) -> list[int]:
+    deadline = time.monotonic() + 30
+    while True:
+        chats = [chat for _, chat, sent in read_replies(replies_path) if sent == text]
+        if len(chats) >= count or time.monotonic() > deadline:
+            return chats
+        await asyncio.sleep(0.05)
+
+
+async def wait_for_replies(replies_path: str, chat_id: int, count: int) -> list[str]:
+    deadline = time.monotonic() + 30
+    while True:
+        replies = [text for _, chat, text in read_replies(replies_path) if chat == chat_id]
+        if len(replies) >= count or time.monotonic() > deadline:
+            return replies
+        await asyncio.sleep(0.05)
+
+
+@pytest.mark.asyncio
+async def test_workers_route_by_chat_and_reload_what_other_workers_changed(
+    tmp_path: Path,
+) -> None:
+    database_path = str(tmp_path / "quest.db")
+    replies_path = str(tmp_path / "replies.jsonl")
+    # Two workers: even chat IDs go to the first, odd ones to the second.
+    admin_id = 2
+    captain_id = 7
+
+    seed = bot.create_application(TOKEN,
+                                  request=FakeTelegramRequest(),
+                                  database_path=database_path)
+    async with seed:
+        quest_store.write(lambda cursor: cursor.execute(
+            "INSERT INTO users VALUES (?, 'test_admin', 'admin')",
+            (admin_id,),
+        ))
+        await phonebook.add_number(
+            "555",
+            None,
+            phonebook.Reply([phonebook.ReplyPart(phonebook.ReplyType.TEXT, "Clue")]),
+        )
+
+    pool = workers.WorkerPool(2, functools.partial(create_worker,
+                                                   database_path,
+                                                   replies_path))
+    intake = workers.create_intake_application(TOKEN,
+                                               pool,
+                                               request=FakeTelegramRequest())
+    async with intake:
+        await intake.start()
+        admin = TelegramUser(intake, admin_id, "test_admin")
+        captain = TelegramUser(intake, captain_id, "new_captain")
+
+        await intake.update_queue.put(admin.update(f"/add_captain {captain_id} new_captain"))
+        await intake.update_queue.put(admin.update("/pause_calls"))
+        await wait_for_replies(replies_path, admin_id, 1)
+        # The captain's worker did not add the captain or pause the calls.
+        await intake.update_queue.put(captain.update("/call 555"))
+        await wait_for_replies(replies_path, captain_id, 1)
+        await intake.update_queue.put(admin.update("/resume_calls"))
+        await wait_for_replies(replies_path, admin_id, 2)
+        await intake.update_queue.put(captain.update("/call 555"))
+        await wait_for_replies(replies_path, captain_id, 2)
+        # Past the call journal's commit delay.
+        await asyncio.sleep(0.5)
+        await intake.update_queue.put(admin.update("/leaderboard"))
+        await wait_for_replies(replies_path, admin_id, 3)
+        await intake.stop()
+
+    replies = read_replies(replies_path)
+    assert [text for _, chat, text in replies if chat == admin_id] == [
+        "_Телефонну мережу вимкнено_",
+        "_Телефонну мережу увімкнено_",
+        "new_captain (captain) — 1",
+    ]
+    assert [text for _, chat, text in replies if chat == captain_id] == [
+        "_Телефонна мережа не працює_",
+        "Clue",
+    ]
+    # Each chat stayed with one worker, and the two chats used different ones.
+    pids = {chat: {pid for pid, reply_chat, _ in replies if reply_chat == chat}
+            for chat in (admin_id, captain_id)}
+    assert len(pids[admin_id]) == 1 and len(pids[captain_id]) == 1
+    assert pids[admin_id] != pids[captain_id]
+    assert not any(worker.process.is_alive() for worker in pool.workers)
+
+
+@pytest.mark.asyncio
+async def test_throttle_limits_changed_on_one_worker_apply_on_the_others(
+    tmp_path: Path,
+) -> None:
+    database_path = str(tmp_path / "quest.db")
+    replies_path = str(tmp_path / "replies.jsonl")
+    admin_id = 2
+    captain_id = 7
+
+    seed = bot.create_application(TOKEN,
+                                  request=FakeTelegramRequest(),
+                                  database_path=database_path)
+    async with seed:
+        quest_store.write(lambda cursor: cursor.execute(
+            "INSERT INTO users VALUES (?, 'test_admin', 'admin')",
+            (admin_id,),
+        ))
+        await users.add_captain(str(captain_id), "captain")
+
+    pool = workers.WorkerPool(2, functools.partial(create_worker,
+                                                   database_path,
+                                                   replies_path))
+    intake = workers.create_intake_application(TOKEN,
+                                               pool,
+                                               request=FakeTelegramRequest())
+    async with intake:
+        await intake.start()
+        admin = TelegramUser(intake, admin_id, "test_admin")
+        captain = TelegramUser(intake, captain_id, "captain")
+
+        await intake.update_queue.put(admin.update("/throttle 1 1"))
+        await wait_for_replies(replies_path, admin_id, 1)
+        for _ in range(2):
+            await intake.update_queue.put(captain.update("/call 555"))
+        await wait_for_replies(replies_path, captain_id, 2)
+        await intake.stop()
+
+    assert [text for _, chat, text in read_replies(replies_path) if chat == captain_id] == [
+        r"_Ніхто не відповідає\.\.\._",
+        "_Лінія зайнята, спробуйте пізніше_",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_restarted_worker_leaves_a_running_broadcast_to_its_sender(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    # Read by the worker processes.
+    monkeypatch.setenv("BROADCAST_CONCURRENCY", "1")
+    monkeypatch.setenv("BROADCAST_LEASE", "3")
+    database_path = str(tmp_path / "quest.db")
+    replies_path = str(tmp_path / "replies.jsonl")
+    # The broadcast is sent by the second worker; the first is killed.
+    sender_id = 3
+    other_admin_id = 2
+    captain_ids = list(range(1001, 1061))
+
+    seed = bot.create_application(TOKEN,
+                                  request=FakeTelegramRequest(),
+                                  database_path=database_path)
+    async with seed:
+        quest_store.write(lambda cursor: cursor.executemany(
+            "INSERT INTO users VALUES (?, ?, ?)",
+            [(sender_id, "sender", "admin"), (other_admin_id, "other_admin", "admin")] +
+            [(captain_id, f"captain_{captain_id}", "captain") for captain_id in captain_ids],
+        ))
+
+    pool = workers.WorkerPool(2, functools.partial(create_worker,
+                                                   database_path,
+                                                   replies_path,
+                                                   latency=0.05))
+    intake = workers.create_intake_application(TOKEN,
+                                               pool,
+                                               request=FakeTelegramRequest())
+    async with intake:
+        await intake.start()
+        sender = TelegramUser(intake, sender_id, "sender")
+        other_admin = TelegramUser(intake, other_admin_id, "other_admin")
+        for text in ("/broadcast", "News", "/done"):
+            await intake.update_queue.put(sender.update(text))
+        await wait_for_sent(replies_path, "News", 1)
+
+        killed = pool.workers[0].process
+        killed.kill()
+        # Updates handed to a worker that is dying are lost, so this one waits
+        # for the new process. It has resumed broadcasts before handling it.
+        while pool.workers[0].process is killed:
+            await asyncio.sleep(0.05)
+        await intake.update_queue.put(other_admin.update("/retry_broadcast 1"))
+        retry_replies = await wait_for_replies(replies_path, other_admin_id, 1)
+        sent_before_the_restart_finished = len(read_replies(replies_path))
+        sent = await wait_for_sent(replies_path, "News", len(captain_ids))
+        # Long enough for a second sender to show up.
+        await asyncio.sleep(1)
+        await intake.stop()
+
+    assert retry_replies == ["Це оголошення ще надсилається"]
+    assert sent_before_the_restart_finished < len(captain_ids)
+    news = [chat for _, chat, text in read_replies(replies_path) if text == "News"]
+    assert sorted(news) == sorted(sent) == captain_ids
@@ -0,0 +1,108 @@
+import os
+
+from enum import Enum
+from sqlite3 import Cursor
+from typing import Set
+
+import invalidation
+import metrics
+from metrics import timed_query
+from ratelimit import KeyedTokenBuckets
+from store import quest_store
+
+THROTTLED = "quest_throttled_total"
+
+class Verdict(Enum):
+    ALLOW = 1
+    # Over budget for the first time since the last allowed command: the
+    # captain is told the line is busy.
+    NOTIFY = 2
+    # Still over budget: dropped without a reply, so a flood of commands does
+    # not turn into a flood of replies.
+    DROP = 3
+
+# One budget per captain shared by /call and /status. A rate of 0 turns
+# throttling off.
+rate_per_minute = 30.0
+burst = 10.0
+buckets = KeyedTokenBuckets(rate_per_minute / 60, burst)
+notified: Set[int] = set()
+# From the environment; the limits in use are stored in the database, so
+# that /throttle applies to every worker process.
+configured_rate_per_minute = rate_per_minute
+configured_burst = burst
+
+def configure() -> None:
+    global buckets, configured_rate_per_minute, configured_burst
+    new_rate_per_minute = float(os.getenv("CAPTAIN_RATE_PER_MINUTE", "30"))
+    new_burst = float(os.getenv("CAPTAIN_BURST", "10"))
+    if not valid_limits(new_rate_per_minute, new_burst):
+        raise ValueError(f"CAPTAIN_RATE_PER_MINUTE must be at least 0 and "
+                         f"CAPTAIN_BURST at least 1, got {new_rate_per_minute:g} "
+                         f"and {new_burst:g}")
+    configured_rate_per_minute = new_rate_per_minute
+    configured_burst = new_burst
+    buckets = KeyedTokenBuckets(0, 0)
+    notified.clear()
+    set_limits(new_rate_per_minute, new_burst)
+
+# A captain with a burst below 1 could never make a call.
+def valid_limits(new_rate_per_minute: float, new_burst: float) -> bool:
+    return new_rate_per_minute == 0 or (new_rate_per_minute > 0 and new_burst >= 1)
+
+# Applies to the captains' current budgets as well, so it takes effect
+# immediately.
+def set_limits(new_rate_per_minute: float, new_burst: float) -> None:
+    global rate_per_minute, burst
+    rate_per_minute = new_rate_per_minute
+    burst = new_burst
+    buckets.configure(rate_per_minute / 60, burst)
+
+# Limits changed with /throttle outlast restarts until the environment's
+# limits change.
+def store_configured_limits(cursor: Cursor) -> None:
+    stored = cursor.execute("""
+        SELECT configured_rate_per_minute, configured_burst
+        FROM throttle
+    """).fetchone()
+    if stored == (configured_rate_per_minute, configured_burst):
+        return
+    cursor.execute("DELETE FROM throttle")
+    cursor.execute("INSERT INTO throttle VALUES (?, ?, ?, ?)",
+                   (configured_rate_per_minute, configured_burst,
+                    configured_rate_per_minute, configured_burst))
+
+@timed_query
+def read_limits() -> None:
+    stored_rate_per_minute, stored_burst = quest_store.read_one("""
+        SELECT rate_per_minute, burst
+        FROM throttle
+    """)
+    set_limits(stored_rate_per_minute, stored_burst)
+
+@timed_query
+async def modify_limits(new_rate_per_minute: float, new_burst: float) -> None:
+    await quest_store.write_async(lambda cursor: cursor.execute(
+            "UPDATE throttle SET rate_per_minute = ?, burst = ?",
+            (new_rate_per_minute, new_burst)
+    ))
+    invalidation.bump(invalidation.THROTTLE)
+    # Only reached after the transaction has committed.
+    set_limits(new_rate_per_minute, new_burst)
+
+def setup() -> None:
+    quest_store.run_script("throttle.sql")
+    quest_store.write(store_configured_limits)
+    read_limits()
+
+def check(user_id: int, command: str) -> Verdict:
+    if rate_per_minute <= 0:
+        return Verdict.ALLOW
+    if buckets.bucket(user_id).try_acquire():
+        notified.discard(user_id)
+        return Verdict.ALLOW
+    metrics.registry.increment(THROTTLED, command=command)
+    if user_id in notified:
+        return Verdict.DROP
+    notified.add(user_id)
+    return Verdict.NOTIFY
@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS throttle (
+  rate_per_minute REAL NOT NULL,
+  burst REAL NOT NULL,
+  configured_rate_per_minute REAL NOT NULL,
+  configured_burst REAL NOT NULL
+) STRICT;
@@ -0,0 +1,221 @@
+import collections
+import logging
+import os
+import sqlite3
+import threading
+import time
+import weakref
+
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable, Deque, List, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+MAX_SQL_LENGTH = 200
+
+@dataclass
+class TraceEvent:
+    timestamp: float
+    pid: int
+    thread: str
+    connection: str
+    sql: str
+    duration: float
+    # Time spent waiting for the store's write lock before the statement.
+    lock_wait: float
+    in_transaction: bool
+    error: str | None = None
+
+    def format(self) -> str:
+        time_utc = datetime.fromtimestamp(self.timestamp, timezone.utc)
+        line = (f"{time_utc:%H:%M:%S.%f} pid={self.pid} {self.thread} "
+                f"{self.connection} {self.duration * 1000:.1f}ms "
+                f"wait={self.lock_wait * 1000:.1f}ms "
+                f"tx={'yes' if self.in_transaction else 'no'} {self.sql}")
+        if self.error is not None:
+            line += f" -> {self.error}"
+        return line
+
+# Recent statements on every traced connection, oldest first. Appending to a
+# deque is atomic, so threads record without a lock.
+events: Deque[TraceEvent] = collections.deque(maxlen=1000)
+dump_interval = 10.0
+last_dump = 0.0
+dump_lock = threading.Lock()
+
+# Thread holding the store's write lock, and since when.
+write_lock_holder: Tuple[str, float] | None = None
+
+def configure(size: int, interval: float) -> None:
+    global events, dump_interval
+    events = collections.deque(events, maxlen=max(size, 0))
+    dump_interval = interval
+
+def short_sql(sql: str) -> str:
+    sql = " ".join(sql.split())
+    if len(sql) > MAX_SQL_LENGTH:
+        sql = sql[:MAX_SQL_LENGTH] + "…"
+    return sql
+
+def hold_write_lock() -> bool:
+    global write_lock_holder
+    # The lock is reentrant; only the outermost holder is recorded.
+    if write_lock_holder is not None:
+        return False
+    write_lock_holder = (threading.current_thread().name, time.time())
+    return True
+
+def release_write_lock(held: bool) -> None:
+    global write_lock_holder
+    if held:
+        write_lock_holder = None
+
+connections: "weakref.WeakSet[TracedConnection]" = weakref.WeakSet()
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql: str, parameters: Any = ()) -> "TracedCursor":
+        return traced(self.connection, sql,
+                      lambda: sqlite3.Cursor.execute(self, sql, parameters))
+
+    def executemany(self, sql: str, parameters: Any) -> "TracedCursor":
+        return traced(self.connection, sql,
+                      lambda: sqlite3.Cursor.executemany(self, sql, parameters))
+
+    def executescript(self, script: str) -> "TracedCursor":
+        return traced(self.connection, script,
+                      lambda: sqlite3.Cursor.executescript(self, script))
+
+# A connection that records every statement, commit and rollback in `events`
+# and dumps them when SQLite reports an OperationalError.
+class TracedConnection(sqlite3.Connection):
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.name = "connection"
+        self.lock_wait = 0.0
+        self.last_thread = ""
+        self.last_sql = ""
+        # The statement that opened the current transaction, and when.
+        self.transaction: Tuple[str, float] | None = None
+        connections.add(self)
+
+    def cursor(self, factory: Any = None) -> Any:
+        return super().cursor(factory if factory is not None else TracedCursor)
+
+    # The built-in shortcuts bypass the cursor's methods.
+    def execute(self, sql: str, parameters: Any = ()) -> Any:
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, parameters: Any) -> Any:
+        return self.cursor().executemany(sql, parameters)
+
+    def executescript(self, script: str) -> Any:
+        return self.cursor().executescript(script)
+
+    def commit(self) -> None:
+        traced(self, "COMMIT", super().commit)
+
+    def rollback(self) -> None:
+        traced(self, "ROLLBACK", super().rollback)
+
+    # The built-in one commits and rolls back without going through the
+    # methods above.
+    def __exit__(self, exc_type: Any, exc: Any, traceback: Any) -> bool:
+        if exc_type is not None:
+            self.rollback()
+            return False
+        try:
+            self.commit()
+        except sqlite3.Error:
+            self.rollback()
+            raise
+        return False
+
+def traced(connection: Any, sql: str, run: Callable[[], T]) -> T:
+    if not isinstance(connection, TracedConnection):
+        return run()
+    lock_wait, connection.lock_wait = connection.lock_wait, 0.0
+    thread = threading.current_thread().name
+    timestamp = time.time()
+    started = time.perf_counter()
+    error = None
+    try:
+        return run()
+    except sqlite3.Error as e:
+        error = e
+        raise
+    finally:
+        sql = short_sql(sql)
+        try:
+            in_transaction = connection.in_transaction
+        except sqlite3.ProgrammingError:
+            # Closed.
+            in_transaction = False
+        opened = in_transaction and connection.transaction is None
+        if not in_transaction:
+            connection.transaction = None
+        elif opened:
+            connection.transaction = (sql, timestamp)
+        connection.last_thread = thread
+        connection.last_sql = sql
+        events.append(TraceEvent(timestamp,
+                                 os.getpid(),
+                                 thread,
+                                 connection.name,
+                                 sql,
+                                 time.perf_counter() - started,
+                                 lock_wait,
+                                 in_transaction,
+                                 None if error is None else
+                                 f"{type(error).__name__}: {error}"))
+        # Interrupts are the read pool giving up on a slow read.
+        if (isinstance(error, sqlite3.OperationalError) and
+            error.sqlite_errorcode != sqlite3.SQLITE_INTERRUPT):
+            # A deferred transaction opened by the failing statement holds no
+            # lock, so it is left out of the summary.
+            dump(error, connection if opened else None)
+
+def transaction_summary(failed: TracedConnection | None) -> List[str]:
+    now = time.time()
+    lines = []
+    holder = write_lock_holder
+    if holder is None:
+        lines.append("write lock: free")
+    else:
+        lines.append(f"write lock: held by {holder[0]} for {now - holder[1]:.3f}s")
+    in_transaction = False
+    for connection in list(connections):
+        if connection is failed:
+            continue
+        try:
+            if not connection.in_transaction:
+                continue
+        except sqlite3.ProgrammingError:
+            # Closed.
+            continue
+        in_transaction = True
+        opened_by, since = connection.transaction or ("?", now)
+        lines.append(f"{connection.name} in a transaction for {now - since:.3f}s "
+                     f"on {connection.last_thread}, opened by: {opened_by}, "
+                     f"last: {connection.last_sql}")
+    if not in_transaction:
+        lines.append("no connection of this process is in a transaction; "
+                     "the lock is held by another process or connection")
+    return lines
+
+def dump(error: sqlite3.Error, failed: TracedConnection | None = None) -> None:
+    global last_dump
+    with dump_lock:
+        now = time.monotonic()
+        # A busy database fails many statements at once; one dump covers them.
+        if last_dump != 0.0 and now - last_dump < dump_interval:
+            return
+        last_dump = now
+    lines = ([f"sqlite error in pid {os.getpid()} on "
+              f"{threading.current_thread().name}: {error}"] +
+             transaction_summary(failed) +
+             [f"last {len(events)} statements:"] +
+             [event.format() for event in list(events)])
+    logger.error("\n".join(lines))
@@ -0,0 +1,55 @@
+import json
+import logging
+import time
+
+from typing import Any, Dict, Iterator, TextIO, Tuple
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+logger = logging.getLogger(__name__)
+
+# Appends every update the bot receives, duplicates included, to a JSON Lines
+# file, one {"received": epoch seconds, "update": {...}} object per line.
+# tests/replay.py feeds such a journal back through the bot.
+class UpdateRecorder:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._file: TextIO = open(path, "a", encoding="utf-8")
+
+    def record(self, update: Update) -> None:
+        entry = {"received": round(time.time(), 3), "update": update.to_dict()}
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        # A line per update, so a crash loses at most the update in flight.
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+recorder: UpdateRecorder | None = None
+
+def open_journal(path: str) -> None:
+    global recorder
+    close_journal()
+    recorder = UpdateRecorder(path)
+    logger.info(f"recording updates to {path}")
+
+def close_journal() -> None:
+    global recorder
+    if recorder is not None:
+        recorder.close()
+        recorder = None
+
+# Runs before duplicate updates are dropped.
+async def record_update(update: object,
+                        context: ContextTypes.DEFAULT_TYPE) -> None:
+    if recorder is not None and isinstance(update, Update):
+        recorder.record(update)
+
+def read_journal(path: str) -> Iterator[Tuple[float, Dict[str, Any]]]:
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if line.strip() == "":
+                continue
+            entry = json.loads(line)
+            yield entry["received"], entry["update"]
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+
+from collections import deque
+from typing import Any, Awaitable, Deque, Dict, Hashable, Iterable, Set
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, BaseUpdateProcessor, ContextTypes
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Processes updates from different chats concurrently, at most
+# `max_parallel_chats` at a time, while updates from one chat run strictly one
+# after another in arrival order. That keeps LongActionContext flows and
+# multi-part replies of one chat from interleaving.
+#
+# PTB's own semaphore only bounds the number of waiting tasks; the limit that
+# matters is acquired after the chat lock, so a backlog in one chat never
+# occupies slots other chats could use.
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    max_pending_updates = 4096
+
+    def __init__(self, max_parallel_chats: int) -> None:
+        super().__init__(self.max_pending_updates)
+        self.max_parallel_chats = max_parallel_chats
+        self._parallel_chats = asyncio.BoundedSemaphore(max_parallel_chats)
+        self._chat_locks: Dict[Hashable, asyncio.Lock] = {}
+        self._chat_waiters: Dict[Hashable, int] = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self,
+                                update: object,
+                                coroutine: Awaitable[Any]) -> None:
+        key = chat_key(update)
+        if key is None:
+            async with self._parallel_chats:
+                await coroutine
+            return
+        # asyncio.Lock wakes waiters in FIFO order, and PTB starts these tasks
+        # in the order updates were received.
+        lock = self._chat_locks.setdefault(key, asyncio.Lock())
+        self._chat_waiters[key] = self._chat_waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                async with self._parallel_chats:
+                    await coroutine
+        finally:
+            self._chat_waiters[key] -= 1
+            if self._chat_waiters[key] == 0:
+                del self._chat_waiters[key]
+                del self._chat_locks[key]
+
+def chat_key(update: object) -> Hashable | None:
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return None
+
+# IDs of the last `capacity` updates. Telegram delivers an update again when
+# the bot did not confirm it, which happens after a crash or a kill during
+# polling. On startup this is seeded with the updates of recorded calls, so a
+# redelivered /call gets neither a second reply nor a second record.
+class RecentUpdates:
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self._ids: Set[int] = set()
+        self._order: Deque[int] = deque()
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    # False if the update was already seen.
+    def add(self, update_id: int) -> bool:
+        if update_id in self._ids:
+            return False
+        self._ids.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self.capacity:
+            self._ids.discard(self._order.popleft())
+        return True
+
+    def reset(self, capacity: int, update_ids: Iterable[int]) -> None:
+        self.capacity = capacity
+        self._ids.clear()
+        self._order.clear()
+        for update_id in update_ids:
+            self.add(update_id)
+
+recent_updates = RecentUpdates(10_000)
+
+# Runs before every other handler group.
+async def drop_duplicate_update(update: object,
+                                context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not isinstance(update, Update):
+        return
+    if recent_updates.add(update.update_id):
+        return
+    metrics.registry.increment(metrics.DUPLICATE_UPDATES, stage="cache")
+    logger.warning(f"dropped update {update.update_id}, it was already processed")
+    raise ApplicationHandlerStop
@@ -1,15 +1,11 @@
-import os
-import sqlite3
-
 from sqlite3 import Cursor
 from dataclasses import dataclass
 from typing import Dict, List, Tuple
 from enum import Enum
 
-users_connection = sqlite3.connect(os.getenv("QUEST_DB_PATH", "quest.db"))
-
-with open('users.sql') as users_file:
-    users_connection.executescript(users_file.read())
+import invalidation
+from metrics import timed_query
+from store import quest_store
 
 class UserRole(Enum):
     ADMIN = "admin"
@@ -24,35 +20,45 @@ class User:
 users: Dict[int, User] = {}
 users_by_username: Dict[str, User] = {}
 
+@timed_query
 def read_users() -> None:
     global users
     global users_by_username
-    users = {}
-    cursor = users_connection.cursor()
-    cursor.execute("""
+    new_users = {}
+    rows = quest_store.read("""
         SELECT user_id, username, role
         FROM users
     """)
-    for user_id, username, role in cursor.fetchall():
-        users[user_id] = User(user_id, username, UserRole(role))
-    users_by_username = { user.username: user for user in users.values() }
-
-def add_captain(user_id: str, username: str) -> None:
-    with users_connection:
-        cursor = users_connection.cursor()
-        cursor.execute(
+    for user_id, username, role in rows:
+        new_users[user_id] = User(user_id, username, UserRole(role))
+    new_users_by_username = { user.username: user for user in new_users.values() }
+    users, users_by_username = new_users, new_users_by_username
+
+@timed_query
+async def add_captain(user_id: str, username: str) -> None:
+    await quest_store.write_async(lambda cursor: cursor.execute(
             "INSERT INTO users VALUES (?, ?, ?)",
             (user_id, username, UserRole.CAPTAIN.value)
-        )
-    read_users()
+    ))
+    invalidation.bump(invalidation.USERS)
+    user = User(int(user_id), username, UserRole.CAPTAIN)
+    users[user.user_id] = user
+    users_by_username[user.username] = user
 
-def remove_captain(user_id: str) -> None:
-    with users_connection:
-        cursor = users_connection.cursor()
-        cursor.execute(
+@timed_query
+async def remove_captain(user_id: str) -> None:
+    cursor = await quest_store.write_async(lambda cursor: cursor.execute(
             "DELETE FROM users WHERE user_id = ? and role = 'captain'",
             (user_id,)
-        )
-    read_users()
+    ))
+    if cursor.rowcount > 0:
+        invalidation.bump(invalidation.USERS)
+        # The row may never have been loaded, e.g. one added to the database
+        # by hand without /read_users.
+        user = users.pop(int(user_id), None)
+        if user is not None:
+            users_by_username.pop(user.username, None)
 
-read_users()
+def setup() -> None:
+    quest_store.run_script("users.sql")
+    read_users()
@@ -0,0 +1,228 @@
+import asyncio
+import hmac
+import json
+import logging
+import signal
+
+from dataclasses import dataclass
+from typing import Dict, Set, Tuple
+from urllib.parse import urlsplit
+
+from telegram import Update
+from telegram.ext import Application
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_REQUESTS = "quest_webhook_requests_total"
+
+HEALTH_PATH = "/healthz"
+SECRET_TOKEN_HEADER = "x-telegram-bot-api-secret-token"
+
+# Telegram's updates are a few KiB; anything this large is not one of them.
+MAX_BODY_SIZE = 1 << 20
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    411: "Length Required",
+    413: "Payload Too Large",
+    503: "Service Unavailable",
+}
+
+class HttpError(Exception):
+    def __init__(self, status: int) -> None:
+        super().__init__(REASONS[status])
+        self.status = status
+
+@dataclass
+class HttpRequest:
+    method: str
+    path: str
+    headers: Dict[str, str]
+    body: bytes
+
+    def keep_alive(self) -> bool:
+        return self.headers.get("connection", "").lower() != "close"
+
+async def read_request(reader: asyncio.StreamReader, first: bytes) -> HttpRequest:
+    try:
+        request_line = first + await reader.readline()
+        parts = request_line.decode("latin-1").split()
+        if len(parts) != 3:
+            raise HttpError(400)
+        method, target, _ = parts
+        headers: Dict[str, str] = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, colon, value = line.decode("latin-1").partition(":")
+            if not colon:
+                raise HttpError(400)
+            headers[name.strip().lower()] = value.strip()
+    except ValueError:
+        # A line longer than the stream's limit.
+        raise HttpError(400)
+
+    if "transfer-encoding" in headers:
+        raise HttpError(411)
+    try:
+        length = int(headers.get("content-length", "0"))
+    except ValueError:
+        raise HttpError(400)
+    if length < 0:
+        raise HttpError(400)
+    if length > MAX_BODY_SIZE:
+        raise HttpError(413)
+    body = await reader.readexactly(length)
+    return HttpRequest(method, target.split("?", 1)[0], headers, body)
+
+def write_response(writer: asyncio.StreamWriter,
+                   status: int,
+                   body: bytes,
+                   keep_alive: bool) -> None:
+    head = [
+        f"HTTP/1.1 {status} {REASONS[status]}",
+        "Content-Type: text/plain; charset=utf-8",
+        f"Content-Length: {len(body)}",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}",
+    ]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+
+# Receives updates from Telegram and puts them on the application's update
+# queue, the same queue run_polling fills. Telegram keeps its connections
+# open, so a connection serves requests until the peer closes it or the
+# server stops. On stop the listening socket is closed first, idle
+# connections are dropped and requests already being read are answered, so
+# every update Telegram got a 200 for is on the queue.
+class WebhookServer:
+    def __init__(self,
+                 application: Application,
+                 url_path: str,
+                 secret_token: str) -> None:
+        self.application = application
+        self.url_path = url_path
+        self.secret_token = secret_token
+        self.server: asyncio.Server | None = None
+        self.closing = False
+        self._connections: Set[asyncio.Task] = set()
+        self._idle: Set[asyncio.Task] = set()
+
+    async def start(self, host: str, port: int) -> None:
+        self.server = await asyncio.start_server(self.serve_connection, host, port)
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        assert self.server is not None
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def stop(self, drain_timeout: float) -> None:
+        if self.server is None:
+            return
+        self.closing = True
+        self.server.close()
+        for task in self._idle:
+            task.cancel()
+        if self._connections:
+            _, pending = await asyncio.wait(self._connections, timeout=drain_timeout)
+            if pending:
+                logger.warning(f"{len(pending)} webhook connections did not "
+                               f"finish in {drain_timeout}s")
+                for task in pending:
+                    task.cancel()
+                await asyncio.wait(pending)
+        await self.server.wait_closed()
+        self.server = None
+
+    async def serve_connection(self,
+                               reader: asyncio.StreamReader,
+                               writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        assert task is not None
+        self._connections.add(task)
+        try:
+            while not self.closing:
+                # Only a connection with no request in flight may be dropped
+                # by stop(), so wait for the first byte of the next request
+                # while marked idle.
+                self._idle.add(task)
+                try:
+                    first = await reader.read(1)
+                finally:
+                    self._idle.discard(task)
+                if not first:
+                    break
+                try:
+                    request = await read_request(reader, first)
+                    status, body = await self.handle(request)
+                    keep_alive = request.keep_alive() and not self.closing
+                except HttpError as e:
+                    status, body = e.status, str(e).encode()
+                    keep_alive = False
+                metrics.registry.increment(WEBHOOK_REQUESTS, status=str(status))
+                write_response(writer, status, body, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.CancelledError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def handle(self, request: HttpRequest) -> Tuple[int, bytes]:
+        if request.path == HEALTH_PATH:
+            if request.method != "GET":
+                raise HttpError(405)
+            if self.closing or not self.application.running:
+                return 503, b"stopping"
+            return 200, b"ok"
+        if request.path != self.url_path:
+            raise HttpError(404)
+        if request.method != "POST":
+            raise HttpError(405)
+        secret_token = request.headers.get(SECRET_TOKEN_HEADER, "")
+        if not hmac.compare_digest(secret_token.encode(), self.secret_token.encode()):
+            raise HttpError(403)
+        try:
+            update = Update.de_json(json.loads(request.body), self.application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            raise HttpError(400)
+        if update is None:
+            raise HttpError(400)
+        await self.application.update_queue.put(update)
+        return 200, b""
+
+async def run_webhook(application: Application,
+                      webhook_url: str,
+                      host: str,
+                      port: int,
+                      secret_token: str,
+                      drain_timeout: float) -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    async with application:
+        server = WebhookServer(application,
+                               urlsplit(webhook_url).path or "/",
+                               secret_token)
+        await application.start()
+        await server.start(host, port)
+        logger.info(f"receiving updates on {host}:{port}")
+        try:
+            await application.bot.set_webhook(webhook_url,
+                                              allowed_updates=Update.ALL_TYPES,
+                                              secret_token=secret_token)
+            await stop.wait()
+        finally:
+            # The webhook stays registered: Telegram holds new updates until
+            # the bot is back.
+            await server.stop(drain_timeout)
+            await application.stop()
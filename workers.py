@@ -0,0 +1,267 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Optional
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+from telegram.request import BaseRequest
+
+import invalidation
+import metrics
+import update_journal
+from update_processing import chat_key
+
+logger = logging.getLogger(__name__)
+
+WORKER_UPDATES = "quest_worker_updates_total"
+WORKER_RESTARTS = "quest_worker_restarts_total"
+
+WATCH_INTERVAL = 1.0
+STARTUP_TIMEOUT = 60.0
+BACKLOG_WARNING = 100
+
+# The intake sends each update as JSON and an empty message to stop.
+STOP = b""
+
+# Creates a worker's application from its index and the number of workers.
+# Must be picklable, since workers are started with spawn.
+CreateApplication = Callable[[int, int], Application]
+
+async def serve(application: Application, updates: Connection, ready: Any) -> None:
+    async with application:
+        await application.start()
+        ready.set()
+        try:
+            while True:
+                try:
+                    data = await asyncio.to_thread(updates.recv_bytes)
+                except EOFError:
+                    # The intake is gone.
+                    break
+                if data == STOP:
+                    break
+                await application.update_queue.put(
+                    Update.de_json(json.loads(data), application.bot)
+                )
+        finally:
+            # Handles what is already on the update queue.
+            await application.stop()
+
+def run_worker(index: int,
+               count: int,
+               create_application: CreateApplication,
+               updates: Connection,
+               versions: Any,
+               ready: Any) -> None:
+    logging.basicConfig(
+        format=f"%(asctime)s - worker {index} - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO
+    )
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    # Ctrl+C reaches the whole process group; workers stop when the intake
+    # tells them to, after the updates it already accepted.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    invalidation.attach(versions)
+    application = create_application(index, count)
+    asyncio.run(serve(application, updates, ready))
+
+# A worker process with the pipe that feeds it. Updates wait in `outbox`
+# until a thread of their own writes them to the pipe, so a stuck worker
+# only holds up its own chats.
+class Worker:
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.process: Any = None
+        self.connection: Connection | None = None
+        self.outbox: "queue.SimpleQueue[bytes]" = queue.SimpleQueue()
+        self.stopping = False
+        self.sender = threading.Thread(target=self.send_updates,
+                                       name=f"worker-{index}-sender",
+                                       daemon=True)
+
+    def send_updates(self) -> None:
+        while True:
+            data = self.outbox.get()
+            while True:
+                connection = self.connection
+                try:
+                    if connection is None:
+                        raise BrokenPipeError
+                    connection.send_bytes(data)
+                    break
+                except OSError:
+                    # Dead; the watchdog starts a new process with a new pipe.
+                    if self.stopping:
+                        return
+                    time.sleep(0.1)
+            if data == STOP:
+                return
+
+# Runs the bot in `count` worker processes, each a complete application with
+# its own connections to the database. Updates are routed by chat, so one
+# chat's updates are always handled in order by the same worker, and
+# LongActionContext, which lives in the chat's user_data, stays with it.
+# Workers share state through the database and reload the caches another
+# worker changed, see invalidation.py.
+class WorkerPool:
+    def __init__(self, count: int, create_application: CreateApplication) -> None:
+        self.count = count
+        self.create_application = create_application
+        self._context = multiprocessing.get_context("spawn")
+        self.versions = self._context.Array("q", invalidation.CACHES)
+        self.workers = [Worker(index) for index in range(count)]
+        self.stopping = False
+        self._watchdog: asyncio.Task | None = None
+
+    def _spawn(self, worker: Worker) -> Any:
+        receiver, sender = self._context.Pipe(duplex=False)
+        ready = self._context.Event()
+        worker.process = self._context.Process(
+            target=run_worker,
+            args=(worker.index,
+                  self.count,
+                  self.create_application,
+                  receiver,
+                  self.versions,
+                  ready),
+            name=f"quest-worker-{worker.index}",
+        )
+        worker.process.start()
+        receiver.close()
+        old_connection, worker.connection = worker.connection, sender
+        if old_connection is not None:
+            old_connection.close()
+        return ready
+
+    async def _wait_ready(self, worker: Worker, ready: Any) -> None:
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while not await asyncio.to_thread(ready.wait, WATCH_INTERVAL):
+            if not worker.process.is_alive():
+                raise RuntimeError(f"worker {worker.index} exited with "
+                                   f"{worker.process.exitcode} while starting")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"worker {worker.index} did not start "
+                                   f"in {STARTUP_TIMEOUT}s")
+
+    async def start(self) -> None:
+        # The first worker migrates the database on its own before the
+        # others open it.
+        await self._wait_ready(self.workers[0], self._spawn(self.workers[0]))
+        started = [(worker, self._spawn(worker)) for worker in self.workers[1:]]
+        for worker, ready in started:
+            await self._wait_ready(worker, ready)
+        for worker in self.workers:
+            worker.sender.start()
+        self._watchdog = asyncio.create_task(self.watch())
+        logger.info(f"started {self.count} workers")
+
+    def worker_for(self, update: Update) -> Worker:
+        key = chat_key(update)
+        return self.workers[0 if key is None else hash(key) % self.count]
+
+    def dispatch(self, update: Update) -> None:
+        worker = self.worker_for(update)
+        worker.outbox.put(json.dumps(update.to_dict()).encode())
+        metrics.registry.increment(WORKER_UPDATES, worker=str(worker.index))
+
+    async def watch(self) -> None:
+        while not self.stopping:
+            await asyncio.sleep(WATCH_INTERVAL)
+            for worker in self.workers:
+                if self.stopping:
+                    return
+                if not worker.process.is_alive():
+                    logger.error(f"worker {worker.index} exited with "
+                                 f"{worker.process.exitcode}, restarting it")
+                    metrics.registry.increment(WORKER_RESTARTS, worker=str(worker.index))
+                    try:
+                        await self._wait_ready(worker, self._spawn(worker))
+                    except RuntimeError:
+                        logger.exception(f"worker {worker.index} failed to restart")
+                backlog = worker.outbox.qsize()
+                if backlog > BACKLOG_WARNING:
+                    logger.warning(f"worker {worker.index} is {backlog} updates behind")
+
+    async def stop(self, timeout: float) -> None:
+        self.stopping = True
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+        for worker in self.workers:
+            worker.outbox.put(STOP)
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            await asyncio.to_thread(worker.process.join,
+                                    max(deadline - time.monotonic(), 0))
+            if worker.process.is_alive():
+                logger.warning(f"worker {worker.index} did not stop in {timeout}s")
+                worker.process.terminate()
+                await asyncio.to_thread(worker.process.join)
+        for worker in self.workers:
+            worker.stopping = True
+            if worker.connection is not None:
+                worker.connection.close()
+                worker.connection = None
+
+# Receives updates, by polling or webhook like the single-process bot, and
+# hands them to the worker pool. It opens no database and handles nothing
+# itself.
+class IntakeApplication(Application):
+    def __init__(self,
+                 *,
+                 pool: WorkerPool,
+                 update_journal_path: str,
+                 stop_timeout: float,
+                 **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.pool = pool
+        self.update_journal_path = update_journal_path
+        self.stop_timeout = stop_timeout
+
+    async def initialize(self) -> None:
+        await super().initialize()
+        if self.update_journal_path != "":
+            update_journal.open_journal(self.update_journal_path)
+        await self.pool.start()
+
+    async def shutdown(self) -> None:
+        await self.pool.stop(self.stop_timeout)
+        update_journal.close_journal()
+        await super().shutdown()
+
+def create_intake_application(token: str,
+                              pool: WorkerPool,
+                              request: Optional[BaseRequest] = None,
+                              update_journal_path: str = "",
+                              stop_timeout: float = 30.0) -> Application:
+    builder = Application.builder().application_class(
+        IntakeApplication,
+        kwargs={
+            "pool": pool,
+            "update_journal_path": update_journal_path,
+            "stop_timeout": stop_timeout,
+        },
+    ).token(token)
+    if request is not None:
+        builder.request(request)
+    application = builder.build()
+
+    async def forward(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        pool.dispatch(update)
+
+    if update_journal_path != "":
+        application.add_handler(TypeHandler(Update, update_journal.record_update),
+                                group=-2)
+    application.add_handler(TypeHandler(Update, forward))
+    return application